@@ -1,2 +1,9 @@
 from .cgps2caom2 import *  # noqa
 from .cgps_composable import *  # noqa
+from .header_cache import *  # noqa
+from .async_headers import *  # noqa
+from .local_headers import *  # noqa
+from .metrics import *  # noqa
+from .ledger import *  # noqa
+from .observation_sink import *  # noqa
+from .retries import *  # noqa
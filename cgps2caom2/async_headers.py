@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2018.                            (c) 2018.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#  $Revision: 4 $
+#
+# ***********************************************************************
+#
+"""
+Retrieve the headers for many files at once, with asyncio and aiohttp, over a
+pool of persistent, authenticated connections to the CADC data service.
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+from cgps2caom2.header_cache import make_headers
+from cgps2caom2.metrics import Metrics
+from cgps2caom2.retries import RetryPolicy
+
+# aiohttp, asyncio and ssl are imported where they are needed, so that
+# importing cgps2caom2 does not pay for them unless headers are retrieved
+# this way
+import logging
+import time
+
+
+__all__ = ['AsyncHeaderClient', 'HeaderConnectionError', 'HeaderRequestError',
+           'HeaderTimeoutError', 'retrieve_headers', 'DATA_URL']
+
+DATA_URL = 'https://www.cadc-ccda.hia-iha.nrc-cnrc.gc.ca/data/pub'
+
+MAX_REDIRECTS = 5
+
+
+class HeaderRequestError(IOError):
+    """
+    The data service responded, but not with headers, or the connection to
+    it failed.
+    """
+
+    def __init__(self, msg, status=None):
+        super(HeaderRequestError, self).__init__(msg)
+        self.status = status
+
+
+class HeaderConnectionError(HeaderRequestError, ConnectionError):
+    """
+    The connection to the data service failed, or broke before the whole
+    response was read.
+    """
+
+
+class HeaderTimeoutError(HeaderRequestError, TimeoutError):
+    """
+    The data service did not respond within the deadline.
+    """
+
+
+class AsyncHeaderClient(object):
+    """
+    Header retrieval from the data service, with an aiohttp session whose
+    keep-alive connections are re-used for all the requests made through
+    the client. With a certificate, the TLS session for each connection is
+    established once, not once per file.
+
+    Each request is made as the RetryPolicy says. The retries, timeouts,
+    hedged requests and failures are counted in the metrics, and the
+    seconds each successful request takes, including the retries, are
+    observed as header_seconds.
+
+    Use from within one event loop, and close when done.
+    """
+
+    def __init__(self, cert=None, base_url=DATA_URL, max_connections=8,
+                 policy=None, metrics=None):
+        """
+        :param cert: X509 certificate for accessing proprietary metadata.
+        :param base_url: The data service URL, without a trailing '/'.
+        :param max_connections: The maximum number of requests in flight,
+            which is also the maximum number of connections.
+        :param policy: RetryPolicy for each request. By default, one
+            attempt, with no deadline.
+        :param metrics: Metrics to record the requests in.
+        """
+        self.cert = cert
+        self.base_url = base_url
+        self.max_connections = max_connections
+        self.policy = RetryPolicy() if policy is None else policy
+        self.metrics = Metrics() if metrics is None else metrics
+        self.requests = 0
+        self.connections = 0
+        self._session = None
+        self._in_flight = None
+
+    async def get_headers(self, uri):
+        """
+        :param uri: An ad:ARCHIVE/file_id URI.
+        :return: list of astropy headers, as from get_cadc_headers.
+        """
+        status, response_headers, body = await self._fetch(
+            'GET', '{}?fhead=true'.format(self._get_url(uri)))
+        return make_headers(body.decode('ascii'))
+
+    async def get_file_info(self, uri):
+        """
+        :param uri: An ad:ARCHIVE/file_id URI.
+        :return: dict of the size, md5sum and type of the file, as from
+            CadcDataClient.get_file_info.
+        """
+        status, response_headers, body = await self._fetch(
+            'HEAD', self._get_url(uri))
+        return {'size': response_headers.get('content-length'),
+                'md5sum': response_headers.get('content-md5'),
+                'type': response_headers.get('content-type')}
+
+    async def get_fingerprint(self, uri):
+        """
+        :param uri: An ad:ARCHIVE/file_id URI.
+        :return: size and checksum of the file, in the same form as
+            cgps2caom2._get_fingerprint.
+        """
+        file_info = await self.get_file_info(uri)
+        return '{}:{}'.format(file_info.get('size'), file_info.get('md5sum'))
+
+    async def get_all(self, uris, cache=None):
+        """
+        :param uris: The URIs to get headers for.
+        :param cache: DiskHeaderCache to consult before retrieving headers,
+            and to fill afterwards, if any.
+        :return: dict of lists of astropy headers, keyed by URI.
+        """
+        import asyncio
+        results = await asyncio.gather(
+            *[self._get_cached_headers(uri, cache) for uri in uris])
+        return dict(zip(uris, results))
+
+    async def close(self):
+        """
+        Close the connections, and wait until they are closed.
+        """
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _get_cached_headers(self, uri, cache):
+        if cache is None:
+            return await self.get_headers(uri)
+        fingerprint = await self.get_fingerprint(uri)
+        headers = cache.get(uri, fingerprint)
+        if headers is None:
+            headers = await self.get_headers(uri)
+            cache.put(uri, fingerprint, headers)
+        return headers
+
+    def _get_url(self, uri):
+        archive, file_id = uri.split(':', 1)[1].split('/', 1)
+        return '{}/{}/{}'.format(self.base_url, archive, file_id)
+
+    def _get_session(self):
+        if self._session is None:
+            import aiohttp
+            ssl_context = None
+            if self.base_url.startswith('https'):
+                import ssl
+                ssl_context = ssl.create_default_context()
+                if self.cert:
+                    ssl_context.load_cert_chain(self.cert)
+            trace_config = aiohttp.TraceConfig()
+            trace_config.on_connection_create_end.append(
+                self._on_connection_create_end)
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections, ssl=ssl_context)
+            self._session = aiohttp.ClientSession(
+                connector=connector, trace_configs=[trace_config],
+                headers={'User-Agent': 'cgps2caom2',
+                         'Accept-Encoding': 'identity'})
+        return self._session
+
+    async def _on_connection_create_end(self, session, context, params):
+        self.connections += 1
+        logging.debug('Connection {}.'.format(self.connections))
+
+    async def _fetch(self, method, url):
+        """
+        One request, with as many attempts as the policy allows.
+        """
+        import asyncio
+        start = time.perf_counter()
+        attempt = 0
+        while True:
+            try:
+                result = await self._hedge(method, url)
+            except Exception as e:
+                if (attempt >= self.policy.retries or
+                        not self.policy.is_retryable(e)):
+                    self.metrics.count('header_failures')
+                    raise
+                delay = self.policy.get_delay(attempt)
+                attempt += 1
+                self.metrics.count('header_retries')
+                logging.debug('Retry {} of {} for {} {} in {:.2f}s: {}'.format(
+                    attempt, self.policy.retries, method, url, delay, e))
+                await asyncio.sleep(delay)
+            else:
+                self.metrics.observe('header_seconds',
+                                     time.perf_counter() - start)
+                return result
+
+    async def _hedge(self, method, url):
+        """
+        One attempt, which is two requests, if the first is slower than the
+        policy's hedge_after. The first response wins, and the other
+        request is cancelled. The attempt fails only if both requests fail.
+        """
+        import asyncio
+        if self.policy.hedge_after is None:
+            return await self._request(method, url)
+        tasks = [asyncio.ensure_future(self._request(method, url))]
+        try:
+            done, ignore = await asyncio.wait(
+                tasks, timeout=self.policy.hedge_after)
+            if not done:
+                self.metrics.count('header_hedges')
+                logging.debug('Hedge {} {}'.format(method, url))
+                tasks.append(asyncio.ensure_future(
+                    self._request(method, url)))
+            error = None
+            while tasks:
+                done, ignore = await asyncio.wait(
+                    tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    tasks.remove(task)
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _request(self, method, url):
+        """
+        One request, following redirects, within the policy's deadline.
+        Time spent waiting for a connection does not count towards the
+        deadline.
+        """
+        import asyncio
+        if self._in_flight is None:
+            self._in_flight = asyncio.Semaphore(self.max_connections)
+        async with self._in_flight:
+            if self.policy.timeout is None:
+                return await self._send(method, url)
+            try:
+                return await asyncio.wait_for(self._send(method, url),
+                                              self.policy.timeout)
+            except asyncio.TimeoutError:
+                self.metrics.count('header_timeouts')
+                raise HeaderTimeoutError(
+                    'No response in {}s to {} {}'.format(
+                        self.policy.timeout, method, url))
+
+    async def _send(self, method, url):
+        import aiohttp
+        try:
+            async with self._get_session().request(
+                    method, url, max_redirects=MAX_REDIRECTS) as response:
+                body = await response.read()
+        except aiohttp.TooManyRedirects:
+            raise HeaderRequestError('Too many redirects for {}'.format(url))
+        except (aiohttp.ClientConnectionError,
+                aiohttp.ClientPayloadError) as e:
+            raise HeaderConnectionError('{} {}: {!r}'.format(method, url, e))
+        self.requests += 1
+        if response.status != 200:
+            raise HeaderRequestError(
+                '{} {} for {}'.format(response.status, method, url),
+                response.status)
+        return response.status, response.headers, body
+
+
+def retrieve_headers(uris, cert=None, base_url=DATA_URL, max_connections=8,
+                     cache=None, policy=None, metrics=None):
+    """
+    Retrieve the headers for many URIs at once, from code that is not
+    already running an event loop.
+
+    :return: dict of lists of astropy headers, keyed by URI.
+    """
+    import asyncio
+
+    async def _retrieve():
+        client = AsyncHeaderClient(cert, base_url, max_connections, policy,
+                                   metrics)
+        try:
+            return await client.get_all(uris, cache)
+        finally:
+            await client.close()
+
+    return asyncio.run(_retrieve())
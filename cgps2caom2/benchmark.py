@@ -0,0 +1,448 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2018.                            (c) 2018.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#  $Revision: 4 $
+#
+# ***********************************************************************
+#
+"""
+Performance numbers for each stage of creating CGPS observations, on the
+template observations in the data directory of the package, and on
+synthetic batches of observations made from them. The
+stages are those of the in-memory path that cgps2caom2 takes, rather than
+of the proc fallback.
+
+Run with cgps_benchmark. Results are written as JSON, and two sets of
+results can be compared to find regressions:
+
+    cgps_benchmark -o before.json
+    cgps_benchmark -o after.json --compare before.json
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+from cgps2caom2 import cgps2caom2 as cc
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import re
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+
+__all__ = ['run_benchmarks', 'compare_results', 'make_synthetic_files',
+           'read_results', 'write_results', 'classify_by_loop',
+           'STAGES']
+
+STAGES = ['classify', 'classify_loop', 'headers', 'draw', 'augment',
+          'catalog', 'write']
+SIZES = [10, 100, 1000, 10000]
+# the headers of one observation per telescope, as for the tests, but
+# installed with the package
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                            'data')
+FIXTURES = ['MC2_DRAO-ST', 'MC2_FCRAO', 'MD1_IRAS']
+
+# the target part of a CGPS file name
+TARGET_PATTERN = re.compile(r'^(cgps_)([^_]+)(_)', re.IGNORECASE)
+# the keywords with the target in their values
+TARGET_KEYWORDS = ['ADC_AREA', 'OBJECT']
+
+
+def make_synthetic_files(count, output_dir, fixtures_dir=FIXTURES_DIR):
+    """
+    Make a batch of files by copying the fixture files under new target
+    names, one target after the other, until there are count files. The
+    target in the headers is changed to match the file name, as it would
+    be in the headers of a real file.
+
+    The image files of each observation are copied before its fwhm files,
+    so that a batch that ends part-way through an observation does not
+    have fwhm files without the image files they are derived from.
+
+    :param count: How many files to make.
+    :param output_dir: Where to make them.
+    :param fixtures_dir: Where to find the fixture directories.
+    :return: list of the files made.
+    """
+    templates = []
+    for fixture in FIXTURES:
+        location = os.path.join(fixtures_dir, fixture)
+        names = sorted(name for name in os.listdir(location)
+                       if name.endswith('.header'))
+        names.sort(key=lambda name: '_fwhm' in name)
+        templates.append([os.path.join(location, name) for name in names])
+
+    result = []
+    target = 0
+    while len(result) < count:
+        for template in templates:
+            for fqn in template:
+                if len(result) == count:
+                    return result
+                name = TARGET_PATTERN.sub(
+                    r'\g<1>S{:05d}\g<3>'.format(target),
+                    os.path.basename(fqn))
+                output = os.path.join(output_dir, name)
+                _copy_retargeted(fqn, output, 'S{:05d}'.format(target))
+                result.append(output)
+        target += 1
+    return result
+
+
+def _copy_retargeted(fqn, output, target):
+    """
+    Copy a header dump, with the target in the TARGET_KEYWORDS cards
+    changed. All the other cards are copied as they are.
+    """
+    from astropy.io import fits
+    original = TARGET_PATTERN.match(os.path.basename(fqn)).group(2)
+    with open(fqn) as f, open(output, 'w') as o:
+        for line in f:
+            if line[:8].rstrip() in TARGET_KEYWORDS:
+                card = fits.Card.fromstring(line.rstrip('\r\n'))
+                card.value = card.value.replace(original, target)
+                line = '{}\n'.format(card.image)
+            o.write(line)
+
+
+def run_benchmarks(sizes=None, stages=None, repeat=3, work_dir=None,
+                   fixtures_dir=FIXTURES_DIR):
+    """
+    Time each stage on each fixture observation, then on synthetic batches
+    of each size.
+
+    :param sizes: The numbers of files in the synthetic batches.
+    :param stages: Which of STAGES to time.
+    :param repeat: How many times to time each stage. The best and median
+        times are kept.
+    :param work_dir: Where to put the synthetic files and the observations
+        written by the write stage. A temporary directory if not given.
+    :param fixtures_dir: Where to find the fixture directories.
+    :return: list of dicts, one per data set and stage.
+    """
+    sizes = SIZES if sizes is None else sizes
+    stages = STAGES if stages is None else stages
+    cleanup = work_dir is None
+    if cleanup:
+        work_dir = tempfile.mkdtemp(prefix='cgps_benchmark_')
+    try:
+        results = []
+        for fixture in FIXTURES:
+            location = os.path.join(fixtures_dir, fixture)
+            file_names = [os.path.join(location, name)
+                          for name in sorted(os.listdir(location))
+                          if name.endswith('.header')]
+            results += _run_data_set('fixture', fixture, file_names,
+                                     stages, repeat, work_dir)
+        for size in sizes:
+            data_dir = os.path.join(work_dir, 'synthetic_{}'.format(size))
+            os.makedirs(data_dir, exist_ok=True)
+            file_names = make_synthetic_files(size, data_dir, fixtures_dir)
+            results += _run_data_set('synthetic', 'synthetic_{}'.format(size),
+                                     file_names, stages, repeat, work_dir)
+        return results
+    finally:
+        if cleanup:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def _run_data_set(suite, name, file_names, stages, repeat, work_dir):
+    """
+    Time the stages on one set of files, as they would be grouped into
+    observations by a batch run.
+
+    :return: list of dicts, one per stage.
+    """
+    groups, unmatched = cc.group_by_observation(file_names)
+    assert not unmatched, 'Cannot classify {}'.format(unmatched)
+    output_dir = os.path.join(work_dir, name)
+    os.makedirs(output_dir, exist_ok=True)
+
+    observations = []
+    for (collection, obs_id), names in groups.items():
+        args = cc._get_cgps_arg_parser().parse_args(
+            ['--not_connected', '--local'] + names +
+            ['--observation', collection, obs_id,
+             '-o', os.path.join(output_dir, '{}.xml'.format(obs_id))] +
+            [cc._make_uri(collection, f) for f in names])
+        observations.append(_Observation(args))
+
+    base_names = [os.path.basename(f) for f in file_names]
+    timers = {'classify': lambda: _classify(base_names),
+              'classify_loop': lambda: _classify_loop(base_names),
+              'headers': lambda: [o.load_headers() for o in observations],
+              'draw': lambda: [o.draw() for o in observations],
+              'augment': lambda: [o.augment() for o in observations],
+              'catalog': lambda: [o.update_catalog() for o in observations],
+              'write': lambda: [o.write() for o in observations]}
+
+    results = []
+    for stage in STAGES:
+        if stage not in stages:
+            continue
+        times = []
+        for ignore in range(repeat):
+            start = time.perf_counter()
+            timers[stage]()
+            times.append(time.perf_counter() - start)
+        result = {'suite': suite,
+                  'name': name,
+                  'stage': stage,
+                  'files': len(file_names),
+                  'observations': len(observations),
+                  'repeat': repeat,
+                  'best': min(times),
+                  'median': statistics.median(times)}
+        logging.info('{name} {stage}: {best:.6f}s'.format(**result))
+        results.append(result)
+    return results
+
+
+def _classify(base_names):
+    for base_name in base_names:
+        cc.classify_file_id(base_name)
+
+
+def _classify_loop(base_names):
+    # the baseline for the classify stage
+    for base_name in base_names:
+        classify_by_loop(base_name)
+
+
+def classify_by_loop(file_id):
+    """
+    Classify a file_id the way it was classified before classify_file_id,
+    by trying the NAME_REGEX values in turn.
+
+    :param file_id: The file name, or the file_id, in any case.
+    :return: a FileClassification, as from classify_file_id.
+    """
+    for telescope in cc.NAME_REGEX:
+        m = re.match(cc.NAME_REGEX[telescope], file_id.lower())
+        if m:
+            md = m.groupdict()
+            band = md.get('band')
+            lookup = cc.BAND[md['content'] if band is None else band]
+            return cc.FileClassification(
+                telescope, cc._get_collection(telescope), md['target'],
+                band, md['content'], lookup['productID'],
+                lookup['bandpassName'])
+    return cc.UNCLASSIFIED
+
+
+class _Observation(object):
+    """
+    The state of one observation between stages, so that each stage can be
+    timed on its own, after the stages it depends on.
+
+    The observations are made with --not_connected, so the artifact
+    metadata is that of the files on disk, and no stage waits for the
+    archive.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.local = cc._make_local_index(args.local)
+        self.store = None
+        self.headers = None
+        self.context = None
+        self.blueprints = None
+        self.observation = None
+
+    def load_headers(self):
+        self.store = cc.HeaderStore(projection=cc._get_header_keywords)
+        self.headers = {}
+        for uri in self.args.fileURI:
+            self.headers[uri] = cc._get_headers(uri, self.local, None,
+                                                self.store)
+
+    def draw(self):
+        if self.headers is None:
+            self.load_headers()
+        self.context = cc.ObservationContext(self.store)
+        cc._resolve_release_dates(self.args.fileURI, self.headers,
+                                  self.local, None, self.context)
+        self.blueprints = {}
+        for uri in self.args.fileURI:
+            self.blueprints[uri] = cc.draw_cgps_blueprint(
+                uri, self.headers[uri], self.local, None, self.context)
+        if self.context.catalog_uri is not None:
+            self.blueprints[self.context.catalog_uri] = \
+                self.context.catalog_blueprint
+
+    def augment(self):
+        if self.blueprints is None:
+            self.draw()
+        self.observation = cc._augment_observation(self.args,
+                                                   self.blueprints)
+        if self.observation is None:
+            raise RuntimeError(
+                'Cannot build {} in memory with this caom2utils.'.format(
+                    self.args.observation[1]))
+
+    def update_catalog(self):
+        if self.observation is None:
+            self.augment()
+        cc._update_catalog_plane(self.observation, self.context)
+
+    def write(self):
+        if self.observation is None:
+            self.augment()
+        cc._write_obs(self.observation, self.args.out_obs_xml)
+
+
+def write_results(results, fname):
+    """
+    Write benchmark results, and where they came from, as JSON.
+    """
+    content = {'created': datetime.datetime.utcnow().isoformat(),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'results': results}
+    with open(fname, 'w') as f:
+        json.dump(content, f, indent=2, sort_keys=True)
+
+
+def read_results(fname):
+    """
+    :return: The results, as written by write_results.
+    """
+    with open(fname) as f:
+        return json.load(f)['results']
+
+
+def compare_results(baseline, current, threshold=0.2):
+    """
+    :param baseline: Results from an earlier run.
+    :param current: Results from this run.
+    :param threshold: The fraction by which the best time for a stage may
+        grow before it is a regression.
+    :return: list of (name, stage, baseline best, current best, ratio,
+        True if a regression) for each data set and stage in both runs.
+    """
+    before = {(r['name'], r['stage']): r['best'] for r in baseline}
+    result = []
+    for r in current:
+        key = (r['name'], r['stage'])
+        if key not in before:
+            continue
+        ratio = r['best'] / before[key] if before[key] > 0 else float('inf')
+        result.append((r['name'], r['stage'], before[key], r['best'], ratio,
+                       ratio > 1.0 + threshold))
+    return result
+
+
+def _get_benchmark_arg_parser():
+    parser = argparse.ArgumentParser(
+        description='Time the stages of creating CGPS observations.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES,
+                        help='numbers of files in the synthetic batches')
+    parser.add_argument('--stages', nargs='+', choices=STAGES,
+                        default=STAGES, help='the stages to time')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='how many times to time each stage')
+    parser.add_argument('--work_dir',
+                        help=('where to put the synthetic files and the '
+                              'observations, instead of a temporary '
+                              'directory'))
+    parser.add_argument('-o', '--out', dest='out_json',
+                        help='write the results to this JSON file')
+    parser.add_argument('--compare',
+                        help='results from an earlier run, as JSON')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help=('fractional slowdown that counts as a '
+                              'regression when comparing'))
+    return parser
+
+
+def main():
+    args = _get_benchmark_arg_parser().parse_args()
+    results = run_benchmarks(args.sizes, args.stages, args.repeat,
+                             args.work_dir)
+    if args.out_json:
+        write_results(results, args.out_json)
+    for r in results:
+        print('{:<20} {:<9} {:>6} files {:>12.6f}s'.format(
+            r['name'], r['stage'], r['files'], r['best']))
+
+    if args.compare:
+        comparison = compare_results(read_results(args.compare), results,
+                                     args.threshold)
+        regressions = 0
+        for name, stage, before, after, ratio, regression in comparison:
+            print('{:<20} {:<9} {:>12.6f}s {:>12.6f}s {:>7.2f}x{}'.format(
+                name, stage, before, after, ratio,
+                ' REGRESSION' if regression else ''))
+            regressions += regression
+        if regressions:
+            sys.exit(-1)
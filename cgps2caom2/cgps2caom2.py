@@ -6,20 +6,36 @@ from __future__ import (absolute_import, division, print_function,
 
 
 __all__ = ['main_app', 'draw_cgps_blueprint', 'read_obs',
-           'APPLICATION', 'COLLECTION']
-
-from caom2 import CalibrationLevel, ReleaseType, DataProductType
-from caom2 import ObservationReader, Provenance, PlaneURI, ObservationWriter
-from caom2utils import ObsBlueprint, get_arg_parser, get_cadc_headers, proc
-from caom2pipe import manage_composable as mc
-
-from astropy.time import Time
-
+           'classify_file_id', 'group_by_observation', 'run_observation',
+           'triage', 'FileClassification', 'ObservationContext',
+           'TriageReport', 'APPLICATION', 'COLLECTION']
+
+# caom2, caom2utils, caom2pipe, cadcdata, cadcutils, astropy and asyncio are
+# imported where they are needed, rather than here, because this module is
+# imported by every start of cgps_run_single and cgps2caom2, and most starts
+# need only some of them. See tests/test_startup.py.
+from cgps2caom2.async_headers import DATA_URL
+from cgps2caom2.header_cache import DiskHeaderCache, HeaderStore
+from cgps2caom2.local_headers import BLOCK_SIZE, CARD_SIZE
+from cgps2caom2.local_headers import is_fits_file, read_fits_headers
+from cgps2caom2.local_headers import is_header_dump, read_header_dump
+from cgps2caom2.metrics import Metrics, write_metrics
+from cgps2caom2.retries import RetryPolicy
+
+from concurrent.futures import ThreadPoolExecutor
+
+import collections
+import contextlib
+import copy
+import functools
 import logging
 import math
 import os
 import re
+import shutil
 import sys
+import tempfile
+import time
 import traceback
 
 
@@ -27,19 +43,64 @@ APPLICATION = 'cgps2caom2'
 COLLECTION = 'cgps'
 COLLECTION_PATTERN = '*'
 
+# Increase when a change to the blueprint rules means that observations
+# should be created again, even though their files have not changed. See
+# IngestLedger.
+BLUEPRINT_RULES_VERSION = '1'
+
 
-class CgpsName(mc.StorageName):
-    def __init__(self, obs_id=None, file_name=None):
-        super(CgpsName, self).__init__(obs_id, COLLECTION, COLLECTION_PATTERN)
-        self.file_name = file_name
+@functools.lru_cache(maxsize=None)
+def _get_cgps_name_class():
+    from caom2pipe import manage_composable as mc
 
-    def is_valid(self):
-        return True
+    class CgpsName(mc.StorageName):
+        def __init__(self, obs_id=None, file_name=None):
+            super(CgpsName, self).__init__(obs_id, COLLECTION,
+                                           COLLECTION_PATTERN)
+            self.file_name = file_name
 
+        def is_valid(self):
+            return True
+
+    return CgpsName
+
+
+def __getattr__(name):
+    # CgpsName extends a caom2pipe class, so it is defined on first use
+    if name == 'CgpsName':
+        return _get_cgps_name_class()
+    raise AttributeError(
+        'module {!r} has no attribute {!r}'.format(__name__, name))
+
+
+class ObservationContext(object):
+    """
+    The state that accumulates while the blueprints for all the files that
+    make up one observation are drawn. Use one instance per observation, so
+    that observations can be processed one after another, or at the same
+    time, without sharing state.
+    """
+
+    def __init__(self, store=None, metrics=None, output=None):
+        """
+        :param store: HeaderStore of the headers already retrieved, if any.
+        :param metrics: Metrics for the observation.
+        :param output: A binary file-like object to write the observation
+            XML to, rather than the -o file, if any.
+        """
+        from caom2utils import ObsBlueprint
+        # the separate blueprint for the catalog plane, built up from the
+        # fwhm files, and the image files they are derived from
+        self.catalog_blueprint = ObsBlueprint()
+        self.catalog_uri = None
+        self.max_release_date = None
+        # True when max_release_date is the maximum for all the files in the
+        # observation, rather than for the files seen so far
+        self.max_release_date_final = False
+        self.store = store
+        self.metrics = Metrics() if metrics is None else metrics
+        self.output = output
 
-catalog_blueprint = ObsBlueprint()
-catalog_uri = None
-max_release_date = None
 
 # Regular expressions for file_ids.  Note that these are all in lower
 # case as are CGPS file_ids, not mixed case as are CGPS file names.  The
@@ -167,6 +228,39 @@ POLARIZATION = {
     'Chunk.polarization.axis.function.refCoord.val': '1',  # CRVAL4
     'Chunk.polarization.axis.function.delta': '1'}  # CDELT4
 
+# Everything that can be known about a file from its file_id.
+FileClassification = collections.namedtuple(
+    'FileClassification', ['telescope', 'collection', 'target', 'band',
+                           'content', 'product_id', 'bandpass_name'])
+
+UNCLASSIFIED = FileClassification(None, 'CGPS', None, None, None, None, None)
+
+
+# The NAME_REGEX values, compiled once.
+NAME_PATTERNS = collections.OrderedDict(
+    (telescope, re.compile(regex))
+    for telescope, regex in NAME_REGEX.items())
+
+
+def _get_name_pattern(file_id):
+    """
+    Find the NAME_REGEX value for a file_id that is not a DRAO-ST file_id,
+    from its prefix and band, rather than trying the values in turn. At
+    most one of the CGPS values can match a file_id, because the band,
+    which follows the target, is different for each telescope.
+
+    :param file_id: The file_id, in lower case.
+    :return: The telescope, and the compiled NAME_REGEX value for it.
+    """
+    if file_id.startswith('cgps_'):
+        # the band follows the target, which has no underscores
+        i = file_id.find('_', 5) + 1
+        if file_id.startswith('co_line_', i):
+            return 'FCRAO', NAME_PATTERNS['FCRAO']
+        if file_id.startswith('_um_', i + 3):
+            return 'IRAS', NAME_PATTERNS['IRAS']
+    return 'VLA', NAME_PATTERNS['VLA']
+
 
 def _geolocation(longitude, latitude, elevation_meters):
     """
@@ -204,63 +298,306 @@ def _geolocation(longitude, latitude, elevation_meters):
             (cos2oe * n + h) * math.sin(phi))
 
 
-# Geocentric locations of observatories
-LOCATIONS = {'IRAS': ('', '', ''),
-             'DRAO-ST': _geolocation(-119.620000,
-                                     48.320000,
-                                     545.0),
-             'FCRAO': _geolocation(-72.345000,
-                                   42.391667,
-                                   314.0),
-             'VLA': _geolocation(-107.618333,
-                                 34.078333,
-                                 2124.0)}
+# Geodetic (longitude, latitude, elevation) of observatories
+OBSERVATORIES = {'DRAO-ST': (-119.620000, 48.320000, 545.0),
+                 'FCRAO': (-72.345000, 42.391667, 314.0),
+                 'VLA': (-107.618333, 34.078333, 2124.0)}
 
 
-def _set_max_observation_release_date(bp, candidate):
-    global max_release_date
-    if max_release_date is None:
-        max_release_date = candidate
+@functools.lru_cache(maxsize=None)
+def _get_location(telescope):
+    """
+    :return: The geocentric location of an observatory, computed the first
+        time it is needed.
+    """
+    if telescope in OBSERVATORIES:
+        return _geolocation(*OBSERVATORIES[telescope])
+    return '', '', ''
+
+
+def _set_max_observation_release_date(bp, candidate, context):
+    # if _resolve_release_dates has been called, the maximum is already
+    # known, otherwise it is the maximum so far
+    if not context.max_release_date_final:
+        if context.max_release_date is None:
+            context.max_release_date = candidate
+        elif candidate is not None:
+            from astropy.time import Time
+            max_time = Time(context.max_release_date)
+            candidate_time = Time(candidate)
+            if candidate_time > max_time:
+                context.max_release_date = candidate
+    bp.set('Observation.metaRelease', context.max_release_date)
+    context.catalog_blueprint.set('Observation.metaRelease',
+                                  context.max_release_date)
+
+
+def classify_file_id(file_id):
+    """
+    Extract the telescope name, collection, target, band, contents,
+    productID and bandpassName of a file from the file_id using the regex's
+    for each telescope.
+
+    :param file_id: The file name, or the file_id, in any case.
+    :return: a FileClassification. All the values except collection are None
+        if the file_id does not match any of the NAME_REGEX values.
+    """
+    file_id = file_id.lower()
+    # most of the files are DRAO-ST files, so try that value first
+    telescope = 'DRAO-ST'
+    m = NAME_PATTERNS[telescope].match(file_id)
+    if m is None:
+        telescope, pattern = _get_name_pattern(file_id)
+        m = pattern.match(file_id)
+        if m is None and telescope != 'VLA':
+            # as when the NAME_REGEX values are tried in turn, the VLA value
+            # is tried last, e.g. for a seven character target that starts
+            # with cgps_
+            telescope = 'VLA'
+            m = NAME_PATTERNS[telescope].match(file_id)
+        if m is None:
+            return UNCLASSIFIED
+        if telescope == 'VLA':
+            target, content = m.groups()
+            lookup = BAND[content]
+            return FileClassification(telescope, 'VGPS', target, None,
+                                      content, lookup['productID'],
+                                      lookup['bandpassName'])
+
+    target, band, content = m.groups()
+    lookup = BAND[band]
+    return FileClassification(telescope, 'CGPS', target, band, content,
+                              lookup['productID'], lookup['bandpassName'])
+
+
+def _get_collection(telescope):
+    if telescope and telescope == 'VLA':
+        return 'VGPS'
     else:
-        max_time = Time(max_release_date)
-        candidate_time = Time(candidate)
-        if candidate_time > max_time:
-            max_release_date = candidate
-    bp.set('Observation.metaRelease', max_release_date)
-    global catalog_blueprint
-    if catalog_blueprint is not None:
-        catalog_blueprint.set('Observation.metaRelease', max_release_date)
+        return 'CGPS'  # TODO how to set collection
 
 
-def _cgps_make_file_id(basename):
+def _make_uri(collection, file_name):
     """
-    CGPS-specific routine to convert a file basename (without the
-    directory path) to the corresponding file_id used in AD.
+    :param collection: CGPS or VGPS.
+    :param file_name: A file name, with or without a directory path. The
+        .header suffix of a text dump of the headers is not part of the
+        URI.
+    :return: The archive URI for the file.
+    """
+    return 'ad:{}/{}'.format(collection, _get_local_file_id(file_name))
+
 
-    Arguments:
-    basename : a file name without the directory path
-    This is a static method taking exactly one argument.
+def _get_local_file_id(file_name):
+    """
+    :param file_name: A file name, with or without a directory path.
+    :return: The file_id of the fileURI the file is for.
     """
-    lower_basename = basename.lower()
-    base, ext = os.path.splitext(lower_basename)
-    if re.match(r'.*?fwhm', base):
-        file_id = lower_basename
+    return _strip_header_suffix(os.path.basename(file_name))
+
+
+def _strip_header_suffix(basename):
+    if basename.endswith('.header'):
+        basename = basename[:-len('.header')]
+    return basename
+
+
+def _make_local_index(local):
+    """
+    Find the local file for each fileURI once, rather than relying on the
+    order of the --local files, or searching them.
+
+    :param local: The --local files, or directories of them, in any order.
+        An index, as returned by this function, is returned unchanged.
+    :return: dict of the local files, keyed by the file_id of the fileURI
+        each is for.
+    """
+    if isinstance(local, dict):
+        return local
+    result = {}
+    for path in local:
+        if os.path.isdir(path):
+            for entry in os.scandir(path):
+                if entry.is_file():
+                    result[_get_local_file_id(entry.name)] = entry.path
+        else:
+            result[_get_local_file_id(path)] = path
+    return result
+
+
+def _get_local_file(uri, local):
+    """
+    :param uri: A fileURI.
+    :param local: The local file index, as from _make_local_index.
+    :return: The local file for the fileURI.
+    """
+    file_id = uri.split('/', 1)[1]
+    if file_id not in local:
+        raise RuntimeError('No --local file for {}'.format(uri))
+    return local[file_id]
+
+
+def group_by_observation(file_names):
+    """
+    Organize files into the observations they make up. An observation is all
+    the files with the same target and telescope in their names.
+
+    :param file_names: File names, with or without a directory path.
+    :return: a tuple of (dict of lists of file names, keyed by
+        (collection, observationID), in the order the observations were first
+        seen; list of the file names that do not match any NAME_REGEX value)
+    """
+    groups = collections.OrderedDict()
+    unmatched = []
+    for file_name in file_names:
+        classification = classify_file_id(os.path.basename(file_name))
+        if classification.telescope is None:
+            unmatched.append(file_name)
+            continue
+        groups.setdefault(_get_observation_key(classification),
+                          []).append(file_name)
+    return groups, unmatched
+
+
+def _get_observation_key(classification):
+    """
+    :return: (collection, observationID) of the observation a classified
+        file is part of.
+    """
+    return (classification.collection,
+            '{}_{}'.format(classification.target,
+                           classification.telescope).upper())
+
+
+# groups and unmatched are as from group_by_observation. duplicates is a dict
+# of the file names that are for the same fileURI, whatever the case of the
+# names, keyed by the file_id of the first of them.
+# missing_images is a dict of the fwhm file names without the image file
+# their metadata comes from, keyed by (collection, observationID).
+TriageReport = collections.namedtuple(
+    'TriageReport', 'groups unmatched duplicates missing_images')
+
+
+def triage(file_names):
+    """
+    Check a listing of files before ingesting it, using only the file
+    names, without retrieving any headers. This is one pass over the names,
+    so that listings of millions of files take seconds.
+
+    :param file_names: File names, with or without a directory path.
+    :return: TriageReport
+    """
+    groups = collections.OrderedDict()
+    unmatched = []
+    # the first file name for each file_id, in lower case, as the names are
+    # classified whatever their case
+    first_seen = {}
+    duplicates = collections.OrderedDict()
+    images = set()
+    fwhm = []
+    for file_name in file_names:
+        basename = os.path.basename(file_name)
+        classification = classify_file_id(basename)
+        if classification.telescope is None:
+            unmatched.append(file_name)
+            continue
+        key = _get_observation_key(classification)
+        groups.setdefault(key, []).append(file_name)
+
+        file_id = _strip_header_suffix(basename)
+        lower_file_id = file_id.lower()
+        if lower_file_id in first_seen:
+            first = first_seen[lower_file_id]
+            duplicates.setdefault(_get_local_file_id(first),
+                                  [first]).append(file_name)
+        else:
+            first_seen[lower_file_id] = file_name
+        if classification.content == 'image':
+            images.add(file_id)
+        elif classification.content == 'fwhm':
+            fwhm.append((key, file_id, file_name))
+
+    missing_images = collections.OrderedDict()
+    for key, file_id, file_name in fwhm:
+        # as _get_associated_image_headers finds the image file, which, with
+        # the same target and telescope, is in the same observation
+        if file_id.replace('_fwhm.txt', '_image.fits') not in images:
+            missing_images.setdefault(key, []).append(file_name)
+    return TriageReport(groups, unmatched, duplicates, missing_images)
+
+
+def _get_release_date(headers, collection):
+    if collection == 'CGPS':
+        return headers[0].get('PUB_RELD')
     else:
-        file_id = base
-    return file_id
+        return headers[0].get('DATE-OBS')
 
 
-def _set_common(bp, headers, telescope, target, collection):
+def _find_max_release_date(candidates):
+    """
+    :param candidates: Release dates, as strings in a format astropy.time
+        understands. None values are ignored.
+    :return: The latest of the candidates, as given, or None if there are
+        none.
+    """
+    unique = sorted(set(c for c in candidates if c is not None))
+    if len(unique) < 2:
+        return unique[0] if unique else None
+    from astropy.time import Time
+    try:
+        # one Time for all the candidates
+        return unique[int(Time(unique).argmax())]
+    except ValueError:
+        # the candidates are not all in the same format
+        result = unique[0]
+        for candidate in unique[1:]:
+            if Time(candidate) > Time(result):
+                result = candidate
+        return result
+
+
+def _resolve_release_dates(uris, headers, local, cert, context):
+    """
+    The first of two phases of drawing the blueprints for an observation:
+    find the observation release date from the release dates of all the
+    files, before any blueprint is drawn, so that all the planes get the
+    same, final, value, regardless of the order of the files.
+
+    :param uris: All the URIs that make up the observation.
+    :param headers: dict of headers, keyed by URI.
+    :param local: Passed through to _get_associated_image_headers.
+    :param cert: Passed through to _get_associated_image_headers.
+    :param context: ObservationContext to set the release date for.
+    """
+    candidates = []
+    for uri in uris:
+        classification = classify_file_id(uri.split('/')[1])
+        if classification.content == 'fwhm':
+            file_headers = _get_associated_image_headers(uri, local, cert,
+                                                         context.store)
+        elif classification.telescope and _is_fits(headers[uri]):
+            file_headers = headers[uri]
+        else:
+            continue
+        candidates.append(
+            _get_release_date(file_headers, classification.collection))
+    context.max_release_date = _find_max_release_date(candidates)
+    context.max_release_date_final = True
+
+
+def _set_common(bp, headers, telescope, target, collection, context):
     """
     Set the blueprint elements that are the same between
     a catalog-based plane and other planes.
     """
+    catalog_blueprint = context.catalog_blueprint
     bp.set('Observation.observationID',
            '{}_{}'.format(target, telescope).upper())
     catalog_blueprint.set('Observation.observationID',
                           '{}_{}'.format(target, telescope).upper())
 
-    geo_x, geo_y, geo_z = LOCATIONS[telescope]
+    from caom2 import CalibrationLevel
+    geo_x, geo_y, geo_z = _get_location(telescope)
     bp.set('Observation.telescope.name', telescope)
     bp.set('Observation.telescope.geoLocationX', geo_x)
     bp.set('Observation.telescope.geoLocationY', geo_y)
@@ -271,14 +608,11 @@ def _set_common(bp, headers, telescope, target, collection):
     catalog_blueprint.set('Observation.telescope.geoLocationY', geo_y)
     catalog_blueprint.set('Observation.telescope.geoLocationZ', geo_z)
     catalog_blueprint.set('Observation.target.name', target)
-    if collection == 'CGPS':
-        release = headers[0].get('PUB_RELD')
-    else:
-        release = headers[0].get('DATE-OBS')
+    release = _get_release_date(headers, collection)
 
-    _set_max_observation_release_date(bp, release)
-    bp.set('Plane.metaRelease', max_release_date)
-    bp.set('Plane.dataRelease', max_release_date)
+    _set_max_observation_release_date(bp, release, context)
+    bp.set('Plane.metaRelease', context.max_release_date)
+    bp.set('Plane.dataRelease', context.max_release_date)
 
     bp.set('Plane.calibrationLevel', CalibrationLevel.CALIBRATED)
 
@@ -320,58 +654,42 @@ def _set_fits(bp, lookup):
         bp.set(key, value)
 
 
-def _metadata_from(bp, headers, uri, local, cert):
+def _metadata_from(bp, headers, uri, local, cert, context):
     """
     Archive-specific method to fill the blueprint based on the content and
     structure of a file header.
 
-    :param: bp blueprint
+    :param: bp blueprint, as returned by _new_blueprint for the same uri and
+        headers
     :param: headers Headers from a FITS file.
     :param: uri the ad (? TBC) URI for the header
-    :param: local file names on disk. Passed through to
-        _get_associated_image_headers as required.
+    :param: local the local file index, as from _make_local_index, if the
+        files are on disk. Passed through to _get_associated_image_headers
+        as required.
     :param: cert X509 certificte for retrieving proprietary data and metadata.
         Passed through to _get_associated_image_headers as required.
+    :param: context ObservationContext for the observation the file is
+        part of.
     """
+    from caom2 import DataProductType, ReleaseType
+    catalog_blueprint = context.catalog_blueprint
 
     file_id = uri.split('/')[1]  # TODO get from header
 
-    # Extract the telescope name, target, productID, bandpassName and
-    # contents of a file from the file_id using the regex's for each
-    # telescope
-
-    for telescope in NAME_REGEX:
-        m = re.match(NAME_REGEX[telescope], file_id.lower())
-        if m:
-            md = m.groupdict()
-            target = md['target']
-            content = md['content']
-            if 'band' in md:
-                product_id = BAND[md['band']]['productID']
-                bandpass_name = BAND[md['band']]['bandpassName']
-            else:
-                product_id = BAND[content]['productID']
-                bandpass_name = BAND[content]['bandpassName']
-            break
-    else:
-        telescope = None
-        target = None
-        product_id = None
-        bandpass_name = None
-        content = None
+    classification = classify_file_id(file_id)
+    telescope = classification.telescope
+    target = classification.target
+    product_id = classification.product_id
+    content = classification.content
 
     bp.set('Plane.productID', product_id)
     bp.set('Artifact.releaseType', ReleaseType.DATA)
 
     # Structural metadata
-    if telescope and telescope == 'VLA':
-        collection = 'VGPS'
-    else:
-        collection = 'CGPS'  # TODO how to set collection
+    collection = classification.collection
 
     # Deal with FITS files first
-    if (isinstance(headers, list) and len(headers) > 0 and
-            'INSTRUME' in headers[0]):
+    if _is_fits(headers):
         hdu0 = headers[0]
         if telescope:
 
@@ -381,45 +699,25 @@ def _metadata_from(bp, headers, uri, local, cert):
             if collection == 'CGPS':
                 target = hdu0.get('ADC_AREA')
 
-            _set_common(bp, headers, telescope, target, collection)
+            _set_common(bp, headers, telescope, target, collection, context)
 
-            bp.set('Observation.instrument.name', telescope)
             catalog_blueprint.set('Observation.instrument.name', telescope)
 
             # Artifact-level metadata (plus a few plane-level metadata
-            # that can only be determined from the science artifacts)
-
-            bp.configure_position_axes((1, 2))
-            if content == 'image':
-                bp.configure_energy_axis(3)
-                _set_fits(bp, ENERGY[product_id])
-
-            if collection == 'CGPS':
-                if content == 'image':
-                    bp.configure_polarization_axis(4)
-                    _set_fits(bp, POLARIZATION)
-                    if product_id == '1420MHz-QU':
-                        crval4 = '%d' % (int(math.floor(hdu0.get('CRVAL4'))))
-                        _set_fits(bp, {
-                            'Chunk.polarization.axis.function.refCoord.val':
-                                crval4})
-                elif content == 'phn' and hdu0.get(
-                        'CTYPE4') == 'STOKES':
-                    bp.configure_polarization_axis(4)
-            elif collection == 'VGPS':
-                bp.configure_polarization_axis(4)
-                _set_fits(bp, POLARIZATION)
-
-            bp.clear('Chunk.energy.restfrq')
-            if telescope in ('DRAO-ST', 'FCRAO'):
-                bp.add_fits_attribute('Chunk.energy.restfrq', 'OBSFREQ')
-            elif telescope == 'VLA':
-                bp.add_fits_attribute('Chunk.energy.restfrq', 'FREQ0')
-            bp.set('Chunk.energy.bandpassName', bandpass_name)
+            # that can only be determined from the science artifacts).
+            # What is the same for all the files of a telescope, productID
+            # and content is already in the blueprint - see
+            # _get_blueprint_template.
+
+            if (collection == 'CGPS' and content == 'image' and
+                    product_id == '1420MHz-QU'):
+                crval4 = '%d' % (int(math.floor(hdu0.get('CRVAL4'))))
+                _set_fits(bp, {
+                    'Chunk.polarization.axis.function.refCoord.val':
+                        crval4})
 
             data_product_type = 'image'
             if collection == 'VGPS' or content == 'image':
-                product_type = 'science'
 
                 # WCS is only significant for science artifacts
 
@@ -438,22 +736,12 @@ def _metadata_from(bp, headers, uri, local, cert):
                 else:
                     data_product_type = 'catalog'
 
-            else:
-                product_type = 'auxiliary'
-
             if (telescope == 'DRAO-ST' and product_id == 'HI-line') or \
                     (telescope == 'FCRAO' and product_id == 'CO-line'):
                 data_product_type = 'cube'
 
-            bp.set('Artifact.productType', product_type)
             bp.set('Plane.dataProductType', data_product_type)
 
-            # Per Pat Dowler/Chris Willot Feb 2/17, ignore the third and
-            # fourth axes if they are not correctly identified as WCS, and
-            # repair naxes count accordingly.
-            #
-            bp.set('Chunk.naxis', bp.get_configed_axes_count())
-
     elif content == 'fwhm':
         # build up a separate blueprint for the catalog files, because they are
         # their own plane/artifact collection in a CGPS observation
@@ -462,16 +750,16 @@ def _metadata_from(bp, headers, uri, local, cert):
         # but the required metadata can be extracted from the corresponding
         # image file
 
-        global catalog_uri
-        catalog_uri = uri
+        context.catalog_uri = uri
         bp.set('Plane.dataProductType', DataProductType.CATALOG)
         bp.set('Plane.productID', 'catalog')
         catalog_blueprint.set('Plane.dataProductType', DataProductType.CATALOG)
         catalog_blueprint.set('Plane.productID', 'catalog')
         bp.set('Artifact.productType', 'science')
 
-        headers = _get_associated_image_headers(uri, local, cert)
-        _set_common(bp, headers, telescope, target, collection)
+        headers = _get_associated_image_headers(uri, local, cert,
+                                                context.store)
+        _set_common(bp, headers, telescope, target, collection, context)
 
         plane_uri = 'caom:{}/{}/{}'.format(
             collection, bp._get('Observation.observationID'), product_id)
@@ -483,13 +771,173 @@ def _metadata_from(bp, headers, uri, local, cert):
         catalog_blueprint.set('Plane.provenance.inputs', inputs)
 
 
-def _set_defaults_and_overrides(bp):
+def _is_fits(headers):
+    return (isinstance(headers, list) and len(headers) > 0 and
+            'INSTRUME' in headers[0])
+
+
+def _new_blueprint(classification, headers):
+    """
+    :param classification: FileClassification of the file the blueprint is
+        for.
+    :param headers: Headers from the file.
+    :return: For a FITS file from a known telescope, a copy of the blueprint
+        template for the file's telescope, productID and content. Otherwise,
+        a new ObsBlueprint.
+    """
+    if classification.telescope is None or not _is_fits(headers):
+        from caom2utils import ObsBlueprint
+        return ObsBlueprint()
+    polarization = (classification.content == 'phn' and
+                    headers[0].get('CTYPE4') == 'STOKES')
+    return _clone_blueprint(_get_blueprint_template(
+        classification.telescope, classification.product_id,
+        classification.bandpass_name, classification.content, polarization))
+
+
+@functools.lru_cache(maxsize=None)
+def _get_blueprint_template(telescope, product_id, bandpass_name, content,
+                            polarization):
+    """
+    The blueprint elements that are the same for all the FITS files with the
+    same telescope, productID and content, set once.
+
+    :param polarization: True if the file has a STOKES axis that is not
+        configured by content alone (phn files).
+    :return: An ObsBlueprint that must not be modified. Use _clone_blueprint.
+    """
+    from caom2 import ReleaseType
+    from caom2utils import ObsBlueprint
+    collection = _get_collection(telescope)
+    bp = ObsBlueprint()
+    bp.set('Plane.productID', product_id)
+    bp.set('Artifact.releaseType', ReleaseType.DATA)
+    bp.set('Observation.instrument.name', telescope)
+
+    bp.configure_position_axes((1, 2))
+    if content == 'image':
+        bp.configure_energy_axis(3)
+        _set_fits(bp, ENERGY[product_id])
+
+    if collection == 'CGPS':
+        if content == 'image':
+            bp.configure_polarization_axis(4)
+            _set_fits(bp, POLARIZATION)
+        elif polarization:
+            bp.configure_polarization_axis(4)
+    elif collection == 'VGPS':
+        bp.configure_polarization_axis(4)
+        _set_fits(bp, POLARIZATION)
+
+    bp.clear('Chunk.energy.restfrq')
+    if telescope in ('DRAO-ST', 'FCRAO'):
+        bp.add_fits_attribute('Chunk.energy.restfrq', 'OBSFREQ')
+    elif telescope == 'VLA':
+        bp.add_fits_attribute('Chunk.energy.restfrq', 'FREQ0')
+    bp.set('Chunk.energy.bandpassName', bandpass_name)
+
+    if collection == 'VGPS' or content == 'image':
+        bp.set('Artifact.productType', 'science')
+    else:
+        bp.set('Artifact.productType', 'auxiliary')
+
+    # Per Pat Dowler/Chris Willot Feb 2/17, ignore the third and
+    # fourth axes if they are not correctly identified as WCS, and
+    # repair naxes count accordingly.
+    #
+    bp.set('Chunk.naxis', bp.get_configed_axes_count())
+    return bp
+
+
+# The keywords that the CGPS rules read from the headers directly, or add
+# to a blueprint after it is copied from the template.
+RULE_KEYWORDS = frozenset(['INSTRUME', 'ADC_AREA', 'ADC_ARCH', 'ADC_TYPE',
+                           'PUB_RELD', 'DATE-OBS', 'OBSERVER', 'ORIGIN',
+                           'NAXIS', 'NAXIS3', 'CRVAL4', 'CTYPE4', 'DATE-FTS'])
+
+
+def _get_header_keywords(uri):
+    """
+    The projection of the headers kept for a URI in the HeaderStore. The
+    headers are read by the CGPS rules, and, as header dumps, by caom2utils,
+    which reads the keywords in the blueprints, and the structure and WCS
+    keywords that a projection always keeps.
+
+    :param uri: Which URI the headers are for.
+    :return: frozenset of the keywords that the CGPS rules, and the
+        blueprint template for the file, read, or None to keep all the
+        cards, for a file that is not from a known telescope.
+    """
+    classification = classify_file_id(uri.split('/')[1])
+    if classification.telescope is None:
+        return None
+    return _get_template_keywords(
+        classification.telescope, classification.product_id,
+        classification.bandpass_name, classification.content)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_template_keywords(telescope, product_id, bandpass_name, content):
+    keywords = set(RULE_KEYWORDS)
+    # the template depends on the STOKES axis of phn files
+    for polarization in (False, True):
+        template = _get_blueprint_template(telescope, product_id,
+                                           bandpass_name, content,
+                                           polarization)
+        for value in vars(template).values():
+            if isinstance(value, dict):
+                keywords.update(_get_plan_keywords(value))
+    return frozenset(keywords)
+
+
+def _get_plan_keywords(plan):
+    """
+    :return: generator of the FITS keywords in the (list of FITS keywords,
+        default) tuples of a blueprint plan, as for _copy_plan.
+    """
+    for value in plan.values():
+        if isinstance(value, tuple) and value and isinstance(value[0], list):
+            for keyword in value[0]:
+                yield keyword.upper()
+        elif isinstance(value, dict):
+            for keyword in _get_plan_keywords(value):
+                yield keyword
+
+
+def _clone_blueprint(template):
+    """
+    A copy of a blueprint that shares nothing modifiable with the original,
+    made more cheaply than with copy.deepcopy. The blueprint state is dicts of
+    values that are strings, numbers, (list of FITS keywords, default) tuples,
+    or more such dicts, so only the dicts and the keyword lists are copied.
+    """
+    bp = copy.copy(template)
+    for key, value in vars(template).items():
+        if isinstance(value, dict):
+            setattr(bp, key, _copy_plan(value))
+    return bp
+
+
+def _copy_plan(plan):
+    result = {}
+    for key, value in plan.items():
+        if isinstance(value, tuple) and value and isinstance(value[0], list):
+            value = (list(value[0]),) + value[1:]
+        elif isinstance(value, dict):
+            value = _copy_plan(value)
+        result[key] = value
+    return result
+
+
+def _set_defaults_and_overrides(bp, context):
     """
     From the .config, .default, .defaults, and .override files for the Java
     version of cgps2caom2.
 
     :param bp: ObsBlueprint to modify with default and ovverides.
+    :param context: ObservationContext, for the catalog blueprint.
     """
+    catalog_blueprint = context.catalog_blueprint
     # from the cgps.config file
     bp.add_fits_attribute('Plane.provenance.lastExecuted', 'DATE-FTS')
     # from the cgps.default file
@@ -507,7 +955,7 @@ def _set_defaults_and_overrides(bp):
     # bp.set_default('process.out.version', '1')
 
 
-def _get_associated_image_headers(uri, local, cert):
+def _get_associated_image_headers(uri, local, cert, store=None):
     """
     fwhm files are text files without FITS headers,
     but the required metadata can be extracted from the corresponding
@@ -515,57 +963,210 @@ def _get_associated_image_headers(uri, local, cert):
     from that file.
 
     :param uri: The fwhm URI name.
-    :param local: The list of files that are on local disk, if they exist.
-        Passed through to _get_headers.
+    :param local: The local file index, as from _make_local_index, if the
+        files are on local disk. Passed through to _get_headers.
     :param cert: X509 cert, required if relying on CADC services to
         query proprietary header information. Passed through to _get_headers.
+    :param store: HeaderStore of the headers already retrieved during this
+        run. Passed through to _get_headers.
     :return: headers from the image file
     """
     image_uri = uri.replace('_fwhm.txt', '_image.fits')
-    index = 0
-    if local:
-        fname = image_uri.split('ad:CGPS/')[1]
-        for key, value in enumerate(local):
-            if value.find(fname) != -1:
-                index = key
-                break
-    return _get_headers(image_uri, local, index, cert)
+    return _get_headers(image_uri, local, cert, store)
 
 
-def _get_headers(uri, local, index, cert):
+def _get_headers(uri, local, cert, store=None):
     """
     Get header information. May be from local files on disk, may be from a
     CADC service, depending on the input parameters to the method.
 
     :param uri: Which URI to get headers for.
-    :param local: A list of files, or headers, if this information exists on
-        disk.
-    :param index: The index into the list of files for the appropriate file.
+    :param local: The local file index, as from _make_local_index, if this
+        information exists on disk.
     :param cert: An X509 certificate for accessing proprietary metadata or
         data from a CADC service.
+    :param store: If provided, a HeaderStore. Headers are retrieved only if
+        the store does not already have them for the URI.
     :return: The astropy header structure resulting from a fits file read.
     """
-    if uri.find('_fwhm') == -1:
-        if local:
-            file = local[index]
-            headers = get_cadc_headers('file://{}'.format(file))
-        else:
-            headers = get_cadc_headers(uri, cert)
+    if store is None:
+        return _retrieve_headers(uri, local, cert)
+
+    def _retrieve():
+        headers = _retrieve_headers(uri, local, cert, store.cache,
+                                    store.policy, store.metrics)
+        store.metrics.count('bytes_read', _get_header_bytes(headers))
+        return headers
+
+    with store.metrics.timer('_get_headers'):
+        return store.get(uri, _retrieve)
+
+
+def _get_header_bytes(headers):
+    """
+    :return: The size of the headers, as they are in a FITS file.
+    """
+    result = 0
+    for h in headers:
+        # the cards, and the END card, padded to whole blocks
+        blocks = ((len(h) + 1) * CARD_SIZE + BLOCK_SIZE - 1) // BLOCK_SIZE
+        result += blocks * BLOCK_SIZE
+    return result
+
+
+def _retrieve_headers(uri, local, cert, cache=None, policy=None,
+                      metrics=None):
+    """
+    :param cache: If provided, a DiskHeaderCache. Headers are retrieved only
+        if the cache does not have them for the current content of the file.
+    :param policy: If provided, a RetryPolicy for retrieving headers, and
+        fingerprints, from a CADC service.
+    :param metrics: Metrics for the retries, if there is a policy.
+    Other parameters as for _get_headers.
+    """
+    if uri.find('_fwhm') != -1:
+        return []
+
+    def _call(retrieve):
+        if local or policy is None:
+            return retrieve()
+        return policy.call(retrieve, metrics, uri)
+
+    fingerprint = None
+    if cache is not None:
+        fingerprint = _call(lambda: _get_fingerprint(uri, local, cert))
+        headers = cache.get(uri, fingerprint)
+        if headers is not None:
+            logging.debug('Using cached headers for {}.'.format(uri))
+            return headers
+
+    if local:
+        headers = _read_local_headers(_get_local_file(uri, local))
     else:
-        headers = []
+        from caom2utils import get_cadc_headers
+        headers = _call(lambda: get_cadc_headers(uri, _get_subject(cert)))
+
+    if cache is not None:
+        cache.put(uri, fingerprint, headers)
     return headers
 
 
+# The types of files on disk that headers are read from without
+# caom2utils, as (test for the type, reader), in the order they are tried.
+LOCAL_HEADER_READERS = [(is_fits_file, read_fits_headers),
+                        (is_header_dump, read_header_dump)]
+
+
+def _read_local_headers(fname):
+    """
+    :param fname: A file on disk.
+    :return: The headers from the file. For an uncompressed FITS file, only
+        the headers are read, however large the file.
+    """
+    for is_type, read_headers in LOCAL_HEADER_READERS:
+        if is_type(fname):
+            return read_headers(fname)
+    from caom2utils import get_cadc_headers
+    return get_cadc_headers('file://{}'.format(fname))
+
+
+def _get_fingerprint(uri, local, cert):
+    """
+    Identify the content of a file without retrieving its headers: size and
+    modification time for a file on disk, size and checksum for a file in a
+    CADC service.
+
+    Parameters as for _get_headers.
+    """
+    if local:
+        stat = os.stat(_get_local_file(uri, local))
+        return '{}:{}'.format(stat.st_size, int(stat.st_mtime))
+    from cadcdata import CadcDataClient
+    archive, file_id = uri.split(':', 1)[1].split('/', 1)
+    client = CadcDataClient(_get_subject(cert))
+    file_info = client.get_file_info(archive, file_id)
+    return '{}:{}'.format(file_info.get('size'), file_info.get('md5sum'))
+
+
+def _get_subject(cert):
+    """
+    :param cert: An X509 certificate for accessing proprietary metadata or
+        data from a CADC service, or None.
+    :return: The cadcutils Subject for the certificate, or an anonymous one
+        if there is no certificate.
+    """
+    from cadcutils import net
+    return net.Subject(certificate=cert)
+
+
+def _prefetch_headers(uris, local, cert, workers, store=None):
+    """
+    Get the header information for all the URIs that make up an
+    observation concurrently, instead of one round trip at a time.
+
+    :param uris: The URIs to get headers for.
+    :param local: The local file index, as from _make_local_index, if this
+        information exists on disk. Passed through to _get_headers.
+    :param cert: An X509 certificate for accessing proprietary metadata or
+        data from a CADC service. Passed through to _get_headers.
+    :param workers: How many headers to retrieve at once.
+    :param store: HeaderStore to fill. Passed through to _get_headers.
+    :return: A dict of the _get_headers results, keyed by URI.
+    """
+    logging.debug('Begin header prefetch for {} URIs with {} workers.'.format(
+        len(uris), workers))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for uri in uris:
+            futures[uri] = executor.submit(
+                _get_headers, uri, local, cert, store)
+        result = {}
+        for uri in uris:
+            result[uri] = futures[uri].result()
+    logging.debug('Done header prefetch.')
+    return result
+
+
+def _prefetch_headers_async(uris, cert, connections, data_url, store):
+    """
+    Get the header information for all the URIs that make up an
+    observation from a CADC service at once, over a pool of persistent
+    connections.
+
+    :param uris: The URIs to get headers for.
+    :param cert: An X509 certificate for accessing proprietary metadata or
+        data from a CADC service.
+    :param connections: The maximum number of requests in flight.
+    :param data_url: The data service URL.
+    :param store: HeaderStore to fill.
+    """
+    from cgps2caom2.async_headers import retrieve_headers
+    remote = [uri for uri in uris
+              if uri.find('_fwhm') == -1 and uri not in store]
+    logging.debug('Begin async header prefetch for {} URIs.'.format(
+        len(remote)))
+    result = retrieve_headers(remote, cert, data_url, connections,
+                              store.cache, store.policy, store.metrics)
+    for uri in remote:
+        store.metrics.count('bytes_read', _get_header_bytes(result[uri]))
+        store.get(uri, lambda: result[uri])
+    logging.debug('Done async header prefetch.')
+
+
 def read_obs(fname):
+    from caom2 import ObservationReader
     assert os.path.exists(fname)
     reader = ObservationReader(False)
     result = reader.read(fname)
     return result
 
 
-def _update_catalog_plane(obs):
-    logging.debug('Begin _update_catalog_plane for {}.'.format(catalog_uri))
+def _update_catalog_plane(obs, context):
+    from caom2 import CalibrationLevel, DataProductType, PlaneURI, Provenance
+    logging.debug(
+        'Begin _update_catalog_plane for {}.'.format(context.catalog_uri))
     assert obs is not None, 'Must have an observation to update'
+    catalog_blueprint = context.catalog_blueprint
 
     for ii in obs.planes:
         plane = obs.planes[ii]
@@ -576,8 +1177,12 @@ def _update_catalog_plane(obs):
             plane.calibration_level = CalibrationLevel.CALIBRATED
             plane.provenance = Provenance(
                 catalog_blueprint._get('Plane.provenance.name'))
-            plane.provenance.project = catalog_blueprint._get(
-                'Plane.provenance.project')[1]
+            project = catalog_blueprint._get('Plane.provenance.project')
+            if isinstance(project, tuple):
+                # the default, if caom2utils has not already replaced the
+                # (keywords, default) tuple with the value
+                project = project[1]
+            plane.provenance.project = project
             plane.provenance.producer = catalog_blueprint._get(
                 'Plane.provenance.producer')
             plane.provenance.reference = catalog_blueprint._get(
@@ -586,78 +1191,600 @@ def _update_catalog_plane(obs):
             if inputs:
                 for i in inputs.split():
                     plane.provenance.inputs.add(PlaneURI(str(i)))
-    logging.debug('Done _update_catalog_plane for {}.'.format(catalog_uri))
+    logging.debug(
+        'Done _update_catalog_plane for {}.'.format(context.catalog_uri))
 
 
 def _write_obs(obs, fname):
+    from caom2 import ObservationWriter
     writer = ObservationWriter(True, False, 'caom2',
                                'http://www.opencadc.org/caom2/xml/v2.3')
     writer.write(obs, fname)
 
 
-def set_catalog_plane_information(args):
+def set_catalog_plane_information(args, context):
     """Add custom metadata due to the catalog plane. Read in the generated
     observation metadata from on disk, update the specific plane metadata,
-    and then write it back to the same file on disk."""
-    if catalog_uri is not None:
+    and then write it back to the same file on disk.
+
+    This is the fallback for when the observation cannot be built in memory.
+    See _proc."""
+    if context.catalog_uri is not None:
         if args.out_obs_xml:
             observation = read_obs(args.out_obs_xml)
-            _update_catalog_plane(observation)
-            _write_obs(observation, args.out_obs_xml)
+            _update_catalog_plane(observation, context)
+            with context.metrics.timer('_write_obs'):
+                _write_obs(observation, args.out_obs_xml)
         else:
-            logging.error(
-                'Could not find the xml to augment for {}'.format(catalog_uri))
+            logging.error('Could not find the xml to augment for {}'.format(
+                context.catalog_uri))
+
+
+def _augment_observation(args, blueprints):
+    """
+    Build the observation in memory, the same way caom2utils.proc does,
+    without writing it out.
+
+    :param args: argparse args object, as for proc.
+    :param blueprints: dictionary of blueprints, keyed by fileURI, as for proc.
+    :return: The augmented Observation, or None if the installed caom2utils
+        does not support building an observation in memory.
+    """
+    try:
+        from caom2utils.fits2caom2 import _augment, _gen_obs
+        from cadcutils import net
+    except ImportError:
+        logging.debug('Cannot build the observation in memory.')
+        return None
+
+    if args.local and (len(args.local) != len(args.fileURI)):
+        raise RuntimeError(
+            'number of local arguments not the same with file URIs '
+            '({} vs {})'.format(len(args.local), args.fileURI))
+
+    # _gen_obs and _augment are not public, and their signatures, and the
+    # blueprint elements they look up, have changed between caom2utils
+    # versions, so fall back to proc, which is the same in all of them
+    try:
+        if args.in_obs_xml:
+            obs = _gen_obs(blueprints, args.in_obs_xml)
+        else:
+            obs = _gen_obs(blueprints, None, args.observation[0],
+                           args.observation[1])
+    except (AttributeError, KeyError, TypeError) as e:
+        logging.warning(
+            'Cannot build the observation in memory: {}'.format(e))
+        return None
+
+    if args.in_obs_xml and len(obs.planes) != 1 and not args.productID:
+        raise RuntimeError(
+            'A productID parameter is required if there are zero or more '
+            'than one planes in the input observation.')
+
+    subject = net.Subject.from_cmd_line_args(args)
+    validate_wcs = not getattr(args, 'no_validate', False)
+    connected = not getattr(args, 'not_connected', False)
+    for i, uri in enumerate(args.fileURI):
+        blueprint = blueprints[uri]
+        product_id = blueprint._get('Plane.productID')
+        if product_id is None or isinstance(product_id, tuple):
+            if args.productID:
+                product_id = args.productID
+            else:
+                raise RuntimeError(
+                    'A productID parameter is required if one is not '
+                    'identified in the blueprint.')
+        file_name = None
+        if args.local:
+            file_name = args.local[i]
+        try:
+            obs = _augment(obs, product_id, uri, blueprint, subject,
+                           dumpconfig=args.dumpconfig,
+                           validate_wcs=validate_wcs, plugin=None,
+                           local=file_name, connected=connected)
+        except (AttributeError, KeyError, TypeError) as e:
+            logging.warning(
+                'Cannot build the observation in memory: {}'.format(e))
+            return None
+    return obs
+
+
+def _read_previous_obs(fname):
+    """
+    :param fname: The -o file.
+    :return: The observation already in the -o file, or None if there is
+        none, or it cannot be read.
+    """
+    if not fname or not os.path.exists(fname):
+        return None
+    try:
+        return read_obs(fname)
+    except Exception as e:
+        logging.warning('Cannot read the existing {}: {}'.format(fname, e))
+        return None
+
+
+def _carry_over_ids(previous, observation):
+    """
+    Give the planes, artifacts, parts and chunks of a newly created
+    observation the ids of the same entities in the previous version of the
+    observation. The ids are part of the metadata checksums, so without this
+    the checksums of an unchanged observation would differ, and the ids would
+    change every time the observation is written.
+
+    Planes are matched by productID, artifacts by URI, parts by name, and
+    chunks by their position in the part.
+
+    :param previous: The Observation as it was last written.
+    :param observation: The Observation as it was just created.
+    """
+    observation._id = previous._id
+    for product_id, plane in observation.planes.items():
+        previous_plane = previous.planes.get(product_id)
+        if previous_plane is None:
+            continue
+        plane._id = previous_plane._id
+        for uri, artifact in plane.artifacts.items():
+            previous_artifact = previous_plane.artifacts.get(uri)
+            if previous_artifact is None:
+                continue
+            artifact._id = previous_artifact._id
+            for name, part in artifact.parts.items():
+                previous_part = previous_artifact.parts.get(name)
+                if previous_part is None:
+                    continue
+                part._id = previous_part._id
+                for chunk, previous_chunk in zip(part.chunks,
+                                                 previous_part.chunks):
+                    chunk._id = previous_chunk._id
+
+
+def _is_unchanged(previous, observation):
+    """
+    :param previous: The Observation as it was last written.
+    :param observation: The Observation as it was just created, with the ids
+        from _carry_over_ids.
+    :return: True if the accumulated metadata checksums of the observations
+        are the same.
+    """
+    from caom2.checksum import get_acc_meta_checksum
+    return (get_acc_meta_checksum(observation, True) ==
+            get_acc_meta_checksum(previous, True))
+
+
+def _proc(args, blueprints, context, headers):
+    """
+    Create the observation from the blueprints, and write it out.
+
+    When there is a catalog plane, the catalog plane information is applied
+    to the in-memory observation, so the observation is written only once.
+    If that is not possible, fall back to proc followed by
+    set_catalog_plane_information, which re-reads and re-writes the
+    observation.
+
+    For files that are not on local disk, caom2utils is given the headers
+    that the blueprints were drawn from, as header dumps, so it does not
+    retrieve them again.
+
+    When the context has an output, the observation is written to it. The
+    -o file is then only written if the observation cannot be built in
+    memory, and is removed once it is copied to the output.
+
+    With --skip_unchanged, and an existing -o file, the observation is
+    compared with the one in the file, and the file is left as it is if
+    their metadata checksums are the same.
+
+    :param args: argparse args object, as for proc.
+    :param blueprints: dictionary of blueprints, keyed by fileURI, as for proc.
+    :param context: ObservationContext for the observation.
+    :param headers: dictionary of headers, keyed by fileURI, as from
+        _get_headers.
+    :return: True if the observation was written, False if it is unchanged.
+    """
+    metrics = context.metrics
+    previous = None
+    if args.skip_unchanged and context.output is None:
+        with metrics.timer('_read_previous_obs'):
+            previous = _read_previous_obs(args.out_obs_xml)
+
+    local = args.local
+    dump_dir = None
+    try:
+        if not local:
+            dump_dir = tempfile.mkdtemp(prefix='cgps2caom2_')
+            with metrics.timer('_write_header_dumps'):
+                args.local = _write_header_dumps(args.fileURI, headers,
+                                                 dump_dir)
+        return _augment_and_write(args, blueprints, context, previous)
+    finally:
+        args.local = local
+        if dump_dir is not None:
+            shutil.rmtree(dump_dir, ignore_errors=True)
+
+
+def _augment_and_write(args, blueprints, context, previous):
+    """
+    :param previous: The observation already in the -o file, if it is to be
+        compared with the new one.
+    Other parameters and return value as for _proc.
+    """
+    metrics = context.metrics
+    observation = None
+    if ((context.catalog_uri is not None or context.output is not None or
+            previous is not None) and args.out_obs_xml):
+        with metrics.timer('_augment_observation'):
+            observation = _augment_observation(args, blueprints)
+
+    if observation is None:
+        from caom2utils import proc
+        out_obs_xml = args.out_obs_xml
+        if previous is not None:
+            # keep the existing -o file until it is known to be changed
+            args.out_obs_xml = '{}.new'.format(out_obs_xml)
+        try:
+            with metrics.timer('proc'), _keep_logging():
+                proc(args, blueprints)
+            with metrics.timer('set_catalog_plane_information'):
+                set_catalog_plane_information(args, context)
+        finally:
+            args.out_obs_xml = out_obs_xml
+        if context.output is not None:
+            with open(args.out_obs_xml, 'rb') as f:
+                shutil.copyfileobj(f, context.output)
+            os.unlink(args.out_obs_xml)
+        if previous is None:
+            return True
+        new_obs_xml = '{}.new'.format(out_obs_xml)
+        observation = read_obs(new_obs_xml)
+        os.unlink(new_obs_xml)
+    else:
+        _update_catalog_plane(observation, context)
+
+    if previous is not None:
+        _carry_over_ids(previous, observation)
+        with metrics.timer('_is_unchanged'):
+            unchanged = _is_unchanged(previous, observation)
+        if unchanged:
+            logging.info('{} is unchanged.'.format(args.out_obs_xml))
+            return False
+    with metrics.timer('_write_obs'):
+        _write_obs(observation, args.out_obs_xml if context.output is None
+                   else context.output)
+    return True
+
+
+def _write_header_dumps(uris, headers, dump_dir):
+    """
+    Write headers as the header text dumps that proc reads for --local
+    files, with the file_id of the URI and a .header suffix as the file
+    name. caom2utils gets the artifact metadata for a .header file from the
+    CADC service, as it does for a file that is not on local disk.
+
+    :param uris: The fileURIs to write the headers of.
+    :param headers: dictionary of headers, keyed by fileURI, as from
+        _get_headers. A file without headers, e.g. a fwhm file, gets an
+        empty dump.
+    :param dump_dir: Where to write the dumps.
+    :return: list of the dumps, in the same order as the URIs.
+    """
+    result = []
+    for uri in uris:
+        fqn = os.path.join(dump_dir, '{}.header'.format(uri.split('/')[-1]))
+        with open(fqn, 'w') as f:
+            for h in headers[uri]:
+                f.write(h.tostring(sep='\n', endcard=True, padding=False))
+                f.write('\n')
+        result.append(fqn)
+    return result
 
 
-def draw_cgps_blueprint(uri, headers, local, cert):
+def draw_cgps_blueprint(uri, headers, local, cert, context=None):
     """
     Modify an ObsBlueprint instance.
 
     :param uri: Which URI defines the structure of the blueprint.
     :param headers:  astropy headers structure containing the metadata for
         the subject of blueprint construction.
-    :param local: Files on disk, conditionally.
+    :param local: Files on disk, conditionally. Either the --local files,
+        or, to avoid indexing them for every URI, the index of them from
+        _make_local_index.
     :param cert:  X509 certificate for accessing proprietary metadata from
         CADC services.
+    :param context: ObservationContext for the observation the URI is part
+        of. Use the same context for all the URIs of an observation. If None,
+        the URI is treated as the only file in its observation.
     :return: The blueprint, customized according to the input data.
     """
     logging.debug('Begin blueprint customization for CGPS {}.'.format(uri))
-    blueprint = ObsBlueprint()
-
-    _metadata_from(blueprint, headers, uri, local, cert)
-    _set_defaults_and_overrides(blueprint)
+    if context is None:
+        context = ObservationContext()
+    if local:
+        local = _make_local_index(local)
+    with context.metrics.timer('draw_cgps_blueprint'):
+        blueprint = _new_blueprint(classify_file_id(uri.split('/')[1]),
+                                   headers)
+        _metadata_from(blueprint, headers, uri, local, cert, context)
+        _set_defaults_and_overrides(blueprint, context)
 
     logging.debug(
         'Blueprint customatization complete for CGPS {}.'.format(uri))
     return blueprint
 
 
-def main_app():
+def _get_cgps_arg_parser():
+    """
+    The fits2caom2 arguments, plus the arguments that only make sense for
+    cgps2caom2.
+    """
+    from caom2utils import get_arg_parser
+    parser = get_arg_parser()
+    for action in parser._actions:
+        if action.dest == 'local':
+            action.help = ('list of files in local filesystem, in any '
+                           'order, or directories of them')
+    parser.add_argument('--prefetch_workers', type=int, default=0,
+                        help=('retrieve the headers for all the fileURIs '
+                              'concurrently, using this many workers'))
+    parser.add_argument('--async_connections', type=int, default=0,
+                        help=('retrieve the headers for all the fileURIs '
+                              'with asyncio, using at most this many '
+                              'connections. Ignored with --local.'))
+    parser.add_argument('--data_url', default=DATA_URL,
+                        help='URL of the data service for headers')
+    parser.add_argument('--cache_dir',
+                        help=('directory for keeping retrieved headers '
+                              'between runs'))
+    parser.add_argument('--cache_max_mb', type=int, default=1024,
+                        help='maximum size of the header cache, in MB')
+    parser.add_argument('--cache_invalidate', action='store_true',
+                        help=('discard any cached headers for the fileURIs '
+                              'before retrieving them'))
+    parser.add_argument('--header_retries', type=int, default=0,
+                        help=('retry the retrieval of the headers for a '
+                              'fileURI this many times, after a connection '
+                              'failure, a timeout, or a response that says '
+                              'the service is busy'))
+    parser.add_argument('--header_timeout', type=float,
+                        help=('seconds to wait for each response with '
+                              '--async_connections'))
+    parser.add_argument('--hedge_after', type=float,
+                        help=('with --async_connections, seconds after which '
+                              'to send a second request for the same '
+                              'headers, and use the first response'))
+    parser.add_argument('--metrics_file',
+                        help=('write the time spent in each stage, call '
+                              'counts, bytes read, cache hits, retries and '
+                              'header request percentiles for the '
+                              'observation to this file'))
+    parser.add_argument('--skip_unchanged', action='store_true',
+                        help=('leave an existing -o file as it is, if the '
+                              'metadata checksum of the observation is '
+                              'unchanged'))
+    parser.add_argument('--metrics_format', choices=['jsonl', 'prometheus'],
+                        help=('append JSON lines, or replace a Prometheus '
+                              'textfile. The default is prometheus for a '
+                              '.prom metrics_file, and jsonl otherwise.'))
+    return parser
+
+
+def _parse_cgps_args(argv=None):
+    """
+    :param argv: The command line arguments. sys.argv if None.
+    :return: argparse args object, as from _get_cgps_arg_parser. Exits, as
+        argparse does, for options that do nothing without
+        --async_connections.
+    """
+    parser = _get_cgps_arg_parser()
+    args = parser.parse_args(argv)
+    if args.async_connections <= 0:
+        for option in ['header_timeout', 'hedge_after']:
+            if getattr(args, option) is not None:
+                parser.error('--{} requires --async_connections'.format(
+                    option))
+    return args
 
-    # assumes the execution is organized by collections of files that make up
-    # an observation
 
-    global max_release_date
-    max_release_date = None
+def _get_cache(args):
+    """
+    :param args: argparse args object, as from _get_cgps_arg_parser.
+    :return: The DiskHeaderCache the args ask for, or None.
+    """
+    if not args.cache_dir:
+        return None
+    return DiskHeaderCache(args.cache_dir, args.cache_max_mb * 1024 * 1024)
+
+
+def _run_observation(args, cache=None, output=None, run_metrics=None):
+    """
+    Create one observation from all the files that make it up, and write it
+    out.
+
+    :param args: argparse args object, as from _get_cgps_arg_parser.
+    :param cache: DiskHeaderCache to use, if any. May be shared with other
+        observations.
+    :param output: A binary file-like object to write the observation XML
+        to, rather than the -o file, if any.
+    :param run_metrics: Metrics for a run of many observations, if any. The
+        metrics of this observation are added to them.
+    :return: True if the observation was written, False if it is unchanged.
+    """
+    metrics = Metrics()
+    cache_hits = cache.hits if cache is not None else 0
+    cache_misses = cache.misses if cache is not None else 0
+    policy = RetryPolicy(args.header_timeout, args.header_retries,
+                         hedge_after=args.hedge_after)
+    store = HeaderStore(cache, metrics, _get_header_keywords, policy)
+    context = ObservationContext(store, metrics, output)
+    status = 'failed'
+    start = time.time()
+    try:
+        with metrics.timer('observation'):
+            changed = _create_observation(args, store, context)
+        metrics.count('observations_changed' if changed
+                      else 'observations_unchanged')
+        status = 'ok'
+    finally:
+        if status == 'failed':
+            metrics.count('observations_failed')
+        if args.metrics_file or run_metrics is not None:
+            metrics.count('files', len(args.fileURI))
+            metrics.count('store_hits', store.hits)
+            metrics.count('store_misses', store.misses)
+            if cache is not None:
+                metrics.count('cache_hits', cache.hits - cache_hits)
+                metrics.count('cache_misses', cache.misses - cache_misses)
+        if run_metrics is not None:
+            run_metrics.add(metrics)
+        if args.metrics_file:
+            labels = collections.OrderedDict(
+                [('collection', args.observation[0]),
+                 ('observation', args.observation[1]),
+                 ('status', status)])
+            write_metrics(args.metrics_file, metrics, labels,
+                          args.metrics_format, start)
+    return changed
+
+
+def _create_observation(args, store, context):
+    """
+    :param args: argparse args object, as from _get_cgps_arg_parser.
+    :param store: HeaderStore for the observation.
+    :param context: ObservationContext for the observation.
+    :return: True if the observation was written, False if it is unchanged.
+    """
+    cache = store.cache
+    if cache is not None and args.cache_invalidate:
+        for uri in args.fileURI:
+            cache.invalidate(uri)
+    local = None
+    if args.local:
+        # proc expects the --local files in the same order as the fileURIs
+        local = _make_local_index(args.local)
+        args.local = [_get_local_file(uri, local) for uri in args.fileURI]
+    if args.async_connections > 0 and not args.local:
+        with context.metrics.timer('prefetch'):
+            _prefetch_headers_async(args.fileURI, args.cert,
+                                    args.async_connections, args.data_url,
+                                    store)
+    elif args.prefetch_workers > 0:
+        with context.metrics.timer('prefetch'):
+            _prefetch_headers(args.fileURI, local, args.cert,
+                              args.prefetch_workers, store)
+    headers = {}
+    for uri in args.fileURI:
+        headers[uri] = _get_headers(uri, local, args.cert, store)
+    _resolve_release_dates(args.fileURI, headers, local, args.cert, context)
 
-    args = get_arg_parser().parse_args()
     blueprints = {}
-    for i, uri in enumerate(args.fileURI):
+    for uri in args.fileURI:
         logging.debug('Begin customization for {}'.format(uri))
-        headers = _get_headers(uri, args.local, i, args.cert)
-        blueprint = draw_cgps_blueprint(uri, headers, args.local, args.cert)
+        blueprint = draw_cgps_blueprint(uri, headers[uri], local,
+                                        args.cert, context)
         blueprints[uri] = blueprint
 
-    if catalog_uri is not None:
-        blueprints[catalog_uri] = catalog_blueprint
+    if context.catalog_uri is not None:
+        blueprints[context.catalog_uri] = context.catalog_blueprint
 
+    changed = _proc(args, blueprints, context, headers)
+    logging.debug(
+        'Done fitscaom2 processing for {}'.format(args.observation[1]))
+    return changed
+
+
+def run_observation(collection, observation_id, file_names, out_obs_xml,
+                    local=False, cert=None, cache=None, options=None,
+                    output=None, metrics=None):
+    """
+    Create one observation from all the files that make it up, in this
+    interpreter, as main_app would if it were called with the equivalent
+    command line.
+
+    :param collection: CGPS or VGPS.
+    :param observation_id: The observationID of the observation.
+    :param file_names: The files that make up the observation. If local,
+        these are the files on disk, otherwise the file names in the archive.
+    :param out_obs_xml: Where to write the observation. If there is an
+        output, this file is only used, and then removed, when the
+        observation cannot be built in memory.
+    :param local: True if the files are on local disk.
+    :param cert: X509 certificate for accessing proprietary metadata from
+        CADC services.
+    :param cache: DiskHeaderCache to use, if any.
+    :param options: Any additional cgps2caom2 command line arguments, as a
+        list.
+    :param output: A binary file-like object, e.g. io.BytesIO, to write the
+        observation XML to, if any.
+    :param metrics: Metrics for a run of many observations, if any. The
+        metrics of this observation are added to them, e.g. so that the run
+        can write them once, at the end.
+    :return: True if the observation was written, False if it is unchanged.
+    """
+    argv = []
+    if local:
+        argv += ['--local'] + list(file_names)
+    argv += ['--observation', collection, observation_id, '-o', out_obs_xml]
+    if cert:
+        argv += ['--cert', cert]
+    if options:
+        argv += list(options)
+    argv += [_make_uri(collection, f) for f in file_names]
+    args = _parse_cgps_args(argv)
+    return _run_observation(args, cache, output, metrics)
+
+
+def _set_logging(args):
+    """
+    Set up the root logger for the -v, -d and -q arguments, as fits2caom2
+    does. Only the command line entry points do this, so that the logging
+    of code that creates observations in the same interpreter, e.g. with
+    run_observation, is left as it is.
+
+    :param args: argparse args object, as from _get_cgps_arg_parser.
+    """
+    level = logging.WARN
+    if args.verbose:
+        level = logging.INFO
+    elif args.debug:
+        level = logging.DEBUG
+    elif args.quiet:
+        level = logging.ERROR
+    logging.basicConfig(
+        format='%(asctime)s:%(levelname)s:%(name)-12s:%(lineno)d:%(message)s')
+    logging.getLogger().setLevel(level)
+
+
+@contextlib.contextmanager
+def _keep_logging():
+    """
+    proc replaces the handlers of the root logger, and sets its level, from
+    its arguments, every time it is called. Put them back afterwards.
+    """
+    logger = logging.getLogger()
+    level = logger.level
+    handlers = list(logger.handlers)
+    try:
+        yield
+    finally:
+        for handler in list(logger.handlers):
+            if handler not in handlers:
+                logger.removeHandler(handler)
+        for handler in handlers:
+            if handler not in logger.handlers:
+                logger.addHandler(handler)
+        logger.setLevel(level)
+
+
+def main_app():
+
+    # assumes the execution is organized by collections of files that make up
+    # an observation
+
+    args = _parse_cgps_args()
+    _set_logging(args)
     try:
-        proc(args, blueprints)
-        set_catalog_plane_information(args)
+        _run_observation(args, _get_cache(args))
     except Exception as e:
         logging.error(e)
         tb = traceback.format_exc()
         logging.debug(tb)
         sys.exit(-1)
-    logging.debug(
-        'Done fitscaom2 processing for {}'.format(args.observation[1]))
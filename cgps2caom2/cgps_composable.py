@@ -66,17 +66,43 @@
 #
 # ***********************************************************************
 #
+import argparse
+import collections
+import contextlib
+import io
+import json
+import logging
+import os
+import socketserver
+import sys
 import tempfile
+import time
+import traceback
 
-from caom2pipe import execute_composable as ec
-from caom2pipe import manage_composable as mc
-from cgps2caom2 import APPLICATION
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from cgps2caom2 import APPLICATION, group_by_observation, run_observation
+from cgps2caom2 import triage
+from cgps2caom2.header_cache import DiskHeaderCache
+from cgps2caom2.ledger import IngestLedger, get_input_fingerprints
+from cgps2caom2.metrics import Metrics, write_metrics
+from cgps2caom2.observation_sink import ObservationSink
+
+
+__all__ = ['cgps_run', 'cgps_run_batch', 'cgps_run_single', 'cgps_run_worker',
+           'make_worker_server', 'run_batch', 'serve_requests']
 
 data_visitors = []
 meta_visitors = []
 
+# what happened to each observation of a batch
+SKIPPED = 'skipped'
+CHANGED = 'changed'
+UNCHANGED = 'unchanged'
+
 
 def cgps_run():
+    from caom2pipe import execute_composable as ec
+    from caom2pipe import manage_composable as mc
     config = mc.Config()
     config.get_executors()
     ec.run_by_file(config, mc.StorageName, APPLICATION, meta_visitors,
@@ -84,18 +110,476 @@ def cgps_run():
 
 
 def cgps_run_single():
-    import sys
+    # caom2pipe is imported here, rather than with the module, so that
+    # importing cgps2caom2 stays cheap for the many short-lived processes that
+    # do not need it
+    from caom2pipe import execute_composable as ec
+    from caom2pipe import manage_composable as mc
     config = mc.Config()
     config.get_executors()
+    with _use_proxy(config, sys.argv[2]):
+        ec.run_single(config, _get_storage_name(config, sys.argv[1]),
+                      APPLICATION, meta_visitors, data_visitors)
+
+
+@contextlib.contextmanager
+def _use_proxy(config, proxy):
+    """
+    Set the proxy certificate file in the configuration.
+
+    :param config: caom2pipe Config.
+    :param proxy: The proxy certificate file, or, when running in Airflow,
+        the content of the proxy certificate, which is written to a
+        temporary file that is removed on exit.
+    """
+    from caom2pipe import manage_composable as mc
     if config.features.run_in_airflow:
-        temp = tempfile.NamedTemporaryFile()
-        mc.write_to_file(temp.name, sys.argv[2])
-        config.proxy = temp.name
+        with tempfile.NamedTemporaryFile() as temp:
+            mc.write_to_file(temp.name, proxy)
+            config.proxy = temp.name
+            yield
     else:
-        config.proxy = sys.argv[2]
+        config.proxy = proxy
+        yield
+
+
+def _get_storage_name(config, name):
+    """
+    :param name: An observationID, or a file name if the configuration says
+        to use file names.
+    """
+    from caom2pipe import manage_composable as mc
     if config.features.use_file_names:
-        storage_name = mc.StorageName(file_name=sys.argv[1])
+        return mc.StorageName(file_name=name)
     else:
-        storage_name = mc.StorageName(obs_id=sys.argv[1])
-    ec.run_single(config, storage_name, APPLICATION, meta_visitors,
-                  data_visitors)
+        return mc.StorageName(obs_id=name)
+
+
+def cgps_run_worker():
+    """
+    Ingest one observation for each line of input, as cgps_run_single would
+    for each of them, in one long-lived process, so that the configuration
+    is read, the modules are imported, and the proxy certificate is written,
+    only once.
+    """
+    parser = argparse.ArgumentParser(
+        description=('Ingest the observation, or file, named by each line of '
+                     'input, and write a JSON line with the result for '
+                     'each.'))
+    parser.add_argument('proxy',
+                        help=('proxy certificate file, or, when running in '
+                              'Airflow, the content of the proxy '
+                              'certificate'))
+    parser.add_argument('--socket',
+                        help=('path of a Unix domain socket to accept '
+                              'connections on, rather than reading stdin'))
+    args = parser.parse_args()
+    from caom2pipe import execute_composable as ec
+    from caom2pipe import manage_composable as mc
+    config = mc.Config()
+    config.get_executors()
+
+    def ingest(name):
+        try:
+            result = ec.run_single(config, _get_storage_name(config, name),
+                                   APPLICATION, meta_visitors, data_visitors)
+        except SystemExit as e:
+            # run_single ends the process with the result, as the last step
+            # of cgps_run_single
+            result = e.code
+        if result:
+            raise RuntimeError('run_single result is {}'.format(result))
+
+    def write(text):
+        sys.stdout.write(text)
+        sys.stdout.flush()
+
+    with _use_proxy(config, args.proxy):
+        if args.socket:
+            server = make_worker_server(args.socket, ingest)
+            logging.info('Accepting connections on {}'.format(args.socket))
+            try:
+                server.serve_forever()
+            finally:
+                server.server_close()
+                os.unlink(args.socket)
+        else:
+            serve_requests(sys.stdin, write, ingest)
+
+
+def serve_requests(lines, write, ingest):
+    """
+    Ingest the observation, or file, named by each line of input, one after
+    the other.
+
+    :param lines: Iterable of the lines of input. Blank lines are ignored.
+    :param write: Called with a JSON line for each line of input, with the
+        name, the status ('ok' or 'failed'), the time taken in seconds, and
+        the failure message, if any.
+    :param ingest: Called with each name. Raises an exception if the ingest
+        fails.
+    :return: The number of failures.
+    """
+    failures = 0
+    for line in lines:
+        name = line.strip()
+        if not name:
+            continue
+        start = time.time()
+        result = collections.OrderedDict([('name', name), ('status', 'ok')])
+        try:
+            ingest(name)
+        except Exception as e:
+            logging.error('Failed to ingest {}: {}'.format(name, e))
+            logging.debug(traceback.format_exc())
+            result['status'] = 'failed'
+            result['message'] = str(e)
+            failures += 1
+        result['seconds'] = round(time.time() - start, 3)
+        write('{}\n'.format(json.dumps(result)))
+    return failures
+
+
+def make_worker_server(path, ingest):
+    """
+    :param path: Path of the Unix domain socket to accept connections on.
+    :param ingest: As for serve_requests.
+    :return: A socketserver that handles one connection at a time, as for
+        serve_requests, with one line of output for each line of input.
+    """
+
+    class Handler(socketserver.StreamRequestHandler):
+
+        def handle(self):
+
+            def write(text):
+                self.wfile.write(text.encode('utf-8'))
+                self.wfile.flush()
+
+            serve_requests((line.decode('utf-8') for line in self.rfile),
+                           write, ingest)
+
+    return socketserver.UnixStreamServer(path, Handler)
+
+
+def run_batch(file_names, output_dir, local=False, cert=None,
+              cache_dir=None, workers=0, options=None, ledger_file=None,
+              sink_file=None, skip_unchanged=False, cache_max_mb=1024,
+              metrics_file=None, metrics_format=None):
+    """
+    Create all the observations that a list of files makes up.
+
+    :param file_names: The files to ingest. If local, these are the files on
+        disk, otherwise the file names in the archive.
+    :param output_dir: Where to write the observation XML files.
+    :param local: True if the files are on local disk.
+    :param cert: X509 certificate for accessing proprietary metadata from
+        CADC services.
+    :param cache_dir: Directory of the DiskHeaderCache to use, if any.
+    :param workers: If zero, ingest the observations one after the other, in
+        this interpreter. Otherwise, ingest the observations in a pool of
+        this many processes.
+    :param options: Any additional cgps2caom2 command line arguments for
+        every observation, as a list.
+    :param ledger_file: The IngestLedger file, if any. Observations whose
+        inputs are unchanged since they were last ingested are skipped.
+    :param sink_file: The ObservationSink file, if any. The observations
+        are appended to it, rather than written to one XML file each in
+        output_dir.
+    :param skip_unchanged: If True, leave the XML files in output_dir as
+        they are for the observations whose metadata checksums are
+        unchanged. Ignored with a sink_file.
+    :param cache_max_mb: The maximum size of the DiskHeaderCache, in MB,
+        for all the processes that share it.
+    :param metrics_file: The file to write the metrics of the run to, if
+        any. The metrics of all the observations are added up, and written
+        once, at the end of the run.
+    :param metrics_format: As for write_metrics.
+    :return: dict of the failure messages, keyed by observationID. The
+        message is None for the observations that succeeded, or were
+        skipped.
+    """
+    groups, unmatched = group_by_observation(file_names)
+    for file_name in unmatched:
+        logging.warning('{} is not part of any observation.'.format(file_name))
+
+    if skip_unchanged and not sink_file:
+        options = list(options or []) + ['--skip_unchanged']
+    results = {}
+    statuses = collections.Counter()
+    metrics = Metrics() if metrics_file else None
+    start = time.time()
+    # only this process writes to the sink, and records the observations
+    # once they are written
+    sink = ObservationSink(sink_file) if sink_file else None
+    ledger = IngestLedger(ledger_file) if ledger_file else None
+    sunk = set(sink.entries) if sink is not None else None
+    try:
+        if workers > 0:
+            logging.info('Ingest {} observations with {} workers.'.format(
+                len(groups), workers))
+            with ProcessPoolExecutor(
+                    max_workers=workers, initializer=_init_worker,
+                    initargs=(cache_dir, ledger_file, sunk,
+                              cache_max_mb)) as executor:
+                futures = [executor.submit(_ingest, group, output_dir, local,
+                                           cert, options, metrics is not None)
+                           for group in groups.items()]
+                for future in as_completed(futures):
+                    statuses[_finish(future.result(), results, sink,
+                                     ledger, metrics)] += 1
+        else:
+            _init_worker(cache_dir, ledger_file, sunk, cache_max_mb)
+            try:
+                for group in groups.items():
+                    statuses[_finish(
+                        _ingest(group, output_dir, local, cert, options,
+                                metrics is not None),
+                        results, sink, ledger, metrics)] += 1
+            finally:
+                _close_worker()
+    finally:
+        if sink is not None:
+            sink.close()
+        if ledger is not None:
+            ledger.close()
+        if metrics is not None:
+            metrics.count('observations_skipped', statuses[SKIPPED])
+            write_metrics(metrics_file, metrics, collections.OrderedDict(),
+                          metrics_format, start)
+    if ledger_file:
+        logging.info('Skipped {} observations with unchanged inputs.'.format(
+            statuses[SKIPPED]))
+    if skip_unchanged and not sink_file:
+        logging.info('Wrote {} changed observations, and left {} unchanged '
+                     'observations as they were.'.format(
+                         statuses[CHANGED], statuses[UNCHANGED]))
+    return results
+
+
+def _finish(result, results, sink, ledger, metrics=None):
+    """
+    Write out what _ingest returned.
+
+    :param metrics: Metrics for the run, if any.
+    :return: The status of the observation, as from _ingest.
+    """
+    (collection, obs_id), msg, status, inputs, data, observed = result
+    results[obs_id] = msg
+    if metrics is not None and observed is not None:
+        metrics.add(observed)
+    if status in (CHANGED, UNCHANGED):
+        if sink is not None:
+            sink.append(collection, obs_id, data)
+        if ledger is not None:
+            ledger.record(collection, obs_id, inputs)
+    return status
+
+
+# the DiskHeaderCache and IngestLedger for the observations ingested by this
+# process, and the observations already in the ObservationSink, if there is
+# one
+_worker_cache = None
+_worker_ledger = None
+_worker_sunk = None
+
+
+def _init_worker(cache_dir, ledger_file=None, sunk=None, cache_max_mb=1024):
+    global _worker_cache, _worker_ledger, _worker_sunk
+    _close_worker()
+    if cache_dir:
+        _worker_cache = DiskHeaderCache(cache_dir,
+                                        cache_max_mb * 1024 * 1024)
+    if ledger_file:
+        _worker_ledger = IngestLedger(ledger_file)
+    _worker_sunk = sunk
+
+
+def _close_worker():
+    global _worker_cache, _worker_ledger, _worker_sunk
+    if _worker_ledger is not None:
+        _worker_ledger.close()
+    _worker_cache = None
+    _worker_ledger = None
+    _worker_sunk = None
+
+
+def _ingest(group, output_dir, local, cert, options=None,
+            with_metrics=False):
+    """
+    Create one observation, as one of a batch.
+
+    :param group: a tuple of ((collection, observationID), file names)
+    :param with_metrics: True to return the metrics of the observation.
+    :return: a tuple of ((collection, observationID), failure message or
+        None, SKIPPED if the observation was skipped because its inputs are
+        unchanged, CHANGED or UNCHANGED if it was created, and its XML was
+        written or left as it was, None if it failed, the input
+        fingerprints if there is a ledger, the observation XML if there is a
+        sink, the Metrics of the observation if with_metrics)
+    """
+    key, file_names = group
+    collection, obs_id = key
+    out_obs_xml = os.path.join(output_dir, '{}.xml'.format(obs_id))
+    metrics = Metrics() if with_metrics else None
+    try:
+        inputs = None
+        if _worker_ledger is not None:
+            inputs = get_input_fingerprints(collection, file_names, local,
+                                            cert)
+            if _worker_sunk is None:
+                exists = os.path.exists(out_obs_xml)
+            else:
+                exists = key in _worker_sunk
+            if (exists and
+                    _worker_ledger.is_unchanged(collection, obs_id, inputs)):
+                logging.debug('Skipping unchanged {}.'.format(obs_id))
+                return key, None, SKIPPED, inputs, None, None
+        output = None
+        if _worker_sunk is not None:
+            # out_obs_xml is only written if the observation cannot be built
+            # in memory
+            output = io.BytesIO()
+        changed = run_observation(collection, obs_id, file_names,
+                                  out_obs_xml, local, cert, _worker_cache,
+                                  options, output, metrics)
+        data = None if output is None else output.getvalue()
+        return (key, None, CHANGED if changed else UNCHANGED, inputs, data,
+                metrics)
+    except Exception as e:
+        logging.error('Failed to ingest {}: {}'.format(obs_id, e))
+        logging.debug(traceback.format_exc())
+        return key, str(e), None, None, None, metrics
+
+
+def _get_batch_arg_parser():
+    parser = argparse.ArgumentParser(
+        description=('Ingest all the observations that a list of files makes '
+                     'up, in one process.'))
+    parser.add_argument('source',
+                        help=('a file naming the files to ingest, one per '
+                              'line, or a directory of local files to ingest'))
+    parser.add_argument('-o', '--out', dest='output_dir', default=os.getcwd(),
+                        help='directory for the observation XML files')
+    parser.add_argument('--cert', help='Proxy Cert&Key PEM file')
+    parser.add_argument('--cache_dir',
+                        help=('directory for keeping retrieved headers '
+                              'between runs'))
+    parser.add_argument('--cache_max_mb', type=int, default=1024,
+                        help='maximum size of the header cache, in MB')
+    parser.add_argument('--async_connections', type=int, default=0,
+                        help=('retrieve the headers for each observation '
+                              'with asyncio, using at most this many '
+                              'connections'))
+    parser.add_argument('--data_url',
+                        help=('URL of the data service for headers, e.g. a '
+                              'local stand-in from cgps_synthetic_survey'))
+    parser.add_argument('--workers', type=int, default=0,
+                        help=('ingest independent observations in a pool of '
+                              'this many processes'))
+    parser.add_argument('--dry_run', action='store_true',
+                        help=('report how the files group into observations, '
+                              'and the files that cannot be ingested, '
+                              'without retrieving any headers'))
+    parser.add_argument('--ledger',
+                        help=('SQLite file of the inputs each observation '
+                              'was last ingested from. Observations with '
+                              'unchanged inputs are skipped.'))
+    parser.add_argument('--sink',
+                        help=('tar file to append the observations to, '
+                              'with an index of their byte offsets, rather '
+                              'than writing one XML file each'))
+    parser.add_argument('--skip_unchanged', action='store_true',
+                        help=('leave the XML file of an observation as it '
+                              'is, if the metadata checksum of the '
+                              'observation is unchanged'))
+    parser.add_argument('--metrics_file',
+                        help=('write the time spent in each stage, call '
+                              'counts, bytes read, cache hits, retries and '
+                              'header request percentiles, added up for all '
+                              'the observations, to this file at the end of '
+                              'the run'))
+    parser.add_argument('--metrics_format', choices=['jsonl', 'prometheus'],
+                        help=('append a JSON line, or replace a Prometheus '
+                              'textfile. The default is prometheus for a '
+                              '.prom metrics_file, and jsonl otherwise.'))
+    return parser
+
+
+def _get_file_names(source):
+    """
+    :param source: A file naming files, one per line, or a directory.
+    :return: a tuple of (list of file names, True if the files are local)
+    """
+    if os.path.isdir(source):
+        return [os.path.join(source, name) for name in
+                sorted(os.listdir(source))], True
+    with open(source) as f:
+        return [line.strip() for line in f if line.strip()], False
+
+
+def _log_summary(results):
+    failures = sorted(
+        obs_id for obs_id, msg in results.items() if msg is not None)
+    logging.info('Ingested {} of {} observations.'.format(
+        len(results) - len(failures), len(results)))
+    for obs_id in failures:
+        logging.error('{}: {}'.format(obs_id, results[obs_id]))
+    return failures
+
+
+def _write_triage_report(report, out=None):
+    """
+    :param report: TriageReport, as from triage.
+    :param out: Where to write the report. sys.stdout if None.
+    :return: The number of files that cannot be ingested as they are.
+    """
+    out = sys.stdout if out is None else out
+    collections_count = collections.Counter(
+        collection for collection, obs_id in report.groups)
+    out.write('{} files make up {} observations ({}).\n'.format(
+        sum(len(names) for names in report.groups.values()),
+        len(report.groups),
+        ', '.join('{} {}'.format(count, collection) for collection, count in
+                  sorted(collections_count.items()))))
+    for (collection, obs_id), names in report.groups.items():
+        out.write('  {} {} {}\n'.format(collection, obs_id, len(names)))
+
+    out.write('{} files match no file name pattern.\n'.format(
+        len(report.unmatched)))
+    for file_name in report.unmatched:
+        out.write('  {}\n'.format(file_name))
+
+    out.write('{} file_ids are named more than once.\n'.format(
+        len(report.duplicates)))
+    for file_id, names in report.duplicates.items():
+        out.write('  {}: {}\n'.format(file_id, ' '.join(names)))
+
+    missing = sum(len(names) for names in report.missing_images.values())
+    out.write('{} fwhm files have no image file.\n'.format(missing))
+    for (collection, obs_id), names in report.missing_images.items():
+        out.write('  {} {}: {}\n'.format(collection, obs_id, ' '.join(names)))
+
+    return (len(report.unmatched) + missing +
+            sum(len(names) - 1 for names in report.duplicates.values()))
+
+
+def cgps_run_batch():
+    logging.getLogger().setLevel(logging.INFO)
+    args = _get_batch_arg_parser().parse_args()
+    file_names, local = _get_file_names(args.source)
+    if args.dry_run:
+        if _write_triage_report(triage(file_names)):
+            sys.exit(-1)
+        return
+    options = []
+    if args.async_connections > 0:
+        options = ['--async_connections', str(args.async_connections)]
+    if args.data_url:
+        options += ['--data_url', args.data_url]
+    results = run_batch(file_names, args.output_dir, local, args.cert,
+                        args.cache_dir, args.workers, options, args.ledger,
+                        args.sink, args.skip_unchanged, args.cache_max_mb,
+                        args.metrics_file, args.metrics_format)
+    if _log_summary(results):
+        sys.exit(-1)
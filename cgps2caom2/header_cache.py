@@ -0,0 +1,442 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2018.                            (c) 2018.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#  $Revision: 4 $
+#
+# ***********************************************************************
+#
+"""
+Re-use of header information, so that the same file's headers are not
+retrieved more than once.
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+from cgps2caom2.metrics import Metrics
+from concurrent.futures import Future
+
+import contextlib
+import fcntl
+import hashlib
+import io
+import json
+import logging
+import os
+import re
+import threading
+
+
+__all__ = ['DiskHeaderCache', 'HeaderStore', 'project_headers']
+CACHE_SUFFIX = '.header'
+# the file that processes sharing a cache directory lock, and that holds the
+# total size of the entries
+LOCK_NAME = 'cache.lock'
+# once the entries do not fit, how much of the maximum size is left after
+# eviction, so that a full cache does not list and sort the entries again
+# on the next put
+LOW_WATER = 0.9
+
+# The keywords that describe the structure of an HDU, and the WCS keywords
+# of the FITS standard, with or without axis numbers and an alternate WCS
+# letter. A projection always keeps these, so that the WCS can still be
+# built from a projected header.
+STRUCTURE_AND_WCS_KEYWORDS = re.compile(
+    r'(SIMPLE|XTENSION|BITPIX|NAXIS|EXTEND|PCOUNT|GCOUNT|GROUPS|EXTNAME|'
+    r'EXTVER|BSCALE|BZERO|BUNIT|BLANK|'
+    r'WCSAXES|WCSNAME|CTYPE|CRVAL|CRPIX|CDELT|CUNIT|CROTA|CNAME|CRDER|'
+    r'CSYER|LONPOLE|LATPOLE|EQUINOX|EPOCH|RADESYS|RADECSYS|RESTFRQ|'
+    r'RESTFREQ|RESTWAV|SPECSYS|SSYSOBS|SSYSSRC|VELOSYS|VELREF|ZSOURCE|'
+    r'VELANGL|MJD-OBS|MJD-AVG|DATE-OBS|DATE-AVG|OBSGEO-[XYZ]|TIMESYS|'
+    r'(PC|CD|PV|PS)\d+_\d+)\d*[A-Z]?$')
+
+
+class HeaderStore(object):
+    """
+    Per-run memo of header information, keyed by URI.
+
+    Concurrent requests for the same URI are merged, so the headers for
+    that URI are retrieved only once, and all the requesters get the same
+    result. Failed retrievals are not kept, so a later request will try
+    again.
+
+    With a projection, only the cards that will be read are kept, so that
+    the memory the store uses depends on the number of files, rather than
+    on the size of their headers.
+    """
+
+    def __init__(self, cache=None, metrics=None, projection=None,
+                 policy=None):
+        """
+        :param cache: If provided, a DiskHeaderCache that outlives this
+            store, and that is consulted before headers are retrieved.
+        :param metrics: Metrics for the observation the headers are for.
+        :param projection: If provided, a function that takes a URI, and
+            returns the keywords to keep in the headers for that URI, as for
+            project_headers, or None to keep all the cards.
+        :param policy: RetryPolicy for retrieving headers from a service.
+            None for one attempt.
+        """
+        self.cache = cache
+        self.metrics = Metrics() if metrics is None else metrics
+        self.projection = projection
+        self.policy = policy
+        self._lock = threading.Lock()
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, uri, retrieve):
+        """
+        :param uri: Which URI to get headers for.
+        :param retrieve: The function that gets the headers for the URI,
+            if they are not already known. Takes no arguments.
+        :return: The headers for the URI.
+        """
+        with self._lock:
+            future = self._entries.get(uri)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._entries[uri] = future
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        if owner:
+            try:
+                future.set_result(self._project(uri, retrieve()))
+            except Exception as e:
+                with self._lock:
+                    del self._entries[uri]
+                future.set_exception(e)
+        else:
+            logging.debug('Re-using headers for {}.'.format(uri))
+        return future.result()
+
+    def __contains__(self, uri):
+        with self._lock:
+            return uri in self._entries
+
+    def _project(self, uri, headers):
+        if self.projection is None or not isinstance(headers, list):
+            return headers
+        keywords = self.projection(uri)
+        if keywords is None:
+            return headers
+        return project_headers(headers, keywords)
+
+
+def project_headers(headers, keywords):
+    """
+    :param headers: list of astropy headers.
+    :param keywords: The keywords to keep, as well as the structure and WCS
+        keywords.
+    :return: list of new astropy headers, with only the cards for those
+        keywords. Anything in the list that is not a header is returned as
+        it is.
+    """
+    from astropy.io import fits
+    result = []
+    for header in headers:
+        if isinstance(header, fits.Header):
+            header = fits.Header(
+                [card for card in header.cards if
+                 card.keyword in keywords or
+                 STRUCTURE_AND_WCS_KEYWORDS.match(card.keyword)])
+        result.append(header)
+    return result
+
+
+class DiskHeaderCache(object):
+    """
+    Persistent header information, keyed by URI, and checked against a
+    fingerprint of the file content (e.g. size and checksum), so that a
+    changed file is not served stale headers.
+
+    Each entry is a text file in the cache directory. The total size of the
+    entries is kept below a maximum by removing the least-recently used
+    entries first, down to LOW_WATER of the maximum. Processes may share
+    the cache directory: the total is kept in the LOCK_NAME file, and
+    updated with that file locked, so that a put does not have to look at
+    the other entries unless some must be evicted.
+    """
+
+    def __init__(self, directory, max_bytes=1024 * 1024 * 1024):
+        """
+        :param directory: Where the cache entries are kept. Created if it
+            does not exist.
+        :param max_bytes: How much disk the cache entries may use.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        self._lock_fqn = os.path.join(directory, LOCK_NAME)
+
+    @property
+    def total_bytes(self):
+        """
+        The total size of the entries, from all the processes that share
+        the cache directory.
+        """
+        with self._shared() as fd:
+            return self._read_total(fd)
+
+    def get(self, uri, fingerprint):
+        """
+        :param uri: Which URI to get headers for.
+        :param fingerprint: The fingerprint of the current file content.
+        :return: The astropy headers for the URI, or None if there is no
+            entry for the URI, or the entry is for different file content.
+        """
+        fqn = self._fqn(uri)
+        try:
+            with io.open(fqn, 'r', encoding='ascii') as f:
+                key = json.loads(f.readline())
+                content = f.read()
+        except (IOError, OSError, ValueError):
+            self._count(hit=False)
+            return None
+
+        if key.get('uri') != uri or key.get('fingerprint') != fingerprint:
+            logging.debug('Stale cache entry for {}.'.format(uri))
+            self.invalidate(uri)
+            self._count(hit=False)
+            return None
+
+        # the modification time is the LRU order
+        try:
+            os.utime(fqn, None)
+        except OSError:
+            pass
+        self._count(hit=True)
+        return make_headers(content)
+
+    def put(self, uri, fingerprint, headers):
+        """
+        Keep the headers for the URI, and then evict the least-recently used
+        entries, if there are now too many.
+
+        :param uri: Which URI the headers are from.
+        :param fingerprint: The fingerprint of the file content the headers
+            are from.
+        :param headers: list of astropy headers.
+        """
+        key = json.dumps({'uri': uri, 'fingerprint': fingerprint})
+        content = ''.join(
+            h.tostring(sep='\n', endcard=True, padding=False) + '\n'
+            for h in headers)
+        fqn = self._fqn(uri)
+        # unique to the process and thread, as processes may share the
+        # cache directory
+        temp_fqn = '{}.{}.{}.tmp'.format(fqn, os.getpid(),
+                                         threading.current_thread().ident)
+        with io.open(temp_fqn, 'w', encoding='ascii') as f:
+            f.write('{}\n{}'.format(key, content))
+        with self._shared() as fd:
+            total = self._read_total(fd)
+            total -= _get_size(fqn)
+            os.rename(temp_fqn, fqn)
+            total += _get_size(fqn)
+            if total > self.max_bytes:
+                total = self._evict()
+            self._write_total(fd, total)
+
+    def invalidate(self, uri=None):
+        """
+        :param uri: Remove the entry for this URI. If None, remove all the
+            entries.
+        """
+        if uri is None:
+            fqns = self._entry_fqns()
+        else:
+            fqns = [self._fqn(uri)]
+        with self._shared() as fd:
+            total = self._read_total(fd)
+            for fqn in fqns:
+                total -= self._remove(fqn)
+            self._write_total(fd, total)
+
+    def _count(self, hit):
+        # the cache may be shared by threads
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    @contextlib.contextmanager
+    def _shared(self):
+        """
+        Hold the lock on the cache directory, for this thread, and this
+        process.
+
+        :return: The descriptor of the LOCK_NAME file.
+        """
+        with self._lock:
+            fd = os.open(self._lock_fqn, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                yield fd
+            finally:
+                # releases the lock
+                os.close(fd)
+
+    def _read_total(self, fd):
+        """
+        :return: The total size of the entries. If it has not been kept yet,
+            e.g. for a cache directory from an earlier version, it is found
+            from the entries.
+        """
+        os.lseek(fd, 0, os.SEEK_SET)
+        content = os.read(fd, 32)
+        if content.strip():
+            try:
+                return int(content)
+            except ValueError:
+                pass
+        return sum(_get_size(fqn) for fqn in self._entry_fqns())
+
+    def _write_total(self, fd, total):
+        os.ftruncate(fd, 0)
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.write(fd, '{}\n'.format(max(total, 0)).encode('ascii'))
+
+    def _evict(self):
+        """
+        Remove the least-recently used entries, until the entries take up
+        no more than LOW_WATER of the maximum size. Called with the lock
+        held.
+
+        :return: The total size of the remaining entries.
+        """
+        # the entries, rather than the kept total, which may be out of date
+        # if entries have been removed by something other than the cache
+        entries = sorted(self._entry_fqns(), key=_get_mtime)
+        total = sum(_get_size(fqn) for fqn in entries)
+        low_water = self.max_bytes * LOW_WATER
+        for fqn in entries:
+            if total <= low_water:
+                break
+            logging.debug('Evict cache entry {}.'.format(fqn))
+            total -= self._remove(fqn)
+        return total
+
+    def _remove(self, fqn):
+        """
+        :return: The size of the entry that was removed, or 0 if there was
+            none.
+        """
+        size = _get_size(fqn)
+        try:
+            os.unlink(fqn)
+        except OSError:
+            return 0
+        return size
+
+    def _entry_fqns(self):
+        return [os.path.join(self.directory, name) for name in
+                os.listdir(self.directory) if name.endswith(CACHE_SUFFIX)]
+
+    def _fqn(self, uri):
+        name = hashlib.sha1(uri.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, '{}{}'.format(name, CACHE_SUFFIX))
+
+
+def _get_size(fqn):
+    # other processes may share the cache directory, and remove entries
+    try:
+        return os.path.getsize(fqn)
+    except OSError:
+        return 0
+
+
+def _get_mtime(fqn):
+    # other processes may share the cache directory, and remove entries
+    try:
+        return os.path.getmtime(fqn)
+    except OSError:
+        return 0
+
+
+def make_headers(content):
+    """
+    :param content: The text form of one or more headers, one card per line,
+        with each header terminated by an END card.
+    :return: list of astropy headers.
+    """
+    from astropy.io import fits
+    headers = []
+    cards = []
+    for line in content.splitlines():
+        if line.rstrip() == 'END':
+            headers.append(fits.Header.fromstring('\n'.join(cards), sep='\n'))
+            cards = []
+        else:
+            cards.append(line)
+    return headers
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2018.                            (c) 2018.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#  $Revision: 4 $
+#
+# ***********************************************************************
+#
+"""
+A local stand-in for the header retrieval of the CADC data service, for
+testing without network access.
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import hashlib
+import os
+import random
+import threading
+import time
+
+
+__all__ = ['HeaderService']
+
+
+class HeaderService(object):
+    """
+    Serves header text dumps (the .header files in the tests/data
+    directories) as the data service serves fhead requests:
+
+        GET  /<archive>/<file_id>?fhead=true  - the header text
+        HEAD /<archive>/<file_id>             - size and checksum
+
+    The file_id of a dump is its name without the .header suffix. Dumps are
+    found anywhere below the served directory. The archive is ignored.
+
+    For load testing, each response can be delayed, a fraction of the
+    responses can be delayed much more (the tail of the response times), and
+    a fraction of the requests can fail, either with an HTTP error status,
+    or by closing the connection without a response.
+
+    Use as a context manager, or call start and stop.
+    """
+
+    def __init__(self, directory, host='127.0.0.1', port=0, latency=0.0,
+                 error_rate=0.0, error_status=503, reset_rate=0.0,
+                 tail_rate=0.0, tail_latency=0.0, seed=None):
+        """
+        :param directory: Where the header text dumps are.
+        :param latency: Seconds by which to delay each response. A
+            (minimum, maximum) tuple for a delay chosen at random between
+            the two.
+        :param error_rate: The fraction of the requests that get the
+            error_status response instead of headers.
+        :param error_status: The HTTP status of the injected errors.
+        :param reset_rate: The fraction of the requests for which the
+            connection is closed without a response.
+        :param tail_rate: The fraction of the requests that succeed after
+            tail_latency seconds, instead of after the latency.
+        :param tail_latency: Seconds by which to delay the tail responses.
+        :param seed: For repeatable choices of delays and failures. The
+            requests are numbered in the order they arrive, and the choice
+            for each request depends only on its number.
+        """
+        self.directory = directory
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.reset_rate = reset_rate
+        self.tail_rate = tail_rate
+        self.tail_latency = tail_latency
+        self.requests = 0
+        self.connections = 0
+        self.errors = 0
+        self.resets = 0
+        self.tails = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._index = {}
+        for root, dirs, files in os.walk(directory):
+            for name in files:
+                if name.endswith('.header'):
+                    self._index[name[:-len('.header')]] = os.path.join(
+                        root, name)
+        self._server = ThreadingHTTPServer((host, port), _make_handler(self))
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self.base_url
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _count(self, attribute):
+        with self._lock:
+            setattr(self, attribute, getattr(self, attribute) + 1)
+
+    def _choose(self):
+        """
+        :return: the delay for a response, and None, 'error' or 'reset' for
+            how it fails.
+        """
+        with self._lock:
+            if isinstance(self.latency, (tuple, list)):
+                delay = self._random.uniform(*self.latency)
+            else:
+                delay = self.latency
+            failure = None
+            choice = self._random.random()
+            if choice < self.reset_rate:
+                failure = 'reset'
+                self.resets += 1
+            elif choice < self.reset_rate + self.error_rate:
+                failure = 'error'
+                self.errors += 1
+            elif choice < self.reset_rate + self.error_rate + self.tail_rate:
+                delay = self.tail_latency
+                self.tails += 1
+            return delay, failure
+
+    def _find(self, path):
+        file_id = path.split('?', 1)[0].rstrip('/').split('/')[-1]
+        return self._index.get(file_id)
+
+
+def _make_handler(service):
+
+    class _HeaderHandler(BaseHTTPRequestHandler):
+        # keep-alive
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            BaseHTTPRequestHandler.setup(self)
+            service._count('connections')
+
+        def do_GET(self):
+            self._respond(True)
+
+        def do_HEAD(self):
+            self._respond(False)
+
+        def _respond(self, with_body):
+            service._count('requests')
+            delay, failure = service._choose()
+            if delay > 0:
+                time.sleep(delay)
+            if failure == 'reset':
+                self.close_connection = True
+                return
+            if failure == 'error':
+                self.send_response(service.error_status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            fqn = service._find(self.path)
+            if fqn is None:
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            with open(fqn, 'rb') as f:
+                content = f.read()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(content)))
+            self.send_header('Content-MD5', hashlib.md5(content).hexdigest())
+            self.end_headers()
+            if with_body:
+                self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            pass
+
+    return _HeaderHandler
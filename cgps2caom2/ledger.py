@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2018.                            (c) 2018.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#  $Revision: 4 $
+#
+# ***********************************************************************
+#
+"""
+A record of the inputs each observation was last ingested from, so that a
+re-run can skip the observations whose inputs have not changed.
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+from cgps2caom2 import cgps2caom2 as cc
+
+import collections
+import datetime
+import hashlib
+import json
+import sqlite3
+
+
+__all__ = ['IngestLedger', 'get_input_fingerprints']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS observations (
+    collection TEXT NOT NULL,
+    observation_id TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    rules_version TEXT NOT NULL,
+    inputs TEXT NOT NULL,
+    ingested TEXT NOT NULL,
+    PRIMARY KEY (collection, observation_id))
+"""
+
+
+def get_input_fingerprints(collection, file_names, local=False, cert=None):
+    """
+    :param collection: CGPS or VGPS.
+    :param file_names: The files that make up an observation. If local,
+        these are the files on disk, otherwise the file names in the archive.
+    :param local: True if the files are on local disk.
+    :param cert: X509 certificate for accessing proprietary metadata from
+        CADC services.
+    :return: OrderedDict of the fingerprints of the file content, keyed by
+        URI, as used to check the DiskHeaderCache.
+    """
+    local_files = cc._make_local_index(file_names) if local else None
+    result = collections.OrderedDict()
+    for file_name in file_names:
+        uri = cc._make_uri(collection, file_name)
+        result[uri] = cc._get_fingerprint(uri, local_files, cert)
+    return result
+
+
+def _make_fingerprint(inputs, rules_version):
+    content = json.dumps([sorted(inputs.items()), rules_version])
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+class IngestLedger(object):
+    """
+    For each observation, the input URIs and their fingerprints, and the
+    version of the blueprint rules, as of the last successful ingest, kept
+    in an SQLite file.
+
+    An observation needs to be ingested again if any of its inputs are
+    added, removed or changed, or if the blueprint rules change.
+
+    Each process should have its own IngestLedger. Processes may share the
+    file.
+    """
+
+    def __init__(self, fname, rules_version=cc.BLUEPRINT_RULES_VERSION):
+        """
+        :param fname: The SQLite file. Created if it does not exist.
+        :param rules_version: The version of the blueprint rules that
+            observations are ingested with.
+        """
+        self.fname = fname
+        self.rules_version = rules_version
+        # wait for other processes writing to the same file
+        self._connection = sqlite3.connect(fname, timeout=60)
+        with self._connection:
+            self._connection.execute(SCHEMA)
+
+    def is_unchanged(self, collection, observation_id, inputs):
+        """
+        :param collection: CGPS or VGPS.
+        :param observation_id: The observationID.
+        :param inputs: dict of the input fingerprints, keyed by URI, as from
+            get_input_fingerprints.
+        :return: True if the observation was last ingested from the same
+            inputs, with the same blueprint rules.
+        """
+        row = self._connection.execute(
+            'SELECT fingerprint FROM observations '
+            'WHERE collection = ? AND observation_id = ?',
+            (collection, observation_id)).fetchone()
+        return (row is not None and
+                row[0] == _make_fingerprint(inputs, self.rules_version))
+
+    def record(self, collection, observation_id, inputs):
+        """
+        Record a successful ingest.
+
+        Parameters as for is_unchanged.
+        """
+        with self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO observations VALUES '
+                '(?, ?, ?, ?, ?, ?)',
+                (collection, observation_id,
+                 _make_fingerprint(inputs, self.rules_version),
+                 self.rules_version, json.dumps(inputs),
+                 datetime.datetime.utcnow().isoformat()))
+
+    def get(self, collection, observation_id):
+        """
+        :return: dict of what was recorded for the observation, or None.
+        """
+        row = self._connection.execute(
+            'SELECT fingerprint, rules_version, inputs, ingested '
+            'FROM observations WHERE collection = ? AND observation_id = ?',
+            (collection, observation_id)).fetchone()
+        if row is None:
+            return None
+        return {'fingerprint': row[0],
+                'rules_version': row[1],
+                'inputs': json.loads(row[2], object_pairs_hook=dict),
+                'ingested': row[3]}
+
+    def forget(self, collection, observation_id):
+        """
+        Make sure the observation is ingested next time.
+        """
+        with self._connection:
+            self._connection.execute(
+                'DELETE FROM observations '
+                'WHERE collection = ? AND observation_id = ?',
+                (collection, observation_id))
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
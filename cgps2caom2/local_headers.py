@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2018.                            (c) 2018.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#  $Revision: 4 $
+#
+# ***********************************************************************
+#
+"""
+Header information from files on local disk, read without opening the
+files through the general FITS machinery.
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import mmap
+import os
+
+
+__all__ = ['is_fits_file', 'is_header_dump', 'read_fits_headers',
+           'read_header_dump']
+
+BLOCK_SIZE = 2880
+CARD_SIZE = 80
+END_CARD = b'END' + b' ' * (CARD_SIZE - 3)
+END_KEYWORD = END_CARD[:8]
+FITS_SIGNATURE = b'SIMPLE  ='
+# Commentary cards, which no blueprint reads, and which are most of the
+# cards in the header dumps
+COMMENTARY_KEYWORDS = frozenset([b'HISTORY ', b'COMMENT ', b' ' * 8])
+
+
+def is_fits_file(fname):
+    """
+    :param fname: A file on disk.
+    :return: True if the file starts the way an uncompressed FITS file
+        does. Text dumps of headers, one card per line, are not FITS files.
+    """
+    with open(fname, 'rb') as f:
+        block = f.read(BLOCK_SIZE)
+    return (len(block) == BLOCK_SIZE and block.startswith(FITS_SIGNATURE) and
+            b'\n' not in block)
+
+
+def is_header_dump(fname):
+    """
+    :param fname: A file on disk.
+    :return: True if the file is a text dump of FITS headers, one card per
+        line, as are the .header files.
+    """
+    with open(fname, 'rb') as f:
+        line = f.readline(CARD_SIZE + 2)
+    return line.startswith(FITS_SIGNATURE) and line.endswith(b'\n')
+
+
+def read_header_dump(fname):
+    """
+    Read a text dump of FITS headers, one card per line, with each header
+    terminated by an END card.
+
+    The file is read one line at a time, and the commentary cards are
+    dropped before the headers are built, so that parsing does not cost
+    more than reading the file.
+
+    :param fname: A header dump on disk.
+    :return: list of astropy headers, one per END card, without any
+        HISTORY, COMMENT or blank cards.
+    """
+    from astropy.io import fits
+    headers = []
+    cards = []
+    with open(fname, 'rb') as f:
+        for line in f:
+            card = line.rstrip(b'\r\n').ljust(CARD_SIZE)
+            keyword = card[:8]
+            if keyword == END_KEYWORD:
+                headers.append(fits.Header.fromstring(
+                    b''.join(cards).decode('ascii', errors='replace')))
+                cards = []
+            elif keyword not in COMMENTARY_KEYWORDS:
+                if len(card) > CARD_SIZE:
+                    card = card.rstrip()
+                    if len(card) > CARD_SIZE:
+                        raise IOError('Card longer than {} characters in '
+                                      '{}: {!r}'.format(CARD_SIZE, fname,
+                                                        card))
+                    card = card.ljust(CARD_SIZE)
+                cards.append(card)
+    return headers
+
+
+def read_fits_headers(fname):
+    """
+    Read the headers of every HDU in an uncompressed FITS file.
+
+    The file is memory-mapped, and each header is scanned one 2880-byte
+    block at a time until its END card. The data that follows each header
+    is skipped over, without being read, so the time and memory this takes
+    do not depend on the size of the data.
+
+    :param fname: A FITS file on disk.
+    :return: list of astropy headers, one per HDU, as from get_cadc_headers.
+    """
+    from astropy.io import fits
+    headers = []
+    with open(fname, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < BLOCK_SIZE:
+            raise IOError('{} is too short to be a FITS file.'.format(fname))
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            offset = 0
+            while offset + BLOCK_SIZE <= size:
+                end = _find_end_card(m, offset, size)
+                if end is None:
+                    if headers:
+                        # padding or other content after the last HDU
+                        break
+                    raise IOError('No END card in {}.'.format(fname))
+                header = fits.Header.fromstring(
+                    m[offset:end].decode('ascii', errors='replace'))
+                headers.append(header)
+                offset = (_round_up(end + CARD_SIZE) +
+                          _round_up(_get_data_size(header)))
+    return headers
+
+
+def _find_end_card(m, offset, size):
+    """
+    :return: The position of the END card of the header that starts at
+        offset, or None if there is no END card.
+    """
+    block = offset
+    while block + BLOCK_SIZE <= size:
+        for card in range(block, block + BLOCK_SIZE, CARD_SIZE):
+            if m[card:card + CARD_SIZE] == END_CARD:
+                return card
+        block += BLOCK_SIZE
+    return None
+
+
+def _get_data_size(header):
+    """
+    :return: The size, in bytes, of the data that follows a header,
+        before padding, as given by the FITS standard.
+    """
+    naxis = header.get('NAXIS', 0)
+    if naxis == 0:
+        return 0
+    first = 1
+    if header.get('NAXIS1') == 0 and header.get('GROUPS'):
+        # random groups
+        first = 2
+    elements = 1
+    for ii in range(first, naxis + 1):
+        elements *= header.get('NAXIS{}'.format(ii), 0)
+    return (abs(header.get('BITPIX', 8)) // 8 * header.get('GCOUNT', 1) *
+            (header.get('PCOUNT', 0) + elements))
+
+
+def _round_up(n):
+    return (n + BLOCK_SIZE - 1) // BLOCK_SIZE * BLOCK_SIZE
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2018.                            (c) 2018.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#  $Revision: 4 $
+#
+# ***********************************************************************
+#
+"""
+Wall time, call counts, counters and latency percentiles for the stages
+of creating an observation, written to a metrics file so that it is
+possible to see where the time goes without attaching a profiler.
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+__all__ = ['Metrics', 'write_metrics']
+
+JSON_LINES = 'jsonl'
+PROMETHEUS = 'prometheus'
+PROMETHEUS_PREFIX = 'cgps2caom2'
+PERCENTILES = [50, 90, 99]
+
+
+class Metrics(object):
+    """
+    The metrics for one observation, or for a run of many observations.
+
+    Stages may be timed from more than one thread at once, e.g. while
+    headers are prefetched, so the time for a stage is the total time spent
+    in its calls, which can be more than the wall time.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # stage name: [calls, seconds]
+        self.stages = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+        # name: list of values
+        self.samples = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """
+        Time one call of a stage, including calls that fail.
+
+        :param stage: The name of the stage.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def add_time(self, stage, seconds):
+        with self._lock:
+            totals = self.stages.setdefault(stage, [0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+
+    def count(self, name, value=1):
+        """
+        :param name: The name of the counter.
+        :param value: How much to add to the counter.
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        """
+        :param name: The name of what is measured, e.g. the seconds a
+            request takes.
+        :param value: One measurement, for the percentiles.
+        """
+        with self._lock:
+            self.samples.setdefault(name, []).append(value)
+
+    def add(self, other):
+        """
+        Add the stage times, counters and measurements of other metrics, e.g.
+        those of one observation of a run, to these.
+
+        :param other: Metrics.
+        """
+        with other._lock:
+            stages = [(stage, list(totals))
+                      for stage, totals in other.stages.items()]
+            counters = list(other.counters.items())
+            samples = [(name, list(values))
+                       for name, values in other.samples.items()]
+        with self._lock:
+            for stage, (calls, seconds) in stages:
+                totals = self.stages.setdefault(stage, [0, 0.0])
+                totals[0] += calls
+                totals[1] += seconds
+            for name, value in counters:
+                self.counters[name] = self.counters.get(name, 0) + value
+            for name, values in samples:
+                self.samples.setdefault(name, []).extend(values)
+
+    def __getstate__(self):
+        # metrics are returned from the processes of a batch
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def as_dict(self):
+        with self._lock:
+            return {'stages': collections.OrderedDict(
+                        (stage, {'calls': calls, 'seconds': seconds})
+                        for stage, (calls, seconds) in self.stages.items()),
+                    'counters': collections.OrderedDict(self.counters),
+                    'percentiles': collections.OrderedDict(
+                        (name, _get_percentiles(values))
+                        for name, values in self.samples.items())}
+
+
+def _get_percentiles(values):
+    """
+    :return: dict of the count, PERCENTILES, by the nearest-rank method, and
+        maximum of the values.
+    """
+    values = sorted(values)
+    result = collections.OrderedDict([('count', len(values))])
+    for percentile in PERCENTILES:
+        rank = max(1, -(-percentile * len(values) // 100))
+        result['p{}'.format(percentile)] = values[rank - 1]
+    result['max'] = values[-1]
+    return result
+
+
+def write_metrics(fname, metrics, labels, metrics_format=None, start=None):
+    """
+    Write the metrics for one observation, or for a run of many
+    observations.
+
+    As JSON lines, one line is appended to the file each time. As a
+    Prometheus textfile, the file is replaced, so it holds the most recent
+    metrics. A run of many observations adds up the metrics of the
+    observations, and writes them once, at the end.
+
+    :param fname: The metrics file.
+    :param metrics: Metrics for the observation, or the run.
+    :param labels: dict of what the metrics are for, e.g. the
+        observationID. The labels of a Prometheus textfile should not
+        change from one run to the next, so that each run does not make new
+        time series.
+    :param metrics_format: JSON_LINES or PROMETHEUS. If None, PROMETHEUS for
+        files named *.prom, and JSON_LINES otherwise.
+    :param start: When the observation, or the run, started, in seconds
+        since the epoch, if known.
+    """
+    if metrics_format is None:
+        metrics_format = (PROMETHEUS if fname.endswith('.prom')
+                          else JSON_LINES)
+    if metrics_format == PROMETHEUS:
+        _write_prometheus(fname, metrics, labels, start)
+    else:
+        _write_json_line(fname, metrics, labels, start)
+
+
+def _write_json_line(fname, metrics, labels, start):
+    content = collections.OrderedDict(labels)
+    if start is not None:
+        content['start'] = time.strftime('%Y-%m-%dT%H:%M:%S',
+                                         time.gmtime(start))
+    content.update(metrics.as_dict())
+    line = '{}\n'.format(json.dumps(content))
+    # one write per line, so lines from processes that share the file are
+    # not interleaved
+    fd = os.open(fname, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line.encode('utf-8'))
+    finally:
+        os.close(fd)
+
+
+def _write_prometheus(fname, metrics, labels, start):
+    values = metrics.as_dict()
+    lines = []
+
+    def _add(name, help_text, samples):
+        metric = '{}_{}'.format(PROMETHEUS_PREFIX, name)
+        lines.append('# HELP {} {}'.format(metric, help_text))
+        lines.append('# TYPE {} gauge'.format(metric))
+        for extra, value in samples:
+            sample_labels = collections.OrderedDict(labels)
+            sample_labels.update(extra)
+            if sample_labels:
+                lines.append('{}{{{}}} {}'.format(
+                    metric, _format_labels(sample_labels), value))
+            else:
+                lines.append('{} {}'.format(metric, value))
+
+    stages = values['stages']
+    _add('stage_seconds', 'Time spent in each stage of the run.',
+         [({'stage': stage}, totals['seconds'])
+          for stage, totals in stages.items()])
+    _add('stage_calls', 'Calls of each stage of the run.',
+         [({'stage': stage}, totals['calls'])
+          for stage, totals in stages.items()])
+    for name, value in values['counters'].items():
+        _add(name, 'The {} counter for the run.'.format(name),
+             [({}, value)])
+    for name, percentiles in values['percentiles'].items():
+        _add(name, 'Percentiles of {} for the run.'.format(name),
+             [({'quantile': percentile / 100},
+               percentiles['p{}'.format(percentile)])
+              for percentile in PERCENTILES] +
+             [({'quantile': 1.0}, percentiles['max'])])
+        _add('{}_count'.format(name),
+             'The number of {} measurements for the run.'.format(name),
+             [({}, percentiles['count'])])
+    if start is not None:
+        _add('start_timestamp_seconds', 'When the run started.',
+             [({}, start)])
+    _add('last_run_timestamp_seconds', 'When the run ended.',
+         [({}, time.time())])
+
+    temp_fname = '{}.{}.tmp'.format(fname, os.getpid())
+    with open(temp_fname, 'w') as f:
+        f.write('\n'.join(lines))
+        f.write('\n')
+    os.rename(temp_fname, fname)
+
+
+def _format_labels(labels):
+    return ','.join(
+        '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n'))
+        for key, value in labels.items())
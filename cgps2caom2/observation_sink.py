@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2018.                            (c) 2018.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#  $Revision: 4 $
+#
+# ***********************************************************************
+#
+"""
+An append-only container for many observations, so that a batch run does
+not write, and a loader does not open, one small XML file per observation.
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import collections
+import io
+import logging
+import os
+import tarfile
+import time
+
+
+__all__ = ['ObservationSink', 'read_index', 'read_observations']
+
+# Where an observation is in the container. offset is the byte offset of
+# the observation XML, and size its length in bytes.
+IndexEntry = collections.namedtuple(
+    'IndexEntry', 'collection observation_id offset size')
+
+
+def _get_index_name(fname):
+    return '{}.index'.format(fname)
+
+
+def read_index(fname):
+    """
+    :param fname: The container file.
+    :return: list of IndexEntry, in the order the observations were
+        appended. An observation that was appended more than once has an
+        entry each time.
+    """
+    return _read_index(fname)[0]
+
+
+def _read_index(fname):
+    """
+    :return: a tuple of (list of IndexEntry, length of the index up to the
+        end of the last complete entry)
+    """
+    index_name = _get_index_name(fname)
+    result = []
+    length = 0
+    if not os.path.exists(index_name):
+        return result, length
+    with open(index_name, 'rb') as f:
+        for line in f:
+            fields = line.decode('utf-8').rstrip('\n').split('\t')
+            if not line.endswith(b'\n') or len(fields) != 4:
+                # the end of a run that did not finish
+                logging.warning('Ignoring incomplete entry {!r} in {}'.format(
+                    line, index_name))
+                break
+            result.append(IndexEntry(fields[0], fields[1], int(fields[2]),
+                                     int(fields[3])))
+            length += len(line)
+    return result, length
+
+
+def read_observations(fname):
+    """
+    Read all the observations in a container, in one sequential pass.
+
+    :param fname: The container file.
+    :return: generator of (IndexEntry, observation XML as bytes), for the
+        last time each observation was appended.
+    """
+    latest = collections.OrderedDict()
+    for entry in read_index(fname):
+        latest[(entry.collection, entry.observation_id)] = entry
+    with open(fname, 'rb') as f:
+        for entry in sorted(latest.values(), key=lambda e: e.offset):
+            f.seek(entry.offset)
+            yield entry, f.read(entry.size)
+
+
+class ObservationSink(object):
+    """
+    Observation XML appended to one tar file, with an index of byte offsets
+    in the file of the same name with an .index suffix. Each line of the
+    index is:
+
+        collection<TAB>observationID<TAB>offset<TAB>size
+
+    The tar framing means that standard tools can list and extract the
+    observations. The index means that a loader can read them without
+    parsing the tar headers.
+
+    Appending an observation that is already in the container adds a new
+    copy, and the index entry for the new copy supersedes the old one.
+
+    The index is written after the observation, so anything after the last
+    observation in the index, e.g. from a run that did not finish, is
+    discarded when the container is opened again.
+
+    Only one process at a time may append to a container.
+    """
+
+    def __init__(self, fname):
+        """
+        :param fname: The container file. Created if it does not exist.
+        """
+        self.fname = fname
+        self.entries = collections.OrderedDict()
+        entries, length = _read_index(fname)
+        end = 0
+        for entry in entries:
+            self.entries[(entry.collection, entry.observation_id)] = entry
+            end = max(end, _round_up(entry.offset + entry.size))
+        # the index is trusted, so remove anything after its last entry
+        self._f = open(fname, 'r+b' if os.path.exists(fname) else 'wb')
+        self._f.seek(end)
+        self._f.truncate()
+        self._index = open(_get_index_name(fname), 'ab')
+        self._index.truncate(length)
+        self._tar = tarfile.open(fileobj=self._f, mode='w')
+
+    def __contains__(self, key):
+        """
+        :param key: tuple of (collection, observationID)
+        """
+        return key in self.entries
+
+    def append(self, collection, observation_id, data):
+        """
+        :param collection: CGPS or VGPS.
+        :param observation_id: The observationID.
+        :param data: The observation XML, as bytes.
+        :return: The IndexEntry for the observation.
+        """
+        info = tarfile.TarInfo('{}/{}.xml'.format(collection, observation_id))
+        info.size = len(data)
+        info.mtime = int(time.time())
+        start = self._tar.offset
+        self._tar.addfile(info, io.BytesIO(data))
+        # the tar header is followed by the data, and the data is padded to
+        # a whole number of blocks
+        offset = self._tar.offset - _round_up(info.size)
+        entry = IndexEntry(collection, observation_id, offset, info.size)
+        logging.debug('Appended {} at {} after {} bytes of tar header'.format(
+            observation_id, offset, offset - start))
+        self._f.flush()
+        self._index.write(
+            '{}\t{}\t{}\t{}\n'.format(*entry).encode('utf-8'))
+        self._index.flush()
+        self.entries[(collection, observation_id)] = entry
+        return entry
+
+    def close(self):
+        # writes the end-of-archive blocks, which are discarded if the
+        # container is opened again
+        self._tar.close()
+        self._f.close()
+        self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _round_up(size):
+    return -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2018.                            (c) 2018.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#  $Revision: 4 $
+#
+# ***********************************************************************
+#
+"""
+How hard to try to get the headers for a file from a service whose
+response times have a long tail, or that fails now and then.
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import logging
+import random
+import socket
+import time
+
+
+__all__ = ['RetryPolicy']
+
+# The HTTP statuses for which the same request may succeed later: the
+# service is overloaded, or briefly unavailable.
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+
+class RetryPolicy(object):
+    """
+    A deadline for each attempt, a bounded number of retries after a random
+    ("full jitter") exponential backoff, and, optionally, a second, hedged,
+    request for the same headers if the first takes longer than usual.
+
+    The deadline and the hedged requests are for the asyncio retrieval,
+    which can abandon a request. The retries are for both that and the
+    caom2utils retrieval.
+    """
+
+    def __init__(self, timeout=None, retries=0, backoff=0.1,
+                 max_backoff=10.0, hedge_after=None, seed=None):
+        """
+        :param timeout: Seconds to wait for each attempt, or None to wait as
+            long as it takes.
+        :param retries: How many times to try again after the first
+            attempt fails in a way that may not happen again.
+        :param backoff: Seconds, before the jitter, to wait before the first
+            retry. The wait doubles for each retry after that.
+        :param max_backoff: The most seconds, before the jitter, to wait
+            before a retry.
+        :param hedge_after: Seconds after which to send a second request for
+            the same headers, if there is no response to the first, and use
+            whichever response comes first. None for no hedged requests.
+        :param seed: For repeatable backoff.
+        """
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge_after = hedge_after
+        self._random = random.Random(seed)
+
+    def is_retryable(self, e):
+        """
+        :param e: Why an attempt failed.
+        :return: True if another attempt may succeed: for connection
+            failures, timeouts, and the RETRY_STATUSES. Other IOErrors,
+            e.g. a missing or unreadable file, happen again.
+        """
+        status = getattr(e, 'status', None)
+        if status is None:
+            # as for the exceptions from requests
+            status = getattr(getattr(e, 'response', None), 'status_code',
+                             None)
+        if status is not None:
+            return status in RETRY_STATUSES
+        if isinstance(e, (ConnectionError, TimeoutError, socket.timeout)):
+            return True
+        import requests
+        return isinstance(e, (requests.ConnectionError, requests.Timeout))
+
+    def get_delay(self, attempt):
+        """
+        :param attempt: The number of attempts that have failed so far, less
+            one.
+        :return: Seconds to wait before the next attempt.
+        """
+        return self._random.uniform(
+            0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def call(self, retrieve, metrics, description):
+        """
+        Call retrieve, and call it again for each retryable failure, up to
+        the number of retries.
+
+        :param retrieve: The function that gets the headers, or other
+            information. Takes no arguments.
+        :param metrics: Metrics to count the retries and failures in, and
+            to observe the header_seconds of each successful call in.
+        :param description: What is retrieved, for the log.
+        :return: What retrieve returns.
+        """
+        start = time.perf_counter()
+        attempt = 0
+        while True:
+            try:
+                result = retrieve()
+            except Exception as e:
+                if attempt >= self.retries or not self.is_retryable(e):
+                    metrics.count('header_failures')
+                    raise
+                delay = self.get_delay(attempt)
+                attempt += 1
+                metrics.count('header_retries')
+                logging.warning('Retry {} of {} for {} in {:.2f}s: {}'.format(
+                    attempt, self.retries, description, delay, e))
+                time.sleep(delay)
+            else:
+                metrics.observe('header_seconds', time.perf_counter() - start)
+                return result
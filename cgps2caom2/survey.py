@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2018.                            (c) 2018.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#  $Revision: 4 $
+#
+# ***********************************************************************
+#
+"""
+A synthetic CGPS/VGPS survey, made from the template headers in the data
+directory of the package, for load testing without the archive.
+
+Every telescope, band and content combination in NAME_REGEX is made for each
+target, including the fwhm catalog files. The files are header text dumps,
+which can be ingested with --local, or served by a HeaderService:
+
+    cgps_synthetic_survey ./survey --targets 200 --serve --latency 0.05 0.2
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+from cgps2caom2 import cgps2caom2 as cc
+from cgps2caom2.header_service import HeaderService
+
+import argparse
+import logging
+import os
+import re
+import time
+
+
+__all__ = ['generate_survey', 'get_name_combinations']
+
+# the headers of one observation per telescope, as for the tests, but
+# installed with the package
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                            'data')
+SUFFIX = '.header'
+
+# the fixtures have no VLA files, so the VLA headers are made from the
+# DRAO-ST headers for the same band
+VLA_TEMPLATES = {'.tb': ('DRAO-ST', 'hi_line', 'image'),
+                 '_cont.tb': ('DRAO-ST', '1420_mhz_i', 'image'),
+                 '_contincluded.tb': ('DRAO-ST', 'hi_line', 'image')}
+
+
+def get_name_combinations():
+    """
+    :return: list of (telescope, band, content) for every file name that
+        NAME_REGEX can match. The band is None for VLA files.
+    """
+    result = []
+    for telescope, regex in sorted(cc.NAME_REGEX.items()):
+        bands = _get_alternatives(regex, 'band') or [None]
+        for band in bands:
+            for content in _get_alternatives(regex, 'content'):
+                result.append((telescope, band, content))
+    return result
+
+
+def _get_alternatives(regex, group):
+    """
+    :return: The values a simple named group of alternatives, such as
+        (?P<band>1420_mhz_[iqu]|408_mhz), can match.
+    """
+    match = re.search(r'\(\?P<{}>([^)]*)\)'.format(group), regex)
+    if match is None:
+        return []
+    result = []
+    for alternative in match.group(1).split('|'):
+        alternative = alternative.replace('\\', '')
+        options = re.search(r'\[([^\]]+)\]', alternative)
+        if options is None:
+            result.append(alternative)
+        else:
+            for option in options.group(1):
+                result.append(alternative[:options.start()] + option +
+                              alternative[options.end():])
+    return result
+
+
+def generate_survey(output_dir, targets=100, vla_targets=None,
+                    fixtures_dir=FIXTURES_DIR):
+    """
+    Write the header text dumps for a synthetic survey.
+
+    :param output_dir: Where to write the dumps, as <file name>.header.
+    :param targets: How many CGPS targets, each of which has the DRAO-ST,
+        FCRAO and IRAS files.
+    :param vla_targets: How many VGPS targets. The same as targets if None.
+    :param fixtures_dir: Where to find the fixture directories.
+    :return: list of the file names in the survey, without the .header
+        suffix, in the order written.
+    """
+    vla_targets = targets if vla_targets is None else vla_targets
+    templates = _read_templates(fixtures_dir)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    result = []
+    for telescope, band, content in get_name_combinations():
+        if telescope == 'VLA':
+            count = vla_targets
+            target_format = 'VGP{:04d}'
+            template_name, template = templates[VLA_TEMPLATES[content]]
+            if template is not None:
+                template = _make_vla_header(template)
+            name_format = '{{}}{}'.format(content)
+        else:
+            count = targets
+            target_format = 'T{:04d}'
+            template_name, template = _find_template(
+                templates, telescope, band, content)
+            if (telescope, band, content) in templates:
+                # the same name as the fixture, with the case it has
+                name_format = re.sub(r'^(cgps_)([^_]+)(_)', r'\g<1>{}\g<3>',
+                                     template_name, flags=re.IGNORECASE)
+            else:
+                name_format = 'CGPS_{{}}_{}_{}{}'.format(
+                    band, content, '.txt' if content == 'fwhm' else '.fits')
+
+        # the targets are all the same width, so the header text is made
+        # once, and the target is substituted into it for each file
+        placeholder = '#' * len(target_format.format(0))
+        text = _make_text(template, placeholder)
+        for ii in range(count):
+            target = target_format.format(ii)
+            file_name = name_format.format(target)
+            fqn = os.path.join(output_dir, '{}{}'.format(file_name, SUFFIX))
+            with open(fqn, 'w') as f:
+                f.write(text.replace(placeholder, target))
+            result.append(file_name)
+    logging.info('Wrote {} files to {}.'.format(len(result), output_dir))
+    return result
+
+
+def _read_templates(fixtures_dir):
+    """
+    :return: dict of (file name, header text or None for files without
+        headers), keyed by (telescope, band, content).
+    """
+    from astropy.io import fits
+    result = {}
+    for root, dirs, files in os.walk(fixtures_dir):
+        for name in sorted(files):
+            if not name.endswith(SUFFIX):
+                continue
+            file_name = name[:-len(SUFFIX)]
+            c = cc.classify_file_id(file_name.lower())
+            if c.telescope is None:
+                continue
+            header = None
+            if c.content != 'fwhm':
+                with open(os.path.join(root, name)) as f:
+                    header = fits.Header.fromstring(f.read(), sep='\n')
+            result[(c.telescope, c.band, c.content)] = (file_name, header)
+    return result
+
+
+def _find_template(templates, telescope, band, content):
+    """
+    :return: The template for a combination, or, if there is no fixture
+        for it, the template for the same telescope and content, or for the
+        same telescope.
+    """
+    if (telescope, band, content) in templates:
+        return templates[(telescope, band, content)]
+    for match in [lambda k: k[0] == telescope and k[2] == content,
+                  lambda k: k[0] == telescope and k[2] != 'fwhm']:
+        for key in sorted(templates.keys()):
+            if match(key):
+                return templates[key]
+    raise ValueError('No fixture for {} {} {}'.format(telescope, band,
+                                                      content))
+
+
+def _make_vla_header(template):
+    header = template.copy()
+    header['INSTRUME'] = 'VLA'
+    header['ORIGIN'] = 'VGPS Consortium'
+    header['FREQ0'] = header.get('OBSFREQ', 1420405751.77)
+    return header
+
+
+def _make_text(template, target):
+    """
+    :return: The header text dump for a target.
+    """
+    if template is None:
+        # fwhm files are text, without headers
+        return 'xxx\n'
+    header = template.copy()
+    header['OBJECT'] = 'CGPS Mosaic {}'.format(target)
+    if 'ADC_AREA' in header:
+        header['ADC_AREA'] = target
+    return '{}\n'.format(
+        header.tostring(sep='\n', endcard=True, padding=False))
+
+
+def _get_survey_arg_parser():
+    parser = argparse.ArgumentParser(
+        description=('Write a synthetic CGPS/VGPS survey of header text '
+                     'dumps, and optionally serve it as the data service '
+                     'would.'))
+    parser.add_argument('output_dir', help='where to write the survey')
+    parser.add_argument('--targets', type=int, default=100,
+                        help='how many CGPS targets')
+    parser.add_argument('--vla_targets', type=int,
+                        help='how many VGPS targets, if not --targets')
+    parser.add_argument('--serve', action='store_true',
+                        help=('serve the survey headers until interrupted, '
+                              'for use with --data_url'))
+    parser.add_argument('--port', type=int, default=0,
+                        help='port to serve on, instead of any free port')
+    parser.add_argument('--latency', type=float, nargs='+', default=[0.0],
+                        help=('seconds to delay each response, or the '
+                              'minimum and maximum of a random delay'))
+    parser.add_argument('--error_rate', type=float, default=0.0,
+                        help='fraction of requests that fail with a 503')
+    parser.add_argument('--reset_rate', type=float, default=0.0,
+                        help=('fraction of requests for which the '
+                              'connection is closed without a response'))
+    parser.add_argument('--tail_rate', type=float, default=0.0,
+                        help=('fraction of requests that are delayed by '
+                              '--tail_latency instead'))
+    parser.add_argument('--tail_latency', type=float, default=0.0,
+                        help='seconds to delay the --tail_rate responses')
+    parser.add_argument('--seed', type=int,
+                        help='for repeatable delays and failures')
+    return parser
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = _get_survey_arg_parser().parse_args()
+    generate_survey(args.output_dir, args.targets, args.vla_targets)
+    if args.serve:
+        latency = (args.latency[0] if len(args.latency) == 1
+                   else tuple(args.latency[:2]))
+        service = HeaderService(args.output_dir, port=args.port,
+                                latency=latency, error_rate=args.error_rate,
+                                reset_rate=args.reset_rate,
+                                tail_rate=args.tail_rate,
+                                tail_latency=args.tail_latency,
+                                seed=args.seed)
+        with service:
+            logging.info('Serving {} at {}'.format(args.output_dir,
+                                                   service.base_url))
+            try:
+                while True:
+                    time.sleep(60)
+            except KeyboardInterrupt:
+                pass
+        logging.info('Served {} requests, {} errors, {} resets.'.format(
+            service.requests, service.errors, service.resets))
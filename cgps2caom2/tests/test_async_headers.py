@@ -0,0 +1,124 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+from astropy.io import fits
+
+from cgps2caom2 import AsyncHeaderClient, DiskHeaderCache
+from cgps2caom2 import HeaderRequestError, HeaderTimeoutError, Metrics
+from cgps2caom2 import RetryPolicy
+from cgps2caom2 import retrieve_headers
+from cgps2caom2.header_service import HeaderService
+
+import asyncio
+import os
+import pytest
+import time
+
+
+THIS_DIR = os.path.dirname(os.path.realpath(__file__))
+TEST_DIR = os.path.join(THIS_DIR, 'data', 'MD1_IRAS')
+
+
+def _get_uris():
+    return ['ad:CGPS/{}'.format(name.split('.header')[0]) for name in
+            sorted(os.listdir(TEST_DIR)) if name.endswith('fits.header')]
+
+
+def test_retrieve_headers():
+    uris = _get_uris()
+    with HeaderService(TEST_DIR) as service:
+        result = retrieve_headers(uris, base_url=service.base_url,
+                                  max_connections=2)
+        assert service.requests == len(uris)
+        assert service.connections <= 2, 'connections should be re-used'
+
+    assert list(result.keys()) == uris
+    for uri in uris:
+        expected = fits.Header.fromfile(
+            os.path.join(TEST_DIR, '{}.header'.format(uri.split('/')[1])),
+            sep='\n', endcard=False, padding=False)
+        assert len(result[uri]) == 1
+        assert result[uri][0] == expected, uri
+
+
+def test_retrieve_headers_cache(tmpdir):
+    uris = _get_uris()[:3]
+    cache = DiskHeaderCache(str(tmpdir))
+    with HeaderService(TEST_DIR) as service:
+        first = retrieve_headers(uris, base_url=service.base_url,
+                                 cache=cache)
+        # one HEAD and one GET for each URI
+        assert service.requests == 2 * len(uris)
+        second = retrieve_headers(uris, base_url=service.base_url,
+                                  cache=cache)
+        # only the HEAD requests
+        assert service.requests == 3 * len(uris)
+    assert cache.hits == len(uris)
+    for uri in uris:
+        assert first[uri][0] == second[uri][0]
+
+
+def test_not_found():
+
+    async def _get(base_url):
+        client = AsyncHeaderClient(base_url=base_url)
+        try:
+            return await client.get_headers('ad:CGPS/not_found.fits')
+        finally:
+            await client.close()
+
+    with HeaderService(TEST_DIR) as service:
+        with pytest.raises(HeaderRequestError) as e:
+            asyncio.run(_get(service.base_url))
+    assert e.value.status == 404
+
+
+def test_retrieve_headers_retries():
+    uris = _get_uris()
+    metrics = Metrics()
+    policy = RetryPolicy(retries=20, backoff=0.01, seed=1)
+    with HeaderService(TEST_DIR, error_rate=0.3, reset_rate=0.1,
+                       seed=1) as service:
+        result = retrieve_headers(uris, base_url=service.base_url,
+                                  max_connections=4, policy=policy,
+                                  metrics=metrics)
+    assert list(result.keys()) == uris
+    assert service.errors + service.resets > 0
+    counters = metrics.as_dict()['counters']
+    # a reset of a re-used connection is tried again on a new connection,
+    # before the policy retries
+    assert (service.errors <= counters['header_retries'] <=
+            service.errors + service.resets)
+    assert 'header_failures' not in counters
+    percentiles = metrics.as_dict()['percentiles']['header_seconds']
+    assert percentiles['count'] == len(uris)
+    assert 0 < percentiles['p50'] <= percentiles['p99'] <= percentiles['max']
+
+
+def test_retrieve_headers_timeout():
+    metrics = Metrics()
+    policy = RetryPolicy(timeout=0.1, retries=1, backoff=0.01)
+    with HeaderService(TEST_DIR, latency=1.0) as service:
+        with pytest.raises(HeaderTimeoutError):
+            retrieve_headers(_get_uris()[:1], base_url=service.base_url,
+                             policy=policy, metrics=metrics)
+    assert metrics.as_dict()['counters'] == {
+        'header_timeouts': 2, 'header_retries': 1, 'header_failures': 1}
+
+
+def test_retrieve_headers_hedged():
+    uris = _get_uris()[:1]
+    metrics = Metrics()
+    policy = RetryPolicy(hedge_after=0.1)
+    # with this seed, the first request is in the tail, and the second is not
+    with HeaderService(TEST_DIR, tail_rate=0.5, tail_latency=3.0,
+                       seed=1) as service:
+        start = time.time()
+        result = retrieve_headers(uris, base_url=service.base_url,
+                                  policy=policy, metrics=metrics)
+        elapsed = time.time() - start
+        assert service.requests == 2
+        assert service.tails == 1
+    assert elapsed < 1.0
+    assert len(result[uris[0]]) == 1
+    assert metrics.as_dict()['counters'] == {'header_hedges': 1}
@@ -0,0 +1,76 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+from cgps2caom2 import benchmark, classify_file_id, group_by_observation
+from cgps2caom2 import read_header_dump
+
+import os
+
+
+def test_make_synthetic_files(tmpdir):
+    file_names = benchmark.make_synthetic_files(100, str(tmpdir))
+    assert len(file_names) == 100
+    assert len(set(file_names)) == 100
+    groups, unmatched = group_by_observation(file_names)
+    assert unmatched == []
+    # 42 fixture files per target, in three observations
+    assert list(groups.keys())[:4] == [('CGPS', 'S00000_DRAO-ST'),
+                                       ('CGPS', 'S00000_FCRAO'),
+                                       ('CGPS', 'S00000_IRAS'),
+                                       ('CGPS', 'S00001_DRAO-ST')]
+    assert len(groups[('CGPS', 'S00000_IRAS')]) == 20
+    # no fwhm file without the image file it is derived from
+    names = set(os.path.basename(f) for f in file_names)
+    for name in names:
+        if '_fwhm' in name:
+            assert name.replace('_fwhm.txt', '_image.fits') in names
+
+    # the headers are for the new target
+    fname = [f for f in file_names if f.endswith(
+        'CGPS_S00001_CO_line_image.fits.header')][0]
+    headers = read_header_dump(fname)
+    assert headers[0]['ADC_AREA'] == 'S00001'
+    assert headers[0]['OBJECT'] == 'CGPS Mosaic S00001'
+    with open(fname) as f:
+        assert set(len(line.rstrip('\n')) for line in f) == {80}
+
+
+def test_classify_by_loop(tmpdir):
+    # the same classification as trying the NAME_REGEX values in turn
+    file_names = [os.path.basename(f) for f in
+                  benchmark.make_synthetic_files(100, str(tmpdir))]
+    file_names += ['CGPS_MC2_1420_MHz_Q_image.fits',
+                   'cgps_md1_100_um_fwhm.txt', 'ADEF012_contincluded.tb',
+                   'ADEF012_cont.tb.fits', 'cgps_ab.tb', 'CGPS_A1_cont.tb',
+                   'CGPS_T1_CO_LINE_BEAMS.fits', 'cgps_t1_060_um_wght.fits',
+                   'cgps_t1_408_um_image.fits', 'cgps_t1', 'cgps_', '',
+                   'not_a_cgps_file.fits']
+    for file_name in file_names:
+        assert classify_file_id(file_name) == \
+            benchmark.classify_by_loop(file_name), file_name
+
+
+def test_run_benchmarks(tmpdir):
+    results = benchmark.run_benchmarks(sizes=[10], repeat=1,
+                                       work_dir=str(tmpdir))
+    assert [(r['name'], r['stage']) for r in results] == \
+        [(name, stage)
+         for name in benchmark.FIXTURES + ['synthetic_10']
+         for stage in benchmark.STAGES]
+    assert all(r['best'] > 0 for r in results)
+
+    fname = os.path.join(str(tmpdir), 'results.json')
+    benchmark.write_results(results, fname)
+    assert benchmark.read_results(fname) == results
+
+
+def test_compare_results():
+    baseline = [{'name': 'MD1_IRAS', 'stage': 'draw', 'best': 1.0},
+                {'name': 'MD1_IRAS', 'stage': 'proc', 'best': 1.0}]
+    current = [{'name': 'MD1_IRAS', 'stage': 'draw', 'best': 1.1},
+               {'name': 'MD1_IRAS', 'stage': 'proc', 'best': 1.5},
+               {'name': 'synthetic_10', 'stage': 'proc', 'best': 1.0}]
+    result = benchmark.compare_results(baseline, current, threshold=0.2)
+    assert [(name, stage, regression)
+            for name, stage, before, after, ratio, regression in result] == \
+        [('MD1_IRAS', 'draw', False), ('MD1_IRAS', 'proc', True)]
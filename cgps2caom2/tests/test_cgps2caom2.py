@@ -4,12 +4,22 @@ from __future__ import (absolute_import, division, print_function,
 from astropy.io import fits
 
 from cgps2caom2 import main_app, draw_cgps_blueprint
+from cgps2caom2 import HeaderStore, ObservationContext, group_by_observation
+from cgps2caom2 import classify_file_id, run_observation, triage
+from cgps2caom2 import DiskHeaderCache
+import cgps2caom2.cgps2caom2 as cgps2caom2_module
 from caom2 import ObservationReader
 from caom2.diff import get_differences
 
+import cadcdata
+import caom2utils
+
+import json
+import logging
 import os
 import pytest
 import sys
+import uuid
 
 
 TEST_URI = 'ad:CGPS/CGPS_MC2_1420_MHz_I_image.fits'
@@ -36,6 +46,55 @@ def test_draw():
     assert test_blueprint._plan['Plane.provenance.lastExecuted'] == (
         ['DATE-FTS'], None)
 
+
+def test_draw_template():
+    hdr1 = fits.Header()
+    hdr1['INSTRUME'] = 'TEST'
+    hdr1['ADC_AREA'] = 'MC2'
+    hdr2 = fits.Header()
+    hdr2['INSTRUME'] = 'TEST'
+    hdr2['ADC_AREA'] = 'MA1'
+    first = draw_cgps_blueprint(TEST_URI, [hdr1], local=False, cert=None)
+    second = draw_cgps_blueprint('ad:CGPS/CGPS_MA1_1420_MHz_I_image.fits',
+                                 [hdr2], local=False, cert=None)
+    assert first._plan['Observation.target.name'] == 'MC2'
+    assert second._plan['Observation.target.name'] == 'MA1'
+
+    # blueprints made from the same template are independent
+    first.add_fits_attribute('Chunk.energy.restfrq', 'RESTFRQ')
+    first.set('Chunk.energy.specsys', 'LSRK')
+    assert second._plan['Chunk.energy.restfrq'] == (['OBSFREQ'], None)
+    assert second._plan['Chunk.energy.specsys'] == 'TOPOCENT'
+    third = draw_cgps_blueprint(TEST_URI, [hdr1], local=False, cert=None)
+    assert third._plan['Chunk.energy.restfrq'] == (['OBSFREQ'], None)
+    assert third._plan['Chunk.energy.specsys'] == 'TOPOCENT'
+
+
+def test_draw_context():
+    hdr1 = fits.Header()
+    hdr1['INSTRUME'] = 'TEST'
+    hdr1['ADC_AREA'] = 'MD1'
+    hdr1['PUB_RELD'] = '2004-04-02'
+    store = HeaderStore()
+    store.get('ad:CGPS/CGPS_MD1_100_um_image.fits', lambda: [hdr1])
+    first = ObservationContext(store)
+    draw_cgps_blueprint(TEST_URI_FHWM, [], local=False, cert=None,
+                        context=first)
+    assert first.catalog_uri == TEST_URI_FHWM
+    assert first.max_release_date == '2004-04-02'
+    assert first.catalog_blueprint._get('Plane.provenance.inputs') == \
+        'caom:CGPS/MD1_IRAS/100um'
+
+    # nothing from the first observation is visible to the second
+    second = ObservationContext()
+    test_blueprint = draw_cgps_blueprint(TEST_URI, [hdr1], local=False,
+                                         cert=None, context=second)
+    assert second.catalog_uri is None
+    assert second.catalog_blueprint._get('Plane.provenance.inputs') is None
+    assert test_blueprint._plan['Observation.observationID'] == 'MD1_DRAO-ST'
+    assert first.catalog_blueprint._plan['Observation.observationID'] == \
+        'MD1_IRAS'
+
 # def test_time_max():
 #     hdr1 = fits.Header()
 #     hdr1['INSTRUME'] = 'TEST'
@@ -61,18 +120,357 @@ def test_draw():
 
 @pytest.mark.parametrize('test_name', ['MC2_DRAO-ST', 'MC2_FCRAO', 'MD1_IRAS'])
 def test_main_app(test_name):
+    _check_main_app(test_name, '')
+
+
+@pytest.mark.parametrize('test_name', ['MC2_DRAO-ST', 'MC2_FCRAO', 'MD1_IRAS'])
+def test_main_app_prefetch(test_name):
+    _check_main_app(test_name, '--prefetch_workers 4')
+
+
+def test_classify_file_id():
+    result = classify_file_id('CGPS_MC2_1420_MHz_Q_image.fits')
+    assert result.telescope == 'DRAO-ST'
+    assert result.collection == 'CGPS'
+    assert result.target == 'mc2'
+    assert result.band == '1420_mhz_q'
+    assert result.content == 'image'
+    assert result.product_id == '1420MHz-QU'
+    assert result.bandpass_name == '1420 MHz'
+
+    result = classify_file_id('cgps_md1_100_um_fwhm.txt')
+    assert (result.telescope, result.product_id, result.content) == \
+        ('IRAS', '100um', 'fwhm')
+
+    result = classify_file_id('ADEF012_contincluded.tb')
+    assert (result.telescope, result.collection, result.target,
+            result.band, result.product_id) == \
+        ('VLA', 'VGPS', 'adef012', None, '21cm-lineWithCont')
+
+    result = classify_file_id('not_a_cgps_file.fits')
+    assert result.telescope is None
+    assert result.product_id is None
+
+
+def test_group_by_observation():
+    file_names = []
+    for test_name in ['MC2_DRAO-ST', 'MC2_FCRAO', 'MD1_IRAS']:
+        location = os.path.join(TESTDATA_DIR, test_name)
+        file_names += [os.path.join(location, name) for name in
+                       os.listdir(location) if name.endswith('header')]
+    file_names.append('/tmp/not_a_cgps_file.fits')
+    groups, unmatched = group_by_observation(file_names)
+    assert unmatched == ['/tmp/not_a_cgps_file.fits']
+    assert list(groups.keys()) == [('CGPS', 'MC2_DRAO-ST'),
+                                   ('CGPS', 'MC2_FCRAO'),
+                                   ('CGPS', 'MD1_IRAS')]
+    assert len(groups[('CGPS', 'MC2_DRAO-ST')]) == 20
+    assert len(groups[('CGPS', 'MC2_FCRAO')]) == 2
+    assert len(groups[('CGPS', 'MD1_IRAS')]) == 20
+
+    groups, unmatched = group_by_observation(['ADEF012.tb'])
+    assert list(groups.keys()) == [('VGPS', 'ADEF012_VLA')]
+
+
+def test_triage():
+    location = os.path.join(TESTDATA_DIR, 'MD1_IRAS')
+    file_names = [os.path.join(location, name) for name in
+                  sorted(os.listdir(location)) if name.endswith('header')]
+    report = triage(file_names)
+    assert list(report.groups.keys()) == [('CGPS', 'MD1_IRAS')]
+    assert report.unmatched == []
+    assert report.duplicates == {}
+    assert report.missing_images == {}
+
+    duplicate = '/tmp/CGPS_MD1_100_um_fwhm.txt'
+    no_image = 'CGPS_MC2_100_um_fwhm.txt.header'
+    report = triage(file_names + [duplicate, no_image, 'junk.fits'])
+    assert report.unmatched == ['junk.fits']
+    assert report.duplicates == {
+        'CGPS_MD1_100_um_fwhm.txt': [
+            os.path.join(location, 'CGPS_MD1_100_um_fwhm.txt.header'),
+            duplicate]}
+    assert report.missing_images == {('CGPS', 'MC2_IRAS'): [no_image]}
+    assert len(report.groups[('CGPS', 'MD1_IRAS')]) == len(file_names) + 1
+
+    # the same file_id, whatever the case
+    report = triage(['CGPS_MD1_100_um_image.fits', 'cgps_md1_100_um_fwhm.txt',
+                     'cgps_md1_100_um_IMAGE.FITS'])
+    assert report.duplicates == {
+        'CGPS_MD1_100_um_image.fits': ['CGPS_MD1_100_um_image.fits',
+                                       'cgps_md1_100_um_IMAGE.FITS']}
+    # the image file is found with the case of the fwhm file name
+    assert report.missing_images == {
+        ('CGPS', 'MD1_IRAS'): ['cgps_md1_100_um_fwhm.txt']}
+
+
+def test_get_header_keywords():
+    result = cgps2caom2_module._get_header_keywords(TEST_URI)
+    assert {'INSTRUME', 'ADC_AREA', 'PUB_RELD', 'OBSFREQ', 'DATE-FTS',
+            'CRVAL4', 'CTYPE4'} <= result
+    assert 'FREQ0' not in result
+    result = cgps2caom2_module._get_header_keywords(
+        'ad:VGPS/ADEF012_contincluded.tb')
+    assert 'FREQ0' in result
+    assert cgps2caom2_module._get_header_keywords(
+        'ad:CGPS/not_a_cgps_file.fits') is None
+
+
+def test_main_app_catalog_fallback(monkeypatch):
+    # the catalog plane information is applied by re-reading and re-writing
+    # the observation if it cannot be built in memory
+    monkeypatch.setattr(cgps2caom2_module, '_augment_observation',
+                        lambda args, blueprints: None)
+    _check_main_app('MD1_IRAS', '')
+
+
+def test_augment_observation_unsupported(monkeypatch):
+    # a caom2utils that does not know a blueprint element means the
+    # observation is built by proc instead
+    def _gen_obs(*args):
+        raise KeyError('DerivedObservation.members')
+
+    monkeypatch.setattr(caom2utils.fits2caom2, '_gen_obs', _gen_obs,
+                        raising=False)
+    args = cgps2caom2_module._get_cgps_arg_parser().parse_args(
+        ['--observation', 'CGPS', 'MC2_FCRAO', '-o', 'MC2_FCRAO.xml',
+         TEST_URI])
+    assert cgps2caom2_module._augment_observation(args, {}) is None
+
+
+def test_get_cadc_headers_subject(monkeypatch, tmpdir):
+    # the certificate is passed to caom2utils as a Subject
+    cert = str(tmpdir.join('cadcproxy.pem'))
+    with open(cert, 'w') as f:
+        f.write('')
+    subjects = []
+
+    def _get_cadc_headers(uri, subject=None):
+        subjects.append(subject)
+        return []
+
+    monkeypatch.setattr(caom2utils, 'get_cadc_headers', _get_cadc_headers,
+                        raising=False)
+    cgps2caom2_module._retrieve_headers(TEST_URI, None, cert)
+    assert subjects[0].certificate == cert
+
+
+def test_run_observation_warm_cache(monkeypatch, tmpdir):
+    # caom2utils is given the headers the blueprints are drawn from, so with
+    # a warm cache, no headers are retrieved from the archive at all
+    local_files = _get_local_files('MC2_FCRAO')
+    calls = _patch_archive(monkeypatch, local_files)
+    cache = DiskHeaderCache(str(tmpdir.join('cache')))
+    actual_file_name = str(tmpdir.join('MC2_FCRAO.xml'))
+    for ignore in range(2):
+        run_observation('CGPS', 'MC2_FCRAO', sorted(local_files),
+                        actual_file_name, cache=cache)
+    assert sorted(calls) == sorted(
+        'ad:CGPS/{}'.format(file_id) for file_id in local_files)
+    actual = _read_obs(actual_file_name)
+    for file_id, file_name in local_files.items():
+        artifact = actual.planes['CO-line'].artifacts[
+            'ad:CGPS/{}'.format(file_id)]
+        assert artifact.content_length == os.path.getsize(file_name)
+        assert artifact.content_checksum.uri == 'md5:{}'.format(file_id)
+
+
+def test_run_observation_logging(monkeypatch, tmpdir):
+    # proc sets up the root logger every time it is called, which must not
+    # change the logging of the code that calls run_observation
+    local_files = _get_local_files('MC2_FCRAO')
+    _patch_archive(monkeypatch, local_files)
+    logger = logging.getLogger()
+    handler = logging.NullHandler()
+    monkeypatch.setattr(logger, 'handlers', [handler])
+    monkeypatch.setattr(logger, 'level', logging.INFO)
+    run_observation('CGPS', 'MC2_FCRAO', sorted(local_files),
+                    str(tmpdir.join('MC2_FCRAO.xml')))
+    assert logger.handlers == [handler]
+    assert logger.level == logging.INFO
+
+
+def _get_local_files(name):
+    """
+    :return: dict of the files of the test observation, keyed by file_id.
+    """
+    location = os.path.join(TESTDATA_DIR, name)
+    local_files = {}
+    for file_name in os.listdir(location):
+        if file_name.endswith('header'):
+            local_files[file_name.split('.header')[0]] = os.path.join(
+                location, file_name)
+    return local_files
+
+
+def _patch_archive(monkeypatch, local_files):
+    """
+    Get the headers and the file information of the ad: URIs from the local
+    files.
+
+    :return: list of the URIs that headers are retrieved for.
+    """
+    calls = []
+    get_cadc_headers = caom2utils.fits2caom2.get_cadc_headers
+
+    def _get_cadc_headers(uri, subject=None):
+        if not uri.startswith('ad:'):
+            # the header dumps
+            return get_cadc_headers(uri, subject)
+        calls.append(uri)
+        return cgps2caom2_module._read_local_headers(
+            local_files[uri.split('/')[-1]])
+
+    class _DataClient(object):
+        def __init__(self, subject):
+            pass
+
+        def get_file_info(self, archive, file_id):
+            return {'size': os.path.getsize(local_files[file_id]),
+                    'md5sum': 'md5:{}'.format(file_id),
+                    'type': 'application/fits'}
+
+    monkeypatch.setattr(caom2utils, 'get_cadc_headers', _get_cadc_headers,
+                        raising=False)
+    monkeypatch.setattr(caom2utils.fits2caom2, 'get_cadc_headers',
+                        _get_cadc_headers, raising=False)
+    monkeypatch.setattr(cadcdata, 'CadcDataClient', _DataClient)
+    monkeypatch.setattr(caom2utils.fits2caom2, 'CadcDataClient', _DataClient,
+                        raising=False)
+    return calls
+
+
+@pytest.mark.parametrize('reverse', [False, True])
+def test_main_app_file_order(reverse):
+    # the release dates of the DRAO-ST files differ, and the release dates
+    # of all the planes are the latest of them, whatever the file order
+    _check_main_app('MC2_DRAO-ST', '', sorted_names=True, reverse=reverse)
+
+
+def test_main_app_metrics(tmpdir):
+    metrics_file = os.path.join(str(tmpdir), 'metrics.jsonl')
+    _check_main_app('MD1_IRAS', '--metrics_file {}'.format(metrics_file))
+    with open(metrics_file) as f:
+        lines = [json.loads(line) for line in f]
+    assert len(lines) == 1
+    assert lines[0]['observation'] == 'MD1_IRAS'
+    assert lines[0]['status'] == 'ok'
+    stages = lines[0]['stages']
+    assert stages['draw_cgps_blueprint']['calls'] == 20
+    assert stages['_get_headers']['calls'] >= 20
+    assert '_write_obs' in stages
+    counters = lines[0]['counters']
+    assert counters['files'] == 20
+    assert counters['bytes_read'] > 0
+    # the image headers are re-used for the fwhm files
+    assert counters['store_hits'] > 0
+
+
+def test_main_app_skip_unchanged(tmpdir):
+    metrics_file = os.path.join(str(tmpdir), 'metrics.jsonl')
+    options = '--skip_unchanged --metrics_file {}'.format(metrics_file)
+    _check_main_app('MC2_FCRAO', options)
+    actual_file_name = os.path.join(TESTDATA_DIR, 'MC2_FCRAO',
+                                    'MC2_FCRAO.actual.xml')
+    mtime = os.path.getmtime(actual_file_name)
+    _check_main_app('MC2_FCRAO', options)
+    assert os.path.getmtime(actual_file_name) == mtime
+    with open(metrics_file) as f:
+        counters = [json.loads(line)['counters'] for line in f]
+    assert counters[-1]['observations_unchanged'] == 1
+    assert 'observations_changed' not in counters[-1]
+
+
+def test_carry_over_ids():
+    fname = os.path.join(TESTDATA_DIR, 'MC2_FCRAO', 'MC2_FCRAO.xml')
+    previous = _read_obs(fname)
+    # the same observation, as if it were created again, with new ids
+    observation = _read_obs(fname)
+    for entity in _get_entities(observation):
+        entity._id = uuid.uuid4()
+    assert not cgps2caom2_module._is_unchanged(previous, observation)
+
+    cgps2caom2_module._carry_over_ids(previous, observation)
+    assert ([entity._id for entity in _get_entities(observation)] ==
+            [entity._id for entity in _get_entities(previous)])
+    assert cgps2caom2_module._is_unchanged(previous, observation)
+
+    plane = observation.planes['CO-line']
+    plane.data_product_type = None
+    assert not cgps2caom2_module._is_unchanged(previous, observation)
+
+
+def _get_entities(observation):
+    yield observation
+    for plane in observation.planes.values():
+        yield plane
+        for artifact in plane.artifacts.values():
+            yield artifact
+            for part in artifact.parts.values():
+                yield part
+                for chunk in part.chunks:
+                    yield chunk
+
+
+def test_main_app_local_directory():
+    _check_main_app('MD1_IRAS', '', local='directory')
+
+
+def test_main_app_local_order():
+    # the --local files do not have to be in the same order as the fileURIs
+    _check_main_app('MC2_DRAO-ST', '', sorted_names=True, local='reverse')
+
+
+@pytest.mark.parametrize('option', ['--header_timeout', '--hedge_after'])
+def test_async_options(option, capsys):
+    argv = ['--observation', 'CGPS', 'MD1_IRAS',
+            'ad:CGPS/CGPS_MD1_100_um_image.fits', option, '0.5']
+    with pytest.raises(SystemExit):
+        cgps2caom2_module._parse_cgps_args(argv)
+    assert '{} requires --async_connections'.format(option) in \
+        capsys.readouterr().err
+    args = cgps2caom2_module._parse_cgps_args(
+        argv + ['--async_connections', '4'])
+    assert args.async_connections == 4
+
+
+def test_make_local_index(tmpdir):
+    location = os.path.join(TESTDATA_DIR, 'MC2_FCRAO')
+    result = cgps2caom2_module._make_local_index([location])
+    assert 'CGPS_MC2_CO_line_image.fits' in result
+    assert result['CGPS_MC2_CO_line_flags.fits'] == os.path.join(
+        location, 'CGPS_MC2_CO_line_flags.fits.header')
+    assert cgps2caom2_module._make_local_index(result) is result
+
+    fname = os.path.join(str(tmpdir), 'CGPS_MD1_100_um_image.fits')
+    result = cgps2caom2_module._make_local_index([fname])
+    assert cgps2caom2_module._get_local_file(
+        'ad:CGPS/CGPS_MD1_100_um_image.fits', result) == fname
+    with pytest.raises(RuntimeError):
+        cgps2caom2_module._get_local_file(
+            'ad:CGPS/CGPS_MD1_100_um_beams.fits', result)
+
+
+def _check_main_app(test_name, options, sorted_names=False, reverse=False,
+                    local=None):
     location = os.path.join(TESTDATA_DIR, test_name)
     actual_file_name = os.path.join(
         location, '{}.actual.xml'.format(test_name))
-    files = ' '.join(
-        [os.path.join(location, name) for name in os.listdir(location) if
-         name.endswith('header')])
+    names = [name for name in os.listdir(location) if name.endswith('header')]
+    if sorted_names:
+        names = sorted(names, reverse=reverse)
+    if local == 'directory':
+        files = location
+    elif local == 'reverse':
+        files = ' '.join([os.path.join(location, name)
+                          for name in reversed(names)])
+    else:
+        files = ' '.join([os.path.join(location, name) for name in names])
     uris = ' '.join(
-        ['ad:CGPS/{}'.format(name.split('.header')[0]) for name in
-         os.listdir(location) if name.endswith('header')])
+        ['ad:CGPS/{}'.format(name.split('.header')[0]) for name in names])
     sys.argv = \
-        ('cgps2caom2 --local {} --observation CGPS {} -o {} {}'.
-         format(files, test_name, actual_file_name, uris)).split()
+        ('cgps2caom2 {} --local {} --observation CGPS {} -o {} {}'.
+         format(options, files, test_name, actual_file_name, uris)).split()
     main_app()
     expected = _read_obs(os.path.join(location, '{}.xml'.format(test_name)))
     actual = _read_obs(actual_file_name)
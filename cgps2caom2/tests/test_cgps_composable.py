@@ -0,0 +1,224 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+from caom2 import ObservationReader
+from caom2.diff import get_differences
+
+from cgps2caom2 import read_observations, run_batch, triage
+from cgps2caom2.cgps_composable import _init_worker, _write_triage_report
+from cgps2caom2.cgps_composable import make_worker_server, serve_requests
+import cgps2caom2.cgps_composable as cgps_composable_module
+
+import io
+import json
+import os
+import pytest
+import shutil
+import socket
+import threading
+import time
+
+
+THIS_DIR = os.path.dirname(os.path.realpath(__file__))
+TESTDATA_DIR = os.path.join(THIS_DIR, 'data')
+TEST_NAMES = ['MC2_DRAO-ST', 'MC2_FCRAO', 'MD1_IRAS']
+
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_run_batch(tmpdir, workers):
+    file_names = []
+    for test_name in TEST_NAMES:
+        location = os.path.join(TESTDATA_DIR, test_name)
+        file_names += [os.path.join(location, name) for name in
+                       os.listdir(location) if name.endswith('header')]
+
+    results = run_batch(file_names, str(tmpdir), local=True, workers=workers)
+    assert results == {test_name: None for test_name in TEST_NAMES}
+    for test_name in TEST_NAMES:
+        expected = _read_obs(
+            os.path.join(TESTDATA_DIR, test_name, '{}.xml'.format(test_name)))
+        actual = _read_obs(
+            os.path.join(str(tmpdir), '{}.xml'.format(test_name)))
+        result = get_differences(expected, actual, 'Observation')
+        assert not result, '\n'.join(result)
+
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_run_batch_metrics(tmpdir, workers):
+    file_names = []
+    for test_name in TEST_NAMES:
+        location = os.path.join(TESTDATA_DIR, test_name)
+        file_names += [os.path.join(location, name) for name in
+                       os.listdir(location) if name.endswith('header')]
+    output_dir = os.path.join(str(tmpdir), 'out')
+    os.mkdir(output_dir)
+    metrics_file = os.path.join(str(tmpdir), 'cgps2caom2.prom')
+
+    results = run_batch(file_names, output_dir, local=True, workers=workers,
+                        metrics_file=metrics_file)
+    assert results == {test_name: None for test_name in TEST_NAMES}
+    # one textfile for the run, with the metrics of all the observations
+    assert sorted(os.listdir(str(tmpdir))) == ['cgps2caom2.prom', 'out']
+    with open(metrics_file) as f:
+        content = f.read()
+    assert content.count('# TYPE cgps2caom2_files gauge') == 1
+    assert 'cgps2caom2_files {}\n'.format(len(file_names)) in content
+    assert 'cgps2caom2_observations_changed 3\n' in content
+    assert ('cgps2caom2_stage_calls{{stage="draw_cgps_blueprint"}} '
+            '{}\n'.format(len(file_names))) in content
+    assert 'observation=' not in content
+
+
+def test_run_batch_ledger(tmpdir):
+    data_dir = os.path.join(str(tmpdir), 'data')
+    os.mkdir(data_dir)
+    file_names = []
+    for test_name in TEST_NAMES:
+        location = os.path.join(TESTDATA_DIR, test_name)
+        for name in os.listdir(location):
+            if name.endswith('header'):
+                shutil.copy(os.path.join(location, name), data_dir)
+                file_names.append(os.path.join(data_dir, name))
+    output_dir = os.path.join(str(tmpdir), 'out')
+    os.mkdir(output_dir)
+    ledger_file = os.path.join(str(tmpdir), 'ledger.sqlite')
+
+    results = run_batch(file_names, output_dir, local=True,
+                        ledger_file=ledger_file)
+    assert results == {test_name: None for test_name in TEST_NAMES}
+    mtimes = _get_mtimes(output_dir)
+
+    # nothing has changed, so nothing is written
+    time.sleep(1)
+    results = run_batch(file_names, output_dir, local=True,
+                        ledger_file=ledger_file)
+    assert results == {test_name: None for test_name in TEST_NAMES}
+    assert _get_mtimes(output_dir) == mtimes
+
+    # only the observation with a changed file is written
+    changed = os.path.join(data_dir, 'CGPS_MC2_CO_line_flags.fits.header')
+    os.utime(changed, (time.time() + 10, time.time() + 10))
+    run_batch(file_names, output_dir, local=True, ledger_file=ledger_file)
+    actual = _get_mtimes(output_dir)
+    assert actual['MC2_FCRAO.xml'] != mtimes['MC2_FCRAO.xml']
+    assert actual['MC2_DRAO-ST.xml'] == mtimes['MC2_DRAO-ST.xml']
+    assert actual['MD1_IRAS.xml'] == mtimes['MD1_IRAS.xml']
+    # the serial run closes the ledger it opened
+    assert cgps_composable_module._worker_ledger is None
+
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_run_batch_sink(tmpdir, workers):
+    file_names = []
+    for test_name in TEST_NAMES:
+        location = os.path.join(TESTDATA_DIR, test_name)
+        file_names += [os.path.join(location, name) for name in
+                       os.listdir(location) if name.endswith('header')]
+    sink_file = os.path.join(str(tmpdir), 'observations.tar')
+    ledger_file = os.path.join(str(tmpdir), 'ledger.sqlite')
+
+    results = run_batch(file_names, str(tmpdir), local=True, workers=workers,
+                        ledger_file=ledger_file, sink_file=sink_file)
+    assert results == {test_name: None for test_name in TEST_NAMES}
+    # no XML file for each observation
+    assert sorted(os.listdir(str(tmpdir))) == [
+        'ledger.sqlite', 'observations.tar', 'observations.tar.index']
+    reader = ObservationReader(False)
+    actual = {}
+    for entry, data in read_observations(sink_file):
+        actual[entry.observation_id] = reader.read(io.BytesIO(data))
+    assert sorted(actual.keys()) == TEST_NAMES
+    for test_name in TEST_NAMES:
+        expected = _read_obs(
+            os.path.join(TESTDATA_DIR, test_name, '{}.xml'.format(test_name)))
+        result = get_differences(expected, actual[test_name], 'Observation')
+        assert not result, '\n'.join(result)
+
+    # the observations in the sink are not appended again
+    size = os.path.getsize(sink_file)
+    run_batch(file_names, str(tmpdir), local=True, workers=workers,
+              ledger_file=ledger_file, sink_file=sink_file)
+    assert os.path.getsize(sink_file) == size
+
+
+def test_init_worker_cache_size(tmpdir):
+    from cgps2caom2 import cgps_composable
+    _init_worker(str(tmpdir), cache_max_mb=10)
+    try:
+        assert cgps_composable._worker_cache.max_bytes == 10 * 1024 * 1024
+    finally:
+        _init_worker(None)
+
+
+def test_write_triage_report():
+    file_names = ['CGPS_MD1_100_um_image.fits', 'CGPS_MD1_100_um_fwhm.txt',
+                  'ADEF012.tb', 'CGPS_MC2_CO_line_image.fits']
+    out = io.StringIO()
+    assert _write_triage_report(triage(file_names), out) == 0
+    assert out.getvalue().startswith(
+        '4 files make up 3 observations (2 CGPS, 1 VGPS).\n')
+
+    out = io.StringIO()
+    assert _write_triage_report(
+        triage(file_names[1:] + ['/tmp/ADEF012.tb', 'junk.fits']), out) == 3
+    report = out.getvalue()
+    assert '  junk.fits\n' in report
+    assert '  ADEF012.tb: ADEF012.tb /tmp/ADEF012.tb\n' in report
+    assert '  CGPS MD1_IRAS: CGPS_MD1_100_um_fwhm.txt\n' in report
+
+
+def _ingest(name):
+    if name.startswith('bad'):
+        raise RuntimeError('cannot ingest {}'.format(name))
+
+
+def test_serve_requests():
+    output = []
+    failures = serve_requests(['MC2_FCRAO\n', '\n', 'bad_name\n',
+                               'CGPS_MD1_100_um_image.fits\n'],
+                              output.append, _ingest)
+    assert failures == 1
+    results = [json.loads(line) for line in output]
+    assert [(r['name'], r['status']) for r in results] == [
+        ('MC2_FCRAO', 'ok'), ('bad_name', 'failed'),
+        ('CGPS_MD1_100_um_image.fits', 'ok')]
+    assert results[1]['message'] == 'cannot ingest bad_name'
+    assert 'message' not in results[0]
+    assert all(r['seconds'] >= 0 for r in results)
+
+
+def test_worker_server(tmpdir):
+    path = os.path.join(str(tmpdir), 'worker.sock')
+    server = make_worker_server(path, _ingest)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        # one connection after another, with a result for each line
+        for names in [['MC2_FCRAO', 'bad_name'], ['MD1_IRAS']]:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+                s.connect(path)
+                f = s.makefile('rwb')
+                results = []
+                for name in names:
+                    f.write('{}\n'.format(name).encode('utf-8'))
+                    f.flush()
+                    results.append(json.loads(f.readline().decode('utf-8')))
+                f.close()
+            assert [(r['name'], r['status']) for r in results] == [
+                (name, 'failed' if name.startswith('bad') else 'ok')
+                for name in names]
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+def _get_mtimes(directory):
+    return {name: os.path.getmtime(os.path.join(directory, name))
+            for name in os.listdir(directory)}
+
+
+def _read_obs(fname):
+    assert os.path.exists(fname)
+    reader = ObservationReader(False)
+    return reader.read(fname)
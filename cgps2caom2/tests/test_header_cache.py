@@ -0,0 +1,201 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+from astropy.io import fits
+
+from cgps2caom2 import DiskHeaderCache, HeaderStore, project_headers
+from cgps2caom2.header_cache import LOCK_NAME, LOW_WATER
+
+import os
+import pytest
+import threading
+import time
+
+
+TEST_URI = 'ad:CGPS/CGPS_MD1_100_um_image.fits'
+
+THIS_DIR = os.path.dirname(os.path.realpath(__file__))
+TEST_HEADER = os.path.join(THIS_DIR, 'data', 'MD1_IRAS',
+                           'CGPS_MD1_100_um_image.fits.header')
+
+
+def test_header_store():
+    test_subject = HeaderStore()
+    calls = []
+
+    def _retrieve():
+        calls.append(1)
+        return ['test header']
+
+    assert test_subject.get(TEST_URI, _retrieve) == ['test header']
+    assert test_subject.get(TEST_URI, _retrieve) == ['test header']
+    assert TEST_URI in test_subject
+    assert len(calls) == 1, 'should only retrieve once'
+    assert test_subject.hits == 1
+    assert test_subject.misses == 1
+
+
+def test_header_store_in_flight():
+    test_subject = HeaderStore()
+    calls = []
+
+    def _retrieve():
+        calls.append(1)
+        time.sleep(0.2)
+        return ['test header']
+
+    results = []
+    threads = [threading.Thread(
+        target=lambda: results.append(test_subject.get(TEST_URI, _retrieve)))
+        for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1, 'concurrent requests should be merged'
+    assert results == [['test header']] * 5
+
+
+def test_header_store_failure():
+    test_subject = HeaderStore()
+
+    def _fail():
+        raise IOError('test failure')
+
+    with pytest.raises(IOError):
+        test_subject.get(TEST_URI, _fail)
+    assert TEST_URI not in test_subject, 'failures should not be kept'
+    assert test_subject.get(TEST_URI, lambda: []) == []
+
+
+def test_project_headers():
+    header = fits.Header.fromfile(TEST_HEADER, sep='\n', endcard=False,
+                                  padding=False)
+    header['PC1_2'] = 0.0
+    header['CTYPE1A'] = 'GLON-CAR'
+    header['PV2_1'] = 0.0
+    test_subject = project_headers([header, 'not a header'],
+                                   frozenset(['INSTRUME', 'PUB_RELD']))
+    assert test_subject[1] == 'not a header'
+    actual = test_subject[0]
+    assert actual['INSTRUME'] == header['INSTRUME']
+    assert actual['PUB_RELD'] == header['PUB_RELD']
+    for keyword in ['SIMPLE', 'BITPIX', 'NAXIS', 'NAXIS4', 'CTYPE1',
+                    'CRVAL4', 'CDELT2', 'CRPIX3', 'CROTA1', 'PC1_2',
+                    'CTYPE1A', 'PV2_1']:
+        assert actual[keyword] == header[keyword], keyword
+    for keyword in ['HISTORY', 'OBJECT', 'OBSERVER', 'DATAMIN']:
+        assert keyword in header
+        assert keyword not in actual, keyword
+    assert len(actual) < len(header) // 2
+
+
+def test_header_store_projection():
+    header = fits.Header()
+    header['INSTRUME'] = 'DRAO-ST'
+    header['NAXIS'] = 2
+    header['HISTORY'] = 'history'
+    keywords = {TEST_URI: frozenset(['INSTRUME'])}
+    test_subject = HeaderStore(projection=keywords.get)
+
+    actual = test_subject.get(TEST_URI, lambda: [header])
+    assert list(actual[0].keys()) == ['INSTRUME', 'NAXIS']
+    # no projection for this URI
+    actual = test_subject.get('ad:CGPS/other.fits', lambda: [header])
+    assert actual[0] is header
+
+
+def test_disk_header_cache(tmpdir):
+    headers = [fits.Header.fromfile(TEST_HEADER, sep='\n', endcard=False,
+                                    padding=False)]
+    test_subject = DiskHeaderCache(str(tmpdir))
+    assert test_subject.get(TEST_URI, '10:abc') is None
+    test_subject.put(TEST_URI, '10:abc', headers)
+
+    # a different instance, as for a later run
+    test_subject = DiskHeaderCache(str(tmpdir))
+    result = test_subject.get(TEST_URI, '10:abc')
+    assert result is not None
+    assert len(result) == 1
+    assert result[0]['ADC_AREA'] == headers[0]['ADC_AREA']
+    assert result[0]['NAXIS'] == 4
+    assert result[0]['CRVAL1'] == headers[0]['CRVAL1']
+
+    # the file changed
+    assert test_subject.get(TEST_URI, '11:def') is None, 'stale'
+    assert test_subject.get(TEST_URI, '10:abc') is None, 'stale is removed'
+
+    test_subject.put(TEST_URI, '10:abc', headers)
+    test_subject.invalidate(TEST_URI)
+    assert test_subject.get(TEST_URI, '10:abc') is None, 'invalidated'
+
+
+def test_disk_header_cache_eviction(tmpdir):
+    headers = [fits.Header.fromfile(TEST_HEADER, sep='\n', endcard=False,
+                                    padding=False)]
+    test_subject = DiskHeaderCache(str(tmpdir), max_bytes=3 * 80 * 90)
+    uris = ['ad:CGPS/test_{}.fits'.format(ii) for ii in range(4)]
+    for uri in uris[:3]:
+        test_subject.put(uri, 'x', headers)
+        time.sleep(0.01)
+    # uris[1] becomes the least-recently used entry
+    assert test_subject.get(uris[0], 'x') is not None
+    test_subject.put(uris[3], 'x', headers)
+    assert test_subject.get(uris[1], 'x') is None, 'should be evicted'
+    for uri in (uris[0], uris[2], uris[3]):
+        assert test_subject.get(uri, 'x') is not None, uri
+    assert test_subject.total_bytes <= 3 * 80 * 90 * LOW_WATER
+
+    test_subject.invalidate()
+    assert os.listdir(str(tmpdir)) == [LOCK_NAME]
+    assert test_subject.total_bytes == 0
+
+
+def test_disk_header_cache_eviction_low_water(tmpdir):
+    headers = [fits.Header.fromfile(TEST_HEADER, sep='\n', endcard=False,
+                                    padding=False)]
+    test_subject = DiskHeaderCache(str(tmpdir), max_bytes=10 * 80 * 90)
+    # the first put finds the total from the entries, as there is none yet
+    test_subject.put('ad:CGPS/test_0.fits', 'x', headers)
+    listed = []
+    entry_fqns = test_subject._entry_fqns
+
+    def _entry_fqns():
+        listed.append(True)
+        return entry_fqns()
+
+    test_subject._entry_fqns = _entry_fqns
+    for ii in range(1, 30):
+        test_subject.put('ad:CGPS/test_{}.fits'.format(ii), 'x', headers)
+        assert test_subject.total_bytes <= 10 * 80 * 90
+    # the entries are listed only when some are evicted, which is not on
+    # every put once the cache is full
+    assert 0 < len(listed) <= (30 - 10) // 2
+
+    # the counters are shared by threads
+    uris = ['ad:CGPS/test_{}.fits'.format(ii) for ii in range(30)] * 10
+    threads = [threading.Thread(
+        target=lambda: [test_subject.get(uri, 'x') for uri in uris])
+        for ii in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert test_subject.hits + test_subject.misses == 4 * len(uris)
+
+
+def test_disk_header_cache_shared(tmpdir):
+    # two caches on the same directory, as for two processes
+    headers = [fits.Header.fromfile(TEST_HEADER, sep='\n', endcard=False,
+                                    padding=False)]
+    first = DiskHeaderCache(str(tmpdir), max_bytes=3 * 80 * 90)
+    second = DiskHeaderCache(str(tmpdir), max_bytes=3 * 80 * 90)
+    for ii in range(2):
+        first.put('ad:CGPS/first_{}.fits'.format(ii), 'x', headers)
+        second.put('ad:CGPS/second_{}.fits'.format(ii), 'x', headers)
+    entries = [name for name in os.listdir(str(tmpdir))
+               if name.endswith('.header')]
+    assert len(entries) == 3
+    total = sum(os.path.getsize(os.path.join(str(tmpdir), name))
+                for name in entries)
+    assert first.total_bytes == second.total_bytes == total <= 3 * 80 * 90
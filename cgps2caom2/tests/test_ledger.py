@@ -0,0 +1,55 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+from cgps2caom2 import IngestLedger, get_input_fingerprints
+
+import os
+import time
+
+
+def test_ledger(tmpdir):
+    fname = os.path.join(str(tmpdir), 'ledger.sqlite')
+    inputs = {'ad:CGPS/CGPS_MC2_CO_line_image.fits': '100:abc',
+              'ad:CGPS/CGPS_MC2_CO_line_flags.fits': '200:def'}
+    with IngestLedger(fname) as test_subject:
+        assert not test_subject.is_unchanged('CGPS', 'MC2_FCRAO', inputs)
+        assert test_subject.get('CGPS', 'MC2_FCRAO') is None
+        test_subject.record('CGPS', 'MC2_FCRAO', inputs)
+        assert test_subject.is_unchanged('CGPS', 'MC2_FCRAO', inputs)
+        assert not test_subject.is_unchanged('VGPS', 'MC2_FCRAO', inputs)
+
+    # kept between runs
+    with IngestLedger(fname) as test_subject:
+        assert test_subject.is_unchanged('CGPS', 'MC2_FCRAO', inputs)
+        assert test_subject.get('CGPS', 'MC2_FCRAO')['inputs'] == inputs
+
+        # a changed, added or removed file
+        changed = dict(inputs)
+        changed['ad:CGPS/CGPS_MC2_CO_line_flags.fits'] = '200:xyz'
+        assert not test_subject.is_unchanged('CGPS', 'MC2_FCRAO', changed)
+        added = dict(inputs)
+        added['ad:CGPS/CGPS_MC2_CO_line_cube.fits'] = '300:ghi'
+        assert not test_subject.is_unchanged('CGPS', 'MC2_FCRAO', added)
+        removed = dict(inputs)
+        del removed['ad:CGPS/CGPS_MC2_CO_line_flags.fits']
+        assert not test_subject.is_unchanged('CGPS', 'MC2_FCRAO', removed)
+
+        test_subject.forget('CGPS', 'MC2_FCRAO')
+        assert not test_subject.is_unchanged('CGPS', 'MC2_FCRAO', inputs)
+        test_subject.record('CGPS', 'MC2_FCRAO', inputs)
+
+    # new blueprint rules
+    with IngestLedger(fname, rules_version='new') as test_subject:
+        assert not test_subject.is_unchanged('CGPS', 'MC2_FCRAO', inputs)
+
+
+def test_get_input_fingerprints(tmpdir):
+    fname = os.path.join(str(tmpdir), 'CGPS_MC2_CO_line_image.fits.header')
+    with open(fname, 'w') as f:
+        f.write('SIMPLE  =                    T\n')
+    first = get_input_fingerprints('CGPS', [fname], local=True)
+    assert list(first.keys()) == ['ad:CGPS/CGPS_MC2_CO_line_image.fits']
+    assert get_input_fingerprints('CGPS', [fname], local=True) == first
+
+    os.utime(fname, (time.time() + 10, time.time() + 10))
+    assert get_input_fingerprints('CGPS', [fname], local=True) != first
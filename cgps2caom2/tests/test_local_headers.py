@@ -0,0 +1,116 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+from astropy.io import fits
+
+from cgps2caom2 import is_fits_file, read_fits_headers
+from cgps2caom2 import is_header_dump, read_header_dump
+from cgps2caom2.header_cache import make_headers
+
+import numpy as np
+import os
+import pytest
+
+
+THIS_DIR = os.path.dirname(os.path.realpath(__file__))
+TESTDATA_DIR = os.path.join(THIS_DIR, 'data')
+
+
+def _check_headers(expected, actual):
+    assert len(expected) == len(actual)
+    for e, a in zip(expected, actual):
+        assert list(e.items()) == list(a.items())
+
+
+def test_read_fits_headers(tmpdir):
+    fname = os.path.join(str(tmpdir), 'CGPS_MC2_1420_MHz_I_image.fits')
+    primary = fits.PrimaryHDU(np.zeros((1, 1, 30, 40), dtype=np.float32))
+    primary.header['INSTRUME'] = 'DRAO-ST'
+    primary.header['OBSFREQ'] = 1420406000.0
+    primary.header['HISTORY'] = 'history'
+    table = fits.BinTableHDU.from_columns(
+        [fits.Column(name='flux', format='E', array=np.arange(5.0))])
+    fits.HDUList([primary, table, fits.ImageHDU()]).writeto(fname)
+
+    assert is_fits_file(fname)
+    with fits.open(fname) as hdulist:
+        expected = [hdu.header for hdu in hdulist]
+    actual = read_fits_headers(fname)
+    _check_headers(expected, actual)
+    assert actual[0]['INSTRUME'] == 'DRAO-ST'
+
+
+def test_read_fits_headers_large_cube(tmpdir):
+    # the data is never read, so it does not have to be there
+    fname = os.path.join(str(tmpdir), 'CGPS_MC2_HI_line_image.fits')
+    header = fits.Header()
+    header['SIMPLE'] = True
+    header['BITPIX'] = -32
+    header['NAXIS'] = 3
+    header['NAXIS1'] = 1024
+    header['NAXIS2'] = 1024
+    header['NAXIS3'] = 1024
+    header['INSTRUME'] = 'DRAO-ST'
+    with open(fname, 'wb') as f:
+        f.write(header.tostring().encode('ascii'))
+        f.truncate(len(header.tostring()) + 4 * 1024 ** 3)
+
+    actual = read_fits_headers(fname)
+    assert len(actual) == 1
+    assert actual[0]['NAXIS3'] == 1024
+    assert actual[0]['INSTRUME'] == 'DRAO-ST'
+
+
+def test_read_fits_headers_not_fits(tmpdir):
+    fname = os.path.join(TESTDATA_DIR, 'MD1_IRAS',
+                         'CGPS_MD1_100_um_image.fits.header')
+    assert not is_fits_file(fname)
+
+    fname = os.path.join(str(tmpdir), 'no_end.fits')
+    with open(fname, 'wb') as f:
+        f.write(b'SIMPLE  =                    T'.ljust(2880))
+    with pytest.raises(IOError):
+        read_fits_headers(fname)
+
+
+@pytest.mark.parametrize('test_name', ['MC2_DRAO-ST', 'MC2_FCRAO',
+                                       'MD1_IRAS'])
+def test_read_header_dump(test_name):
+    location = os.path.join(TESTDATA_DIR, test_name)
+    for name in os.listdir(location):
+        fname = os.path.join(location, name)
+        if not name.endswith('fits.header'):
+            assert not is_header_dump(fname)
+            continue
+        assert is_header_dump(fname)
+        assert not is_fits_file(fname)
+        with open(fname) as f:
+            expected = make_headers(f.read())
+        for header in expected:
+            for keyword in ['HISTORY', 'COMMENT', '']:
+                header.remove(keyword, ignore_missing=True, remove_all=True)
+        _check_headers(expected, read_header_dump(fname))
+
+
+def test_read_header_dump_extensions(tmpdir):
+    fname = os.path.join(str(tmpdir), 'CGPS_MC2_CO_line_image.fits.header')
+    with open(fname, 'w') as f:
+        f.write('SIMPLE  =                    T\r\n'
+                'NAXIS   =                    0   \r\n'
+                'HISTORY not needed\r\n'
+                'END\r\n'
+                'XTENSION= \'IMAGE   \'\r\n'
+                'INSTRUME= \'FCRAO   \'' + ' ' * 70 + '\r\n'
+                'END\r\n')
+    assert is_header_dump(fname)
+    actual = read_header_dump(fname)
+    assert len(actual) == 2
+    assert list(actual[0].keys()) == ['SIMPLE', 'NAXIS']
+    assert actual[1]['INSTRUME'] == 'FCRAO'
+
+    with open(fname, 'w') as f:
+        f.write('SIMPLE  =                    T\n'
+                'OBJECT  = \'{}\'\n'
+                'END\n'.format('x' * 80))
+    with pytest.raises(IOError):
+        read_header_dump(fname)
@@ -0,0 +1,111 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+from cgps2caom2 import Metrics, write_metrics
+
+import collections
+import json
+import os
+import pickle
+import pytest
+import threading
+
+
+LABELS = collections.OrderedDict([('collection', 'CGPS'),
+                                  ('observation', 'MD1_IRAS'),
+                                  ('status', 'ok')])
+
+
+def _make_metrics():
+    test_subject = Metrics()
+    with test_subject.timer('draw_cgps_blueprint'):
+        pass
+    with pytest.raises(ValueError):
+        with test_subject.timer('draw_cgps_blueprint'):
+            raise ValueError('timed anyway')
+    test_subject.count('bytes_read', 2880)
+    test_subject.count('bytes_read', 5760)
+    test_subject.count('cache_hits')
+    test_subject.observe('header_seconds', 0.25)
+    return test_subject
+
+
+def test_metrics():
+    test_subject = _make_metrics()
+    result = test_subject.as_dict()
+    assert result['stages']['draw_cgps_blueprint']['calls'] == 2
+    assert result['stages']['draw_cgps_blueprint']['seconds'] >= 0.0
+    assert result['counters'] == {'bytes_read': 8640, 'cache_hits': 1}
+
+    # stages timed from more than one thread
+    threads = [threading.Thread(target=lambda: test_subject.add_time(
+        '_get_headers', 0.5)) for ignore in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert test_subject.as_dict()['stages']['_get_headers'] == \
+        {'calls': 10, 'seconds': 5.0}
+
+
+def test_metrics_percentiles():
+    test_subject = Metrics()
+    for value in range(100, 0, -1):
+        test_subject.observe('header_seconds', value / 100)
+    assert test_subject.as_dict()['percentiles'] == {
+        'header_seconds': {'count': 100, 'p50': 0.5, 'p90': 0.9,
+                           'p99': 0.99, 'max': 1.0}}
+    test_subject.observe('one', 2.0)
+    assert test_subject.as_dict()['percentiles']['one'] == {
+        'count': 1, 'p50': 2.0, 'p90': 2.0, 'p99': 2.0, 'max': 2.0}
+
+
+def test_metrics_add():
+    test_subject = Metrics()
+    test_subject.add(_make_metrics())
+    # as returned from the process of a batch
+    test_subject.add(pickle.loads(pickle.dumps(_make_metrics())))
+    result = test_subject.as_dict()
+    assert result['stages']['draw_cgps_blueprint']['calls'] == 4
+    assert result['counters'] == {'bytes_read': 17280, 'cache_hits': 2}
+    assert result['percentiles']['header_seconds']['count'] == 2
+
+
+def test_write_metrics_json_lines(tmpdir):
+    fname = os.path.join(str(tmpdir), 'metrics.jsonl')
+    write_metrics(fname, _make_metrics(), LABELS, start=0)
+    write_metrics(fname, Metrics(), LABELS)
+    with open(fname) as f:
+        lines = [json.loads(line) for line in f]
+    assert len(lines) == 2
+    assert lines[0]['observation'] == 'MD1_IRAS'
+    assert lines[0]['start'] == '1970-01-01T00:00:00'
+    assert 'start' not in lines[1]
+    assert lines[0]['counters']['bytes_read'] == 8640
+    assert lines[0]['stages']['draw_cgps_blueprint']['calls'] == 2
+    assert lines[1]['stages'] == {}
+
+
+def test_write_metrics_prometheus(tmpdir):
+    fname = os.path.join(str(tmpdir), 'cgps2caom2.prom')
+    write_metrics(fname, Metrics(), LABELS)
+    write_metrics(fname, _make_metrics(), LABELS, start=1000.0)
+    with open(fname) as f:
+        content = f.read()
+    # the file is replaced, not appended to
+    assert content.count('# TYPE cgps2caom2_stage_calls gauge') == 1
+    assert ('cgps2caom2_stage_calls{collection="CGPS",'
+            'observation="MD1_IRAS",status="ok",'
+            'stage="draw_cgps_blueprint"} 2') in content
+    assert ('cgps2caom2_bytes_read{collection="CGPS",'
+            'observation="MD1_IRAS",status="ok"} 8640') in content
+    assert ('cgps2caom2_header_seconds{collection="CGPS",'
+            'observation="MD1_IRAS",status="ok",quantile="0.99"} 0.25'
+            ) in content
+    assert ('cgps2caom2_header_seconds_count{collection="CGPS",'
+            'observation="MD1_IRAS",status="ok"} 1') in content
+    # the start of the run is a value, not a label
+    assert 'start=' not in content
+    assert ('cgps2caom2_start_timestamp_seconds{collection="CGPS",'
+            'observation="MD1_IRAS",status="ok"} 1000.0\n') in content
+    assert os.listdir(str(tmpdir)) == ['cgps2caom2.prom']
@@ -0,0 +1,56 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+from cgps2caom2 import ObservationSink, read_index, read_observations
+
+import os
+import tarfile
+
+
+def test_sink(tmpdir):
+    fname = os.path.join(str(tmpdir), 'observations.tar')
+    with ObservationSink(fname) as test_subject:
+        test_subject.append('CGPS', 'MC2_FCRAO', b'<first/>\n' * 100)
+        test_subject.append('VGPS', 'ADEF012_VLA', b'<second/>\n')
+        assert ('CGPS', 'MC2_FCRAO') in test_subject
+
+    # appended to between runs, and the latest copy is the one read
+    with ObservationSink(fname) as test_subject:
+        assert ('VGPS', 'ADEF012_VLA') in test_subject
+        test_subject.append('CGPS', 'MC2_FCRAO', b'<third/>\n')
+
+    index = read_index(fname)
+    assert [(e.collection, e.observation_id) for e in index] == [
+        ('CGPS', 'MC2_FCRAO'), ('VGPS', 'ADEF012_VLA'), ('CGPS', 'MC2_FCRAO')]
+    with open(fname, 'rb') as f:
+        f.seek(index[1].offset)
+        assert f.read(index[1].size) == b'<second/>\n'
+    assert [(e.observation_id, data) for e, data in
+            read_observations(fname)] == [('ADEF012_VLA', b'<second/>\n'),
+                                          ('MC2_FCRAO', b'<third/>\n')]
+
+    # a standard tar file
+    with tarfile.open(fname) as f:
+        assert f.getnames() == ['CGPS/MC2_FCRAO.xml', 'VGPS/ADEF012_VLA.xml',
+                                'CGPS/MC2_FCRAO.xml']
+        assert f.extractfile('VGPS/ADEF012_VLA.xml').read() == b'<second/>\n'
+
+
+def test_sink_incomplete(tmpdir):
+    # what is left by a run that did not finish is discarded
+    fname = os.path.join(str(tmpdir), 'observations.tar')
+    with ObservationSink(fname) as test_subject:
+        test_subject.append('CGPS', 'MC2_FCRAO', b'<first/>\n')
+    with open(fname, 'ab') as f:
+        f.write(b'x' * 700)
+    with open('{}.index'.format(fname), 'ab') as f:
+        f.write(b'CGPS\tMD1_IRAS\t20')
+
+    with ObservationSink(fname) as test_subject:
+        assert ('CGPS', 'MD1_IRAS') not in test_subject
+        test_subject.append('CGPS', 'MD1_IRAS', b'<second/>\n')
+    assert [(e.observation_id, data) for e, data in
+            read_observations(fname)] == [('MC2_FCRAO', b'<first/>\n'),
+                                          ('MD1_IRAS', b'<second/>\n')]
+    with tarfile.open(fname) as f:
+        assert f.getnames() == ['CGPS/MC2_FCRAO.xml', 'CGPS/MD1_IRAS.xml']
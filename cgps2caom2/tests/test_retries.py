@@ -0,0 +1,81 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+from cgps2caom2 import HeaderConnectionError, HeaderRequestError
+from cgps2caom2 import HeaderTimeoutError, Metrics, RetryPolicy
+
+import pytest
+import requests
+import socket
+
+
+def _make_retrieve(failures):
+    calls = []
+
+    def _retrieve():
+        calls.append(1)
+        if len(calls) <= len(failures):
+            raise failures[len(calls) - 1]
+        return ['headers']
+
+    return _retrieve, calls
+
+
+def test_retry_policy():
+    test_subject = RetryPolicy(retries=2, backoff=0.001, seed=1)
+    metrics = Metrics()
+    retrieve, calls = _make_retrieve(
+        [ConnectionResetError('reset'), HeaderRequestError('busy', 503)])
+    assert test_subject.call(retrieve, metrics, 'test') == ['headers']
+    assert len(calls) == 3
+    result = metrics.as_dict()
+    assert result['counters'] == {'header_retries': 2}
+    assert result['percentiles']['header_seconds']['count'] == 1
+
+    # no more than the retries
+    retrieve, calls = _make_retrieve([TimeoutError('1'), TimeoutError('2'),
+                                      TimeoutError('3')])
+    with pytest.raises(TimeoutError):
+        test_subject.call(retrieve, metrics, 'test')
+    assert len(calls) == 3
+
+    # not for what will happen again
+    for failure in [HeaderRequestError('not found', 404),
+                    HeaderRequestError('Too many redirects'),
+                    ValueError('not headers'),
+                    FileNotFoundError('no such file'),
+                    PermissionError('permission denied'),
+                    IOError('unknown')]:
+        retrieve, calls = _make_retrieve([failure])
+        with pytest.raises(type(failure)):
+            test_subject.call(retrieve, metrics, 'test')
+        assert len(calls) == 1
+    assert metrics.as_dict()['counters'] == {'header_retries': 4,
+                                             'header_failures': 7}
+
+
+def test_retry_policy_is_retryable():
+    test_subject = RetryPolicy()
+    response = requests.Response()
+    response.status_code = 503
+    for failure in [ConnectionResetError('reset'), socket.timeout('slow'),
+                    HeaderConnectionError('refused'),
+                    HeaderTimeoutError('no response'),
+                    HeaderRequestError('busy', 429),
+                    requests.ConnectionError('refused'),
+                    requests.Timeout('slow'),
+                    requests.HTTPError('busy', response=response)]:
+        assert test_subject.is_retryable(failure), repr(failure)
+    response.status_code = 404
+    for failure in [requests.HTTPError('not found', response=response),
+                    FileNotFoundError('no such file'),
+                    PermissionError('permission denied'),
+                    EOFError('truncated')]:
+        assert not test_subject.is_retryable(failure), repr(failure)
+
+
+def test_retry_policy_delay():
+    test_subject = RetryPolicy(backoff=0.1, max_backoff=1.0, seed=1)
+    for attempt in range(10):
+        delay = test_subject.get_delay(attempt)
+        assert 0 <= delay <= min(1.0, 0.1 * 2 ** attempt)
@@ -0,0 +1,52 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import subprocess
+import sys
+
+import pytest
+
+
+# The cumulative time, in seconds, that 'import cgps2caom2' may take, as
+# reported by python -X importtime. It was about 0.03s when the budget was
+# set, against more than 1s when caom2utils was imported with the module.
+IMPORT_TIME_BUDGET = 0.25
+
+# The modules that must not be imported until the code that needs them runs.
+DEFERRED_MODULES = ['astropy.time', 'astropy.io.fits', 'caom2', 'caom2utils',
+                    'caom2pipe', 'cadcdata', 'cadcutils', 'asyncio']
+
+
+def _run(code, *options):
+    return subprocess.run(
+        [sys.executable] + list(options) + ['-c', code],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True, check=True)
+
+
+def test_deferred_imports():
+    code = ('import sys\n'
+            'import cgps2caom2\n'
+            'print(" ".join(sorted(sys.modules)))\n')
+    loaded = set(_run(code).stdout.split())
+    assert 'cgps2caom2' in loaded
+    assert [name for name in DEFERRED_MODULES if name in loaded] == []
+
+
+@pytest.mark.parametrize('module', ['cgps2caom2',
+                                    'cgps2caom2.cgps_composable'])
+def test_import_time_budget(module):
+    # take the best of a few runs, so that a busy machine does not fail the
+    # test, but a heavier import does
+    results = []
+    for ignore in range(3):
+        stderr = _run('import {}'.format(module), '-X', 'importtime').stderr
+        for line in stderr.splitlines():
+            # import time: self [us] | cumulative | imported package
+            fields = line.split('|')
+            if len(fields) == 3 and fields[2].strip() == 'cgps2caom2':
+                results.append(int(fields[1]) / 1e6)
+    assert len(results) == 3, 'no import time for cgps2caom2'
+    assert min(results) < IMPORT_TIME_BUDGET, \
+        'import of {} took {:.3f}s, over the budget of {}s'.format(
+            module, min(results), IMPORT_TIME_BUDGET)
@@ -0,0 +1,83 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+from cgps2caom2 import classify_file_id, group_by_observation
+from cgps2caom2 import HeaderRequestError, retrieve_headers
+from cgps2caom2.header_cache import make_headers
+from cgps2caom2.header_service import HeaderService
+from cgps2caom2.survey import generate_survey, get_name_combinations
+
+import os
+import pytest
+import time
+
+
+def test_get_name_combinations():
+    result = get_name_combinations()
+    assert len(result) == 45
+    assert ('DRAO-ST', '1420_mhz_q', 'rescb') in result
+    assert ('FCRAO', 'co_line', 'flags') in result
+    assert ('IRAS', '060_um', 'fwhm') in result
+    assert ('VLA', None, '_contincluded.tb') in result
+
+
+def test_generate_survey(tmpdir):
+    output_dir = str(tmpdir)
+    file_names = generate_survey(output_dir, targets=3, vla_targets=2)
+    assert len(file_names) == 3 * 42 + 2 * 3
+    assert sorted(os.listdir(output_dir)) == \
+        sorted('{}.header'.format(f) for f in file_names)
+
+    # every combination, for every target
+    found = set()
+    for file_name in file_names:
+        c = classify_file_id(file_name.lower())
+        found.add((c.telescope, c.band, c.content))
+    assert found == set(get_name_combinations())
+
+    groups, unmatched = group_by_observation(file_names)
+    assert unmatched == []
+    assert len(groups) == 3 * 3 + 2
+    assert len(groups[('CGPS', 'T0002_IRAS')]) == 20
+    assert groups[('VGPS', 'VGP0001_VLA')] == \
+        ['VGP0001.tb', 'VGP0001_cont.tb', 'VGP0001_contincluded.tb']
+
+    with open(os.path.join(output_dir,
+                           'CGPS_T0001_1420_MHz_Q_image.fits.header')) as f:
+        headers = make_headers(f.read())
+    assert headers[0]['ADC_AREA'] == 'T0001'
+    assert headers[0]['OBJECT'] == 'CGPS Mosaic T0001'
+    with open(os.path.join(output_dir, 'VGP0000.tb.header')) as f:
+        headers = make_headers(f.read())
+    assert headers[0]['INSTRUME'] == 'VLA'
+    assert 'FREQ0' in headers[0]
+
+
+def test_header_service_latency(tmpdir):
+    output_dir = str(tmpdir)
+    generate_survey(output_dir, targets=1, vla_targets=0)
+    uris = ['ad:CGPS/CGPS_T0000_{}_um_image.fits'.format(band)
+            for band in ['012', '025', '060', '100']]
+    with HeaderService(output_dir, latency=0.2) as service:
+        start = time.time()
+        result = retrieve_headers(uris, base_url=service.base_url,
+                                  max_connections=4)
+        elapsed = time.time() - start
+    assert sorted(result.keys()) == sorted(uris)
+    # the requests are delayed at the same time, not one after the other
+    assert 0.2 <= elapsed < 0.6
+
+
+@pytest.mark.parametrize('error_rate, reset_rate', [(1.0, 0.0), (0.0, 1.0)])
+def test_header_service_failures(tmpdir, error_rate, reset_rate):
+    output_dir = str(tmpdir)
+    generate_survey(output_dir, targets=1, vla_targets=0)
+    uris = ['ad:CGPS/CGPS_T0000_CO_line_image.fits']
+    with HeaderService(output_dir, error_rate=error_rate,
+                       reset_rate=reset_rate, seed=1) as service:
+        with pytest.raises((HeaderRequestError, ConnectionError)) as e:
+            retrieve_headers(uris, base_url=service.base_url)
+        assert service.errors == (1 if error_rate else 0)
+        assert service.resets >= (1 if reset_rate else 0)
+    if error_rate:
+        assert e.value.status == 503